@@ -3,5 +3,8 @@ import logging
 
 logging.addLevelName(5, "TRACE")
 logging.TRACE = 5
-logging.Logger.trace = lambda self, msg, *args, **kwargs: \
-    self.log(logging.TRACE, msg, *args, **kwargs)
+
+def _trace(self, msg, *args, **kwargs):
+    if self.isEnabledFor(logging.TRACE):
+        self._log(logging.TRACE, msg, args, **kwargs)
+logging.Logger.trace = _trace
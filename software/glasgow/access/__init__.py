@@ -1,3 +1,4 @@
+import time
 from abc import ABCMeta, abstractmethod
 from migen import *
 
@@ -6,7 +7,7 @@ from ..gateware.pads import Pads
 
 __all__  = ["AccessArguments"]
 __all__ += ["AccessMultiplexer", "AccessMultiplexerInterface"]
-__all__ += ["AccessDemultiplexer", "AccessDemultiplexerInterface"]
+__all__ += ["AccessDemultiplexer", "AccessDemultiplexerInterface", "AccessStream"]
 
 
 class AccessArguments(metaclass=ABCMeta):
@@ -119,6 +120,10 @@ class AccessDemultiplexer(metaclass=ABCMeta):
         for iface in self._interfaces:
             await iface.flush()
 
+    async def cancel(self):
+        for iface in self._interfaces:
+            await iface.cancel()
+
 
 class AccessDemultiplexerInterface(metaclass=ABCMeta):
     def __init__(self, device, applet):
@@ -134,6 +139,11 @@ class AccessDemultiplexerInterface(metaclass=ABCMeta):
     async def read(self, length=None):
         pass
 
+    async def readinto(self, buffer):
+        data = await self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
     async def read_str(self, *args, encoding="utf-8", **kwargs):
         result = await self.read(*args, **kwargs)
         if result is None:
@@ -141,6 +151,22 @@ class AccessDemultiplexerInterface(metaclass=ABCMeta):
         else:
             return result.decode(encoding)
 
+    async def _read_chunk(self, max_length):
+        while True:
+            data = await self.read(max_length)
+            if data:
+                return memoryview(data)
+
+    def stream(self, chunk_size=None, max_buffered=4 << 20):
+        """
+        Return an :class:`AccessStream` that iterates over chunks of at most ``chunk_size`` bytes
+        (or, if ``chunk_size`` is ``None``, of any size) received from the interface.
+
+        At most ``max_buffered`` bytes are buffered on the host for the stream; once that many
+        are, the host stops accepting data from the device until the consumer catches up.
+        """
+        return AccessStream(self, chunk_size, max_buffered)
+
     @abstractmethod
     async def write(self, data):
         pass
@@ -151,3 +177,54 @@ class AccessDemultiplexerInterface(metaclass=ABCMeta):
     @abstractmethod
     async def flush(self):
         pass
+
+    @abstractmethod
+    async def cancel(self):
+        pass
+
+
+class AccessStream:
+    """
+    An asynchronous iterator over the data received from a demultiplexer interface, yielding
+    non-empty ``memoryview`` chunks.
+
+    The stream keeps statistics: the amount of ``bytes`` and ``chunks`` received, the amount of
+    ``overflows`` (times the host buffer was full and the device had to wait for the host),
+    and the :attr:`throughput` since the first chunk was requested.
+    """
+    def __init__(self, iface, chunk_size=None, max_buffered=None):
+        self.iface        = iface
+        self.chunk_size   = chunk_size
+        self.max_buffered = max_buffered
+        self.bytes        = 0
+        self.chunks       = 0
+        self.overflows    = 0
+        self._started     = None
+        self._elapsed     = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._started is None:
+            self._started = time.perf_counter()
+        chunk = await self.iface._read_chunk(self.chunk_size)
+        self.bytes  += len(chunk)
+        self.chunks += 1
+        self._elapsed = time.perf_counter() - self._started
+        return chunk
+
+    @property
+    def throughput(self):
+        """Average throughput in bytes per second, or ``None`` if nothing was received yet."""
+        if self._elapsed == 0:
+            return None
+        return self.bytes / self._elapsed
+
+    def __str__(self):
+        if self.throughput is None:
+            throughput = "n/a"
+        else:
+            throughput = "{:.3f} MiB/s".format(self.throughput / (1 << 20))
+        return "{} bytes in {} chunks, {}, {} overflows".format(
+            self.bytes, self.chunks, throughput, self.overflows)
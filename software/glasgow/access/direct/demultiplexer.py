@@ -1,18 +1,60 @@
 import usb1
 
 from .. import AccessDemultiplexer, AccessDemultiplexerInterface
+from ...support.task_queue import *
+from ...support.chunked_fifo import *
+from ...support.logging import *
+
+
+# Each transfer is submitted for this many packets at once. An IN transfer completes early
+# if the device sends a short packet, so this only limits the throughput, not the latency.
+_packets_per_xfer = 32
+# This many IN transfers are kept in flight at all times, so that the FX2 always has somewhere
+# to put the data while the host is busy with something else. At most this many OUT transfers
+# are in flight at any time; once that many are, writes wait until one of them completes.
+#
+# On Linux, the total amount of memory for in-flight transfers is limited by the usbcore module
+# parameter usbfs_memory_mb (16 MiB by default), so this should not be made much larger.
+_xfers_per_queue  = 16
+
+# In configuration 1, the FX2 has two interfaces, each with a pair of double-buffered endpoints.
+# In configuration 2, it has only the first interface, but its endpoints are quad-buffered.
+_config_double_buffered = 1
+_config_quad_buffered   = 2
 
 
 class DirectDemultiplexer(AccessDemultiplexer):
-    def __init__(self, device):
+    """
+    If ``quad_buffered`` is true, the device is switched to the USB configuration with
+    quad-buffered endpoints, which only works for designs that use just the first FIFO pair
+    (see :attr:`DirectMultiplexer.single_interface`).
+    """
+    def __init__(self, device, packets_per_xfer=_packets_per_xfer,
+                 xfers_per_queue=_xfers_per_queue, quad_buffered=False):
         super().__init__(device)
         self._claimed    = set()
+        self._packets_per_xfer = packets_per_xfer
+        self._xfers_per_queue  = xfers_per_queue
+        self._quad_buffered    = quad_buffered
+
+    def _set_configuration(self):
+        if self._quad_buffered:
+            config_num = _config_quad_buffered
+        else:
+            config_num = _config_double_buffered
+        if self.device.usb.getConfiguration() != config_num:
+            self.device.usb.setConfiguration(config_num)
 
     async def claim_interface(self, applet, mux_interface, args):
         assert mux_interface._fifo_num not in self._claimed
+        assert not self._quad_buffered or mux_interface._fifo_num == 0
+        if not self._claimed:
+            self._set_configuration()
         self._claimed.add(mux_interface._fifo_num)
 
-        iface = DirectDemultiplexerInterface(self.device, applet, mux_interface)
+        iface = DirectDemultiplexerInterface(self.device, applet, mux_interface,
+                                             packets_per_xfer=self._packets_per_xfer,
+                                             xfers_per_queue=self._xfers_per_queue)
         self._interfaces.append(iface)
 
         if hasattr(args, "mirror_voltage") and args.mirror_voltage:
@@ -32,9 +74,13 @@ class DirectDemultiplexer(AccessDemultiplexer):
 
 
 class DirectDemultiplexerInterface(AccessDemultiplexerInterface):
-    def __init__(self, device, applet, mux_interface):
+    def __init__(self, device, applet, mux_interface, packets_per_xfer=_packets_per_xfer,
+                 xfers_per_queue=_xfers_per_queue):
         super().__init__(device, applet)
 
+        self._packets_per_xfer = packets_per_xfer
+        self._xfers_per_queue  = xfers_per_queue
+
         self._fifo_num   = mux_interface._fifo_num
         self._addr_reset = mux_interface._addr_reset
 
@@ -46,6 +92,9 @@ class DirectDemultiplexerInterface(AccessDemultiplexerInterface):
         interfaces = list(config.iterInterfaces())
         assert self._fifo_num <= len(interfaces)
         interface = interfaces[self._fifo_num]
+        self.quad_buffered = (config_num == _config_quad_buffered)
+        self.logger.debug("using %s-buffered endpoints",
+                          "quad" if self.quad_buffered else "double")
 
         settings = list(interface.iterSettings())
         setting = settings[1] # alt-setting 1 has the actual endpoints
@@ -61,60 +110,179 @@ class DirectDemultiplexerInterface(AccessDemultiplexerInterface):
         assert self._endpoint_in != None and self._endpoint_out != None
 
         self._interface  = self.device.usb.claimInterface(self._fifo_num)
-        self._buffer_in  = bytearray()
-        self._buffer_out = bytearray()
+        self._in_tasks   = TaskQueue()
+        self._out_tasks  = TaskQueue()
+        self._buffer_in  = ChunkedFIFO()
+        self._buffer_out = ChunkedFIFO()
+        # While a stream is active, the IN queue is not refilled once the stream's buffering
+        # bound is reached, which leaves it to the device to hold the data.
+        self._stream     = None
+        self._in_paused  = False
+        self._in_pending = 0
+
+    async def cancel(self):
+        if self._in_tasks or self._out_tasks:
+            self.logger.trace("FIFO: cancelling operations")
+            await self._in_tasks.cancel()
+            await self._out_tasks.cancel()
 
     async def reset(self):
         self.logger.trace("asserting reset")
         await self.device.write_register(self._addr_reset, 1)
+        await self.cancel()
         self.logger.trace("synchronizing FIFO")
         self.device.usb.setInterfaceAltSetting(self._fifo_num, 1)
+        self._buffer_in .clear()
+        self._buffer_out.clear()
+        self._in_paused = False
+        # Queue the reads before deasserting reset, so that an applet that starts streaming
+        # data immediately does not have to wait for the host to catch up.
+        self.logger.trace("FIFO: queueing %d reads", self._xfers_per_queue)
+        for _ in range(self._xfers_per_queue):
+            self._submit_in()
         self.logger.trace("deasserting reset")
         await self.device.write_register(self._addr_reset, 0)
 
-    async def _read_packet(self):
-        packet = await self.device.bulk_read(self._endpoint_in, self._in_packet_size)
-        self._buffer_in += packet
+    def _submit_in(self):
+        self._in_pending += 1
+        self._in_tasks.submit(self._in_task())
 
-    async def read(self, length=None):
+    async def _in_task(self):
+        size = self._in_packet_size * self._packets_per_xfer
+        try:
+            data = await self.device.bulk_read(self._endpoint_in, size)
+        finally:
+            # A failed transfer is not resubmitted here; the error is reraised to the reader,
+            # and the queue is topped up by the next read (see _resume_in).
+            self._in_pending -= 1
+        self._buffer_in.write(data)
+
+        if self._stream is not None and len(self._buffer_in) >= self._stream.max_buffered:
+            if not self._in_paused:
+                self.logger.trace("FIFO: stream buffer full, pausing reads")
+                self._stream.overflows += 1
+                self._in_paused = True
+            return
+
+        # Resubmit right away, so that the queue stays full even if nobody is reading.
+        self._submit_in()
+
+    def _resume_in(self, length=0):
+        if self._in_paused:
+            if len(self._buffer_in) >= max(length, self._stream.max_buffered):
+                return
+            self.logger.trace("FIFO: resuming reads")
+            self._in_paused = False
+        while self._in_pending < self._xfers_per_queue:
+            self._submit_in()
+
+    async def _wait_in(self):
+        # Waiting on an empty queue returns immediately, so a read loop would never yield.
+        assert self._in_tasks, "no IN transfers in flight"
+        await self._in_tasks.wait_one()
+
+    async def _fill(self, length):
         if len(self._buffer_out) > 0:
             # Flush the buffer, so that everything written before the read reaches the device.
-            await self.flush()
+            # There is no need to wait for the writes to complete, since the reads are queued
+            # after them anyway.
+            await self.flush(wait=False)
 
+        self._resume_in()
         if length is None and len(self._buffer_in) > 0:
             # Just return whatever is in the buffer.
             length = len(self._buffer_in)
         elif length is None:
             # Return whatever is received in the next transfer, even if it's nothing.
-            await self._read_packet()
+            await self._wait_in()
             length = len(self._buffer_in)
         else:
             # Return exactly the requested length.
             while len(self._buffer_in) < length:
                 self.logger.trace("FIFO: need %d bytes", length - len(self._buffer_in))
-                await self._read_packet()
+                self._resume_in(length)
+                await self._wait_in()
+
+        return length
 
-        result = self._buffer_in[:length]
-        self._buffer_in = self._buffer_in[length:]
-        self.logger.trace("FIFO: read <%s>", result.hex())
+    async def read(self, length=None):
+        length = await self._fill(length)
+
+        result = bytearray(length)
+        self._buffer_in.readinto(result)
+        self.logger.trace("FIFO: read <%s>", dump_hex(result))
+        return result
+
+    async def readinto(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        length = await self._fill(len(buffer))
+
+        self._buffer_in.readinto(buffer)
+        self.logger.trace("FIFO: read <%s>", dump_hex(buffer))
+        return length
+
+    def stream(self, chunk_size=None, max_buffered=4 << 20):
+        self._stream = super().stream(chunk_size, max_buffered)
+        return self._stream
+
+    async def _read_chunk(self, max_length):
+        if len(self._buffer_out) > 0:
+            await self.flush(wait=False)
+
+        while len(self._buffer_in) == 0:
+            self._resume_in()
+            await self._wait_in()
+
+        # The chunks in the buffer are never reused, so they can be handed out without copying.
+        result = self._buffer_in.read(max_length)
+        self._resume_in()
+        self.logger.trace("FIFO: read <%s>", dump_hex(result))
         return result
 
-    async def _write_packet(self):
-        packet = self._buffer_out[:self._out_packet_size]
-        self._buffer_out = self._buffer_out[self._out_packet_size:]
-        await self.device.bulk_write(self._endpoint_out, packet)
+    async def _out_task(self, data):
+        await self.device.bulk_write(self._endpoint_out, data)
+
+    async def _submit_out(self, length):
+        # Applying backpressure here keeps the amount of memory pinned by in-flight transfers
+        # bounded no matter how much data the applet writes.
+        while len(self._out_tasks) >= self._xfers_per_queue:
+            self.logger.trace("FIFO: write pushback")
+            await self._out_tasks.wait_one()
+
+        # Another write or flush could have drained the buffer while we were waiting.
+        length = min(length, len(self._buffer_out))
+        if length == 0:
+            return
+
+        data = self._buffer_out.read(length)
+        if len(data) < length:
+            # The transfer spans several chunks, so they have to be joined.
+            data = bytearray(data)
+            while len(data) < length:
+                data += self._buffer_out.read(length - len(data))
+        self._out_tasks.submit(self._out_task(data))
 
     async def write(self, data):
-        if not isinstance(data, (bytes, bytearray)):
+        # The data is sent after write() returns, so it must be copied if the caller could
+        # change it in the meantime.
+        if not isinstance(data, bytes):
             data = bytes(data)
 
-        self.logger.trace("FIFO: write <%s>", data.hex())
-        self._buffer_out += data
+        # Eagerly report any errors in the previously queued writes.
+        await self._out_tasks.poll()
+
+        self.logger.trace("FIFO: write <%s>", dump_hex(data))
+        self._buffer_out.write(data)
 
-        if len(self._buffer_out) > self._out_packet_size:
-            await self._write_packet()
+        xfer_size = self._out_packet_size * self._packets_per_xfer
+        while len(self._buffer_out) >= xfer_size:
+            await self._submit_out(xfer_size)
 
-    async def flush(self):
+    async def flush(self, wait=True):
         self.logger.trace("FIFO: flush")
         while len(self._buffer_out) > 0:
-            await self._write_packet()
+            await self._submit_out(len(self._buffer_out))
+
+        if wait:
+            self.logger.trace("FIFO: wait for flush")
+            await self._out_tasks.wait_all()
@@ -1,6 +1,7 @@
 import logging
 from migen import *
 
+from ...applet import GlasgowAppletError
 from .. import AccessMultiplexer, AccessMultiplexerInterface
 
 
@@ -78,37 +79,46 @@ class DirectMultiplexer(AccessMultiplexer):
         self._registers     = registers
         self._fx2_arbiter   = fx2_arbiter
 
+    @property
+    def single_interface(self):
+        """
+        Whether the design only uses the first pair of FIFOs, and so can use the USB configuration
+        where the corresponding endpoints are quad-buffered.
+        """
+        return self._claimed_fifos == 1
+
     def set_analyzer(self, analyzer):
         assert self._analyzer is None
         self._analyzer = analyzer
 
     def claim_interface(self, applet, args, with_analyzer=True, throttle="fifo"):
-        if self._claimed_fifos == self._fifo_count:
-            applet.logger.error("cannot claim USB FIFO: out of FIFOs")
-            return None
-        fifo_num = self._claimed_fifos
-        self._claimed_fifos += 1
-
         pins = []
         pin_names = []
         if hasattr(args, "port_spec"):
             iface_spec = list(args.port_spec)
 
+            for port in iface_spec:
+                if port not in self._ports:
+                    raise GlasgowAppletError("port {} does not exist".format(port))
+
             claimed_spec = self._claimed_ports.intersection(iface_spec)
             if claimed_spec:
-                applet.logger.error("cannot claim port(s) %s: port(s) %s already claimed",
-                                    ", ".join(sorted(iface_spec)),
-                                    ", ".join(sorted(claimed_spec)))
-                return None
+                raise GlasgowAppletError("cannot claim port(s) {}: port(s) {} already claimed"
+                                         .format(", ".join(sorted(iface_spec)),
+                                                 ", ".join(sorted(claimed_spec))))
+        else:
+            iface_spec = []
 
-            for port in iface_spec:
-                if port not in self._ports:
-                    applet.logger.error("port %s does not exist", port)
-                    return None
-                else:
-                    port_signal = self._ports[port]()
-                    pins += [port_signal[bit] for bit in range(port_signal.nbits)]
-                    pin_names += ["{}{}".format(port, bit) for bit in range(port_signal.nbits)]
+        if self._claimed_fifos == self._fifo_count:
+            raise GlasgowAppletError("cannot claim USB FIFO: out of FIFOs")
+        fifo_num = self._claimed_fifos
+        self._claimed_fifos += 1
+
+        for port in iface_spec:
+            port_signal = self._ports[port]()
+            pins += [port_signal[bit] for bit in range(port_signal.nbits)]
+            pin_names += ["{}{}".format(port, bit) for bit in range(port_signal.nbits)]
+        self._claimed_ports.update(iface_spec)
 
         if with_analyzer and self._analyzer:
             analyzer = self._analyzer
@@ -2,6 +2,7 @@ import asyncio
 from migen import *
 
 from .. import AccessDemultiplexer, AccessDemultiplexerInterface
+from ...support.logging import *
 
 
 class SimulationDemultiplexer(AccessDemultiplexer):
@@ -34,13 +35,27 @@ class SimulationDemultiplexerInterface(AccessDemultiplexerInterface):
                 data.append((yield from self._in_fifo.read()))
 
         data = bytes(data)
-        self.logger.trace("FIFO: read <%s>", data.hex())
+        self.logger.trace("FIFO: read <%s>", dump_hex(data))
         return data
 
+    @asyncio.coroutine
+    def _read_chunk(self, max_length):
+        # There is no buffering on the host side, so the chunk is whatever the FIFO holds once
+        # it becomes readable.
+        while not (yield self._in_fifo.readable):
+            yield
+        data = []
+        while (max_length is None or len(data) < max_length) and (yield self._in_fifo.readable):
+            data.append((yield from self._in_fifo.read()))
+
+        data = bytes(data)
+        self.logger.trace("FIFO: read <%s>", dump_hex(data))
+        return memoryview(data)
+
     @asyncio.coroutine
     def write(self, data):
         data = bytes(data)
-        self.logger.trace("FIFO: write <%s>", data.hex())
+        self.logger.trace("FIFO: write <%s>", dump_hex(data))
 
         for byte in data:
             while not (yield self._out_fifo.writable):
@@ -50,3 +65,7 @@ class SimulationDemultiplexerInterface(AccessDemultiplexerInterface):
     @asyncio.coroutine
     def flush(self):
         pass
+
+    @asyncio.coroutine
+    def cancel(self):
+        pass
@@ -1,25 +1,77 @@
 import re
 import argparse
+import importlib
+from collections.abc import Mapping
 
 
 __all__ = ["GlasgowAppletError", "GlasgowApplet", "GlasgowAppletTestCase",
            "synthesis_test", "applet_simulation_test"]
 
 
+# Applet modules are imported only once the applet is used, so that commands which do not use
+# any applet start quickly. Every applet must be listed here.
+_applet_modules = {
+    "benchmark":        ".benchmark",
+    "hd44780":          ".hd44780",
+    "i2c-master":       ".i2c.master",
+    "i2c-bmp280":       ".i2c.bmp280",
+    "i2c-eeprom-24c":   ".i2c.eeprom_24c",
+    "i2c-tps6598x":     ".i2c.tps6598x",
+    "jtag":             ".jtag",
+    "jtag-mips":        ".jtag.mips",
+    "nand-flash":       ".nand_flash",
+    "program-ice40":    ".program_ice40",
+    "rgb-grabber":      ".rgb_grabber",
+    "selftest":         ".selftest",
+    "spi-master":       ".spi.master",
+    "spi-flash-25c":    ".spi.flash_25c",
+    "spi-flash-avr":    ".spi.flash_avr",
+    "swd":              ".swd",
+    "uart":             ".uart",
+}
+
+
+class _AppletRegistry(Mapping):
+    """
+    A mapping of applet names to applet classes, which imports the module defining an applet
+    when it is looked up for the first time. Iterating over the names does not import anything.
+    """
+    def __init__(self, modules):
+        self._modules = modules
+        self._applets = {}
+
+    def register(self, name, applet):
+        if name in self._applets:
+            raise ValueError("Applet {!r} already exists".format(name))
+        self._applets[name] = applet
+
+    def __getitem__(self, name):
+        if name not in self._applets and name in self._modules:
+            importlib.import_module(self._modules[name], __name__)
+        return self._applets[name]
+
+    def __contains__(self, name):
+        return name in self._modules or name in self._applets
+
+    def __iter__(self):
+        yield from self._modules
+        yield from (name for name in self._applets if name not in self._modules)
+
+    def __len__(self):
+        return len(self._modules.keys() | self._applets.keys())
+
+
 class GlasgowAppletError(Exception):
     """An exception raised when an applet encounters an error."""
 
 
 class GlasgowApplet:
-    all_applets = {}
+    all_applets = _AppletRegistry(_applet_modules)
 
     def __init_subclass__(cls, name, **kwargs):
         super().__init_subclass__(**kwargs)
 
-        if name in cls.all_applets:
-            raise ValueError("Applet {!r} already exists".format(name))
-
-        cls.all_applets[name] = cls
+        cls.all_applets.register(name, cls)
         cls.name = name
 
     preview = False
@@ -53,13 +105,9 @@ import os
 import shutil
 import unittest
 import functools
-from migen.sim import *
 
-from ..access.direct import *
-from ..access.simulation import *
-from ..target.hardware import *
-from ..target.simulation import *
-from ..device.simulation import *
+# The toolchain and simulator are imported by the methods that use them, so that importing
+# this module (which every applet and the CLI do) does not also import migen.
 
 
 class GlasgowAppletTestCase(unittest.TestCase):
@@ -73,6 +121,9 @@ class GlasgowAppletTestCase(unittest.TestCase):
         self.applet = self.applet_cls()
 
     def assertBuilds(self, access="direct", args=[]):
+        from ..access.direct import DirectMultiplexer, DirectArguments
+        from ..target.hardware import GlasgowHardwareTarget
+
         if access == "direct":
             target = GlasgowHardwareTarget(multiplexer_cls=DirectMultiplexer)
             access_args = DirectArguments(applet_name=self.applet.name,
@@ -89,6 +140,11 @@ class GlasgowAppletTestCase(unittest.TestCase):
         target.get_bitstream(debug=True)
 
     def _prepare_simulation_target(self, args):
+        from ..access.simulation import (SimulationMultiplexer, SimulationDemultiplexer,
+                                         SimulationArguments)
+        from ..target.simulation import GlasgowSimulationTarget
+        from ..device.simulation import GlasgowSimulationDevice
+
         self.target = GlasgowSimulationTarget()
         self.target.submodules.multiplexer = SimulationMultiplexer()
 
@@ -121,6 +177,8 @@ def applet_simulation_test(setup, args=[]):
     def decorator(case):
         @functools.wraps(case)
         def wrapper(self):
+            from migen.sim import run_simulation
+
             self._prepare_simulation_target(args)
             getattr(self, setup)()
             vcd_name = "{}.vcd".format(case.__name__)
@@ -130,23 +188,3 @@ def applet_simulation_test(setup, args=[]):
         return wrapper
 
     return decorator
-
-# -------------------------------------------------------------------------------------------------
-
-from .benchmark import BenchmarkApplet
-from .rgb_grabber import RGBGrabberApplet
-from .hd44780 import HD44780Applet
-from .i2c.master import I2CMasterApplet
-from .i2c.bmp280 import I2CBMP280Applet
-from .i2c.eeprom_24c import I2CEEPROM24CApplet
-from .i2c.tps6598x import I2CTPS6598xApplet
-from .jtag import JTAGApplet
-from .jtag.mips import JTAGMIPSApplet
-from .nand_flash import NANDFlashApplet
-from .program_ice40 import ProgramICE40Applet
-from .selftest import SelfTestApplet
-from .spi.master import SPIMasterApplet
-from .spi.flash_25c import SPIFlash25CApplet
-from .spi.flash_avr import SPIFlashAVRApplet
-from .swd import SWDApplet
-from .uart import UARTApplet
@@ -86,6 +86,10 @@ class BenchmarkApplet(GlasgowApplet, name="benchmark"):
         * loopback: host emits an endless stream of data via one FIFOs, device mirrors it all back,
           host validates
           (simulates an SPI protocol subtarget)
+
+    When this applet is the only one in the bitstream, the device uses quad-buffered USB
+    endpoints; run it with and without `glasgow run --no-quad-buffering` to compare that
+    with double-buffered ones.
     """
 
     __all_modes = ["source", "sink", "loopback"]
@@ -115,6 +119,10 @@ class BenchmarkApplet(GlasgowApplet, name="benchmark"):
 
     async def run(self, device, args):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
+        if getattr(iface, "quad_buffered", False):
+            buffering = "quad-buffered endpoints"
+        else:
+            buffering = "double-buffered endpoints"
 
         golden = bytearray().join([struct.pack("<H", self.__sequence[n % len(self.__sequence)])
                                    for n in range(args.count)])
@@ -160,8 +168,8 @@ class BenchmarkApplet(GlasgowApplet, name="benchmark"):
             if error:
                 self.logger.error("mode %s failed!", mode)
             else:
-                self.logger.info("mode %s: %.3f MiB/s",
-                                 mode, (len(golden) / (end - begin)) / (1 << 20))
+                self.logger.info("mode %s: %.3f MiB/s (%s)",
+                                 mode, (len(golden) / (end - begin)) / (1 << 20), buffering)
 
 # -------------------------------------------------------------------------------------------------
 
@@ -1,6 +1,7 @@
 import logging
 
 from .. import *
+from ...support.logging import *
 from .master import I2CMasterApplet
 
 
@@ -39,7 +40,7 @@ class I2CEEPROM24CInterface:
         if data is None:
             self._log("unacked")
         else:
-            self._log("data=<%s>", data.hex())
+            self._log("data=<%s>", dump_hex(data))
         return data
 
     async def write(self, addr, data):
@@ -53,7 +54,7 @@ class I2CEEPROM24CInterface:
 
             chunk = data[:chunk_size]
             data  = data[chunk_size:]
-            self._log("i2c-addr=%#04x addr=%#06x write=<%s>", i2c_addr, addr, chunk.hex())
+            self._log("i2c-addr=%#04x addr=%#06x write=<%s>", i2c_addr, addr, dump_hex(chunk))
             result = await self.lower.write(i2c_addr, [*addr_bytes, *chunk], stop=True)
             if result is False:
                 self._log("unacked")
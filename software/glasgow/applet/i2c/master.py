@@ -4,6 +4,7 @@ from migen import *
 from migen.genlib.fsm import *
 
 from .. import *
+from ...support.logging import *
 from ...gateware.pads import *
 from ...gateware.i2c import I2CMaster
 from ...pyrepl import *
@@ -196,10 +197,10 @@ class I2CMasterInterface:
 
         if stop:
             self._logger.log(self._level, "I2C: start addr=%s write=<%s> stop",
-                             bin(addr), data.hex())
+                             bin(addr), dump_hex(data))
         else:
             self._logger.log(self._level, "I2C: start addr=%s write=<%s>",
-                             bin(addr), data.hex())
+                             bin(addr), dump_hex(data))
 
         await self._cmd_start()
         await self._cmd_count(1 + len(data))
@@ -236,7 +237,7 @@ class I2CMasterInterface:
         unacked, = await self._data_read(1)
         data = await self._data_read(size)
         if unacked == 0:
-            self._logger.log(self._level, "I2C: acked data=<%s>", data.hex())
+            self._logger.log(self._level, "I2C: acked data=<%s>", dump_hex(data))
             return data
         else:
             self._logger.log(self._level, "I2C: unacked")
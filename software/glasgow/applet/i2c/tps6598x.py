@@ -2,6 +2,7 @@ import logging
 import asyncio
 
 from .. import *
+from ...support.logging import *
 from .master import I2CMasterApplet
 
 
@@ -26,14 +27,14 @@ class TPS6598xI2CInterface:
 
         self._check(await self.lower.write(self._i2c_addr, [address]))
         data = self._check(await self.lower.read(self._i2c_addr, 1 + size, stop=True))[1:]
-        self._logger.log(self._level, "TPS6598x: read=<%s>", data.hex())
+        self._logger.log(self._level, "TPS6598x: read=<%s>", dump_hex(data))
 
         return data
 
     async def write_reg(self, address, data):
         data = bytes(data)
         self._logger.log(self._level, "TPS6598x: reg=%#04x write=<%s>",
-                         address, data.hex())
+                         address, dump_hex(data))
         self._check(await self.lower.write(self._i2c_addr, [address, len(data), *data], stop=True))
 
 
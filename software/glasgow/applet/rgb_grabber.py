@@ -151,11 +151,19 @@ class RGBGrabberApplet(GlasgowApplet, name="rgb-grabber"):
     async def run(self, device, args):
         iface = await device.demultiplexer.claim_interface(self, self.mux_interface, args)
 
-        for _ in range(200):
-            sync = 0
-            while not (sync & 0x80):
-                sync = (await iface.read(1))[0]
-            frame = (sync & 0x3e) >> 1
-            row   = ((sync & 0x01) << 7) | (await iface.read(1))[0]
+        rows = 0
+        sync = None
+        async for chunk in iface.stream():
+            for byte in chunk:
+                if sync is None:
+                    if byte & 0x80:
+                        sync = byte
+                    continue
+                frame = (sync & 0x3e) >> 1
+                row   = ((sync & 0x01) << 7) | byte
+                sync  = None
 
-            print("frame {} row {}".format(frame, row))
+                print("frame {} row {}".format(frame, row))
+                rows += 1
+                if rows == 200:
+                    return
@@ -5,6 +5,7 @@ import logging
 import argparse
 
 from .. import *
+from ...support.logging import *
 from .master import SPIMasterApplet
 
 
@@ -20,12 +21,12 @@ class SPIFlash25CInterface:
     async def _command(self, cmd, arg=[], dummy=0, ret=0):
         arg = bytes(arg)
 
-        self._log("cmd=%02X arg=<%s> dummy=%d ret=%d", cmd, arg.hex(), dummy, ret)
+        self._log("cmd=%02X arg=<%s> dummy=%d ret=%d", cmd, dump_hex(arg), dummy, ret)
 
         result = await self.lower.transfer([cmd, *arg, *[0 for _ in range(dummy + ret)]])
         result = result[1 + len(arg) + dummy:]
 
-        self._log("result=<%s>", result.hex())
+        self._log("result=<%s>", dump_hex(result))
 
         return result
 
@@ -116,7 +117,7 @@ class SPIFlash25CInterface:
 
     async def page_program(self, address, data):
         data = bytes(data)
-        self._log("page program addr=%#08x data=<%s>", address, data.hex())
+        self._log("page program addr=%#08x data=<%s>", address, dump_hex(data))
         await self._command(0x02, arg=self._format_addr(address) + data)
         while await self.write_in_progress(): pass
 
@@ -6,6 +6,7 @@ from migen.genlib.fsm import *
 from migen.genlib.cdc import *
 
 from .. import *
+from ...support.logging import *
 
 
 class SPIBus(Module):
@@ -161,13 +162,13 @@ class SPIMasterInterface:
         assert len(data) <= 0xffff
         data = bytes(data)
 
-        self._log("out=<%s>", data.hex())
+        self._log("out=<%s>", dump_hex(data))
 
         await self.lower.write(struct.pack(">H", len(data)))
         await self.lower.write(data)
         data = await self.lower.read(len(data))
 
-        self._log("in=<%s>", data.hex())
+        self._log("in=<%s>", dump_hex(data))
 
         return data
 
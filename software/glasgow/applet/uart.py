@@ -6,6 +6,7 @@ from migen import *
 from migen.genlib.fsm import *
 
 from . import *
+from ..support.logging import *
 from ..gateware.pads import *
 from ..gateware.uart import *
 
@@ -94,13 +95,14 @@ class UARTApplet(GlasgowApplet, name="uart"):
 
     async def _forward(self, in_fileno, out_fileno, uart, quit_sequence=False, stream=False):
         quit = 0
+        uart_stream = uart.stream()
         dev_fut = uart_fut = None
         while True:
             if dev_fut is None:
                 dev_fut = asyncio.get_event_loop().run_in_executor(None,
                     lambda: os.read(in_fileno, 1024))
             if uart_fut is None:
-                uart_fut = asyncio.ensure_future(uart.read())
+                uart_fut = asyncio.ensure_future(uart_stream.__anext__())
 
             await asyncio.wait([uart_fut, dev_fut], return_when=asyncio.FIRST_COMPLETED)
 
@@ -120,7 +122,7 @@ class UARTApplet(GlasgowApplet, name="uart"):
                     else:
                         quit = 0
 
-                self.logger.trace("in->UART: <%s>", data.hex())
+                self.logger.trace("in->UART: <%s>", dump_hex(data))
                 await uart.write(data)
                 await uart.flush()
 
@@ -128,12 +130,13 @@ class UARTApplet(GlasgowApplet, name="uart"):
                 data = await uart_fut
                 uart_fut = None
 
-                self.logger.trace("UART->out: <%s>", data.hex())
+                self.logger.trace("UART->out: <%s>", dump_hex(data))
                 os.write(out_fileno, data)
 
         for fut in [uart_fut, dev_fut]:
             if fut is not None and not fut.done():
                 fut.cancel()
+        self.logger.debug("UART->out: %s", uart_stream)
 
     async def _interact_tty(self, uart, stream):
         in_fileno  = sys.stdin.fileno()
@@ -189,3 +192,19 @@ class UARTAppletTestCase(GlasgowAppletTestCase, applet=UARTApplet):
         uart_iface = await self.run_simulated_applet()
         await uart_iface.write(bytes([0xAA, 0x55]))
         self.assertEqual(await uart_iface.read(2), bytes([0xAA, 0x55]))
+
+    @applet_simulation_test("setup_loopback", ["--baud", "5000000"])
+    async def test_loopback_stream(self):
+        uart_iface = await self.run_simulated_applet()
+        await uart_iface.write(bytes([0xAA, 0x55, 0x33]))
+        data = bytearray()
+        stream = uart_iface.stream(chunk_size=2)
+        async for chunk in stream:
+            self.assertIsInstance(chunk, memoryview)
+            self.assertLessEqual(len(chunk), 2)
+            data += chunk
+            if len(data) == 3:
+                break
+        self.assertEqual(data, bytes([0xAA, 0x55, 0x33]))
+        self.assertEqual(stream.bytes, 3)
+        self.assertEqual(stream.overflows, 0)
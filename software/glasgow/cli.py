@@ -1,5 +1,17 @@
+import io
 import os
 import sys
+import copy
+import json
+import stat
+import time
+import shlex
+import signal
+import socket
+import struct
+import getpass
+import tempfile
+import contextlib
 import logging
 import argparse
 import textwrap
@@ -7,20 +19,19 @@ import re
 import asyncio
 import unittest
 import shutil
-from vcd import VCDWriter
+import functools
+import concurrent.futures
 from datetime import datetime
 
 from fx2 import VID_CYPRESS, PID_FX2, FX2Config
-from fx2.format import input_data, diff_data
+from fx2.format import input_data
 
 from .device import GlasgowDeviceError
 from .device.config import GlasgowConfig
-from .target.hardware import GlasgowHardwareTarget
-from .gateware.analyzer import TraceDecoder
+from .target.cache import BitstreamCache, elaboration_key
 from .device.hardware import VID_QIHW, PID_GLASGOW, GlasgowHardwareDevice
-from .internal_test import *
-from .access.direct import *
 from .applet import *
+from .support.endpoint import endpoint
 from .pyrepl import *
 
 
@@ -51,6 +62,108 @@ class TextHelpFormatter(argparse.HelpFormatter):
         return re.sub(r"((?!\n\n)(?!\n\s+(?:\*|\d+\.)).)+(\n*)?", filler, text, flags=re.S)
 
 
+class _LazySubParsersAction(argparse._SubParsersAction):
+    """
+    A subparsers action where each subparser is constructed only once it is selected, and its
+    help text is only computed once it is displayed.
+    """
+    class _LazyChoicesPseudoAction(argparse.Action):
+        def __init__(self, name, get_help):
+            super().__init__(option_strings=[], dest=name, metavar=name)
+            self._get_help = get_help
+
+        @property
+        def help(self):
+            return self._get_help()
+
+        @help.setter
+        def help(self, value):
+            pass
+
+    class _LazyParserMap(dict):
+        def __init__(self):
+            super().__init__()
+            self.builders = {}
+
+        def __contains__(self, name):
+            return name in self.builders or super().__contains__(name)
+
+        def __iter__(self):
+            yield from super().__iter__()
+            yield from self.builders
+
+        def __len__(self):
+            return super().__len__() + len(self.builders)
+
+        def __missing__(self, name):
+            parser = self[name] = self.builders.pop(name)()
+            return parser
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._name_parser_map = self.choices = self._LazyParserMap()
+
+    def add_lazy_parser(self, name, get_help, build, **kwargs):
+        """
+        Add a subparser ``name`` that is constructed by calling ``build(parser)`` on a new parser
+        created with ``kwargs`` once it is selected, and described by the result of
+        ``get_help()``.
+        """
+        if kwargs.get("prog") is None:
+            kwargs["prog"] = "{} {}".format(self._prog_prefix, name)
+
+        def construct():
+            parser = self._parser_class(**kwargs)
+            build(parser)
+            return parser
+
+        self._choices_actions.append(self._LazyChoicesPseudoAction(name, get_help))
+        self._name_parser_map.builders[name] = construct
+
+
+def _applet_help(applet_name):
+    applet = GlasgowApplet.all_applets[applet_name]
+    help = applet.help
+    if applet.preview:
+        help += " (PREVIEW QUALITY APPLET)"
+    return help
+
+
+def _add_applet_arguments(parser, applet_name, mode):
+    from .access.direct import DirectArguments
+
+    applet = GlasgowApplet.all_applets[applet_name]
+    description = applet.description
+    if applet.preview:
+        description = """
+        This applet is PREVIEW QUALITY and may CORRUPT DATA or have missing features.
+        Use at your own risk.
+        """ + description
+    parser.description = description
+
+    if mode == "test":
+        parser.add_argument(
+            "tests", metavar="TEST", nargs="*",
+            help="test cases to run")
+        return
+
+    access_args = DirectArguments(applet_name=applet_name,
+                                  default_port="AB",
+                                  pin_count=16)
+    if mode in ("run", "server"):
+        g_applet_build = parser.add_argument_group("build arguments")
+        applet.add_build_arguments(g_applet_build, access_args)
+        g_applet_run = parser.add_argument_group("run arguments")
+        applet.add_run_arguments(g_applet_run, access_args)
+        if mode == "run":
+            # FIXME: this makes it impossiblt to add subparsers in applets
+            # g_applet_interact = parser.add_argument_group("interact arguments")
+            # applet.add_interact_arguments(g_applet_interact)
+            applet.add_interact_arguments(parser)
+    else:
+        applet.add_build_arguments(parser, access_args)
+
+
 def get_argparser():
     def add_subparsers(parser, **kwargs):
         if isinstance(parser, argparse._MutuallyExclusiveGroup):
@@ -61,54 +174,28 @@ def get_argparser():
                 kwargs['prog'] = formatter.format_help().strip()
 
             parsers_class = parser._pop_action_class(kwargs, 'parsers')
-            subparsers = argparse._SubParsersAction(option_strings=[],
-                                                    parser_class=type(container),
-                                                    **kwargs)
+            subparsers = _LazySubParsersAction(option_strings=[],
+                                               parser_class=type(container),
+                                               **kwargs)
             parser._add_action(subparsers)
         else:
-            subparsers = parser.add_subparsers(dest="applet", metavar="APPLET")
+            subparsers = parser.add_subparsers(action=_LazySubParsersAction,
+                                               dest="applet", metavar="APPLET")
         return subparsers
 
     def add_applet_arg(parser, mode, required=False):
         subparsers = add_subparsers(parser, dest="applet", metavar="APPLET")
         subparsers.required = required
 
-        for applet_name, applet in GlasgowApplet.all_applets.items():
-            if mode == "test" and not hasattr(applet, "test_cls"):
-                continue
-
-            help        = applet.help
-            description = applet.description
-            if applet.preview:
-                help += " (PREVIEW QUALITY APPLET)"
-                description = """
-                This applet is PREVIEW QUALITY and may CORRUPT DATA or have missing features.
-                Use at your own risk.
-                """ + description
-
-            p_applet = subparsers.add_parser(
-                applet_name, help=help, description=description,
+        # Applets are imported, and their arguments are added, only when one is selected or
+        # when the list of applets is displayed.
+        for applet_name in GlasgowApplet.all_applets:
+            subparsers.add_lazy_parser(
+                applet_name,
+                get_help=functools.partial(_applet_help, applet_name),
+                build=functools.partial(_add_applet_arguments,
+                                        applet_name=applet_name, mode=mode),
                 formatter_class=TextHelpFormatter)
-            if mode == "test":
-                p_applet.add_argument(
-                    "tests", metavar="TEST", nargs="*",
-                    help="test cases to run")
-                continue
-
-            access_args = DirectArguments(applet_name=applet_name,
-                                          default_port="AB",
-                                          pin_count=16)
-            if mode == "run":
-                g_applet_build = p_applet.add_argument_group("build arguments")
-                applet.add_build_arguments(g_applet_build, access_args)
-                g_applet_run = p_applet.add_argument_group("run arguments")
-                applet.add_run_arguments(g_applet_run, access_args)
-                # FIXME: this makes it impossiblt to add subparsers in applets
-                # g_applet_interact = p_applet.add_argument_group("interact arguments")
-                # applet.add_interact_arguments(g_applet_interact)
-                applet.add_interact_arguments(p_applet)
-            else:
-                applet.add_build_arguments(p_applet, access_args)
 
     parser = argparse.ArgumentParser(formatter_class=TextHelpFormatter)
 
@@ -118,10 +205,24 @@ def get_argparser():
     parser.add_argument(
         "-q", "--quiet", default=0, action="count",
         help="decrease logging verbosity")
+    parser.add_argument(
+        "--usb-poller", metavar="POLLER", choices=("thread", "loop"), default="thread",
+        help="handle USB events on a separate thread or on the event loop "
+             "(one of: thread loop, default: %(default)s)")
+    parser.add_argument(
+        "--serial", metavar="SERIAL", type=str, default=None,
+        help="use the device with serial number SERIAL (required if several are connected)")
+    parser.add_argument(
+        "--no-cache", dest="cache", default=True, action="store_false",
+        help="always build bitstreams instead of using the bitstream cache")
 
     subparsers = parser.add_subparsers(dest="action", metavar="COMMAND")
     subparsers.required = True
 
+    p_list = subparsers.add_parser(
+        "list", formatter_class=TextHelpFormatter,
+        help="list serial numbers of connected devices")
+
     def add_ports_arg(parser):
         parser.add_argument(
             "ports", metavar="PORTS", type=str, nargs="?", default="AB",
@@ -152,21 +253,99 @@ def get_argparser():
     add_voltage_arg(p_voltage_limit,
         help="maximum allowed I/O port voltage")
 
+    def positive_int(arg):
+        try:
+            value = int(arg)
+        except ValueError:
+            value = 0
+        if value < 1:
+            raise argparse.ArgumentTypeError("{} is not a positive integer".format(arg))
+        return value
+
+    def add_pnr_seeds_arg(parser):
+        parser.add_argument(
+            "--pnr-seeds", metavar="COUNT", type=positive_int, default=None,
+            help="place and route with COUNT seeds in parallel and keep the bitstream with "
+                 "the best timing; the winning seed is reused by later builds of the same design")
+
+    def add_quad_buffering_arg(parser):
+        parser.add_argument(
+            "--no-quad-buffering", dest="quad_buffering", default=True, action="store_false",
+            help="use double-buffered USB endpoints even if the applet uses the only FIFO pair "
+                 "and could use quad-buffered ones")
+
+    def add_trace_format_arg(parser, *names):
+        parser.add_argument(
+            *names, dest="trace_format", metavar="FORMAT", choices=("vcd", "fst"),
+            default=None,
+            help="write traces as FORMAT (one of: vcd fst, default: from the file extension); "
+                 "FST files are much smaller, but writing them requires the external vcd2fst "
+                 "tool from GTKWave in PATH, which is checked before the trace is captured")
+
     p_run = subparsers.add_parser(
         "run", formatter_class=TextHelpFormatter,
         help="load an applet bitstream and run applet code")
     p_run.add_argument(
         "--force", default=False, action="store_true",
         help="reload bitstream even if an identical one is loaded")
+    g_run_trace = p_run.add_mutually_exclusive_group()
+    g_run_trace.add_argument(
+        "--trace", metavar="FILENAME", type=str, default=None,
+        help="trace applet I/O to FILENAME, in the format given by --trace-format")
+    g_run_trace.add_argument(
+        "--trace-raw", metavar="FILENAME", type=argparse.FileType("wb"), default=None,
+        help="record raw applet I/O trace to FILENAME, and its description to FILENAME.json, "
+             "for decoding later with `glasgow trace-decode`")
+    add_trace_format_arg(p_run, "--trace-format")
+    add_pnr_seeds_arg(p_run)
+    add_quad_buffering_arg(p_run)
     p_run.add_argument(
-        "--trace", metavar="FILENAME", type=argparse.FileType("wt"), default=None,
-        help="trace applet I/O to FILENAME")
+        "--with", dest="with_applet", metavar="'APPLET ...'", type=shlex.split, default=None,
+        help="also build and run another applet, specified as for `glasgow run APPLET ...`; "
+             "the applets must use different ports")
     g_run_bitstream = p_run.add_mutually_exclusive_group(required=True)
     g_run_bitstream.add_argument(
         "--bitstream", metavar="FILENAME", type=argparse.FileType("rb"),
         help="read bitstream from the specified file")
     add_applet_arg(g_run_bitstream, mode="run")
 
+    def add_endpoint_arg(parser):
+        parser.add_argument(
+            "--endpoint", metavar="ENDPOINT", type=_server_endpoint,
+            default=_default_server_endpoint(),
+            help="server endpoint, as unix:PATH (default: unix:%s)"
+                 % _default_server_endpoint()[1])
+
+    p_server = subparsers.add_parser(
+        "server", formatter_class=TextHelpFormatter,
+        help="load an applet bitstream, run applet code, and serve applet operations",
+        description="""
+        Load an applet bitstream and run applet code like `glasgow run`, then keep the device,
+        the bitstream and the I/O port voltages configured, and perform applet operations
+        submitted with `glasgow client` until interrupted.
+
+        Operations are performed one at a time, and cannot read from standard input. Only
+        the user running the server can connect to it.
+        """)
+    add_endpoint_arg(p_server)
+    p_server.add_argument(
+        "--force", default=False, action="store_true",
+        help="reload bitstream even if an identical one is loaded")
+    add_pnr_seeds_arg(p_server)
+    add_quad_buffering_arg(p_server)
+    add_applet_arg(p_server, mode="server", required=True)
+
+    p_client = subparsers.add_parser(
+        "client", formatter_class=TextHelpFormatter,
+        help="perform an applet operation using `glasgow server`")
+    add_endpoint_arg(p_client)
+    p_client.add_argument(
+        "applet", metavar="APPLET", type=str,
+        help="applet that the server is running")
+    p_client.add_argument(
+        "operation", metavar="ARGUMENTS", nargs=argparse.REMAINDER,
+        help="applet operation arguments, as for `glasgow run APPLET`")
+
     p_flash = subparsers.add_parser(
         "flash", formatter_class=TextHelpFormatter,
         help="program FX2 firmware or applet bitstream into EEPROM")
@@ -213,8 +392,65 @@ def get_argparser():
     p_build.add_argument(
         "-f", "--filename", metavar="FILENAME", type=str,
         help="file to save artifact to (default: <applet-name>.{v,bin})")
+    add_pnr_seeds_arg(p_build)
     add_applet_arg(p_build, mode="build", required=True)
 
+    p_cache = subparsers.add_parser(
+        "cache", formatter_class=TextHelpFormatter,
+        help="(advanced) manage the bitstream cache")
+
+    cache_subparsers = p_cache.add_subparsers(dest="cache_action", metavar="ACTION")
+    cache_subparsers.required = True
+
+    p_cache_list = cache_subparsers.add_parser(
+        "list", help="list cached bitstreams")
+
+    p_cache_prune = cache_subparsers.add_parser(
+        "prune", help="evict bitstreams built by another toolchain, or over the size limit")
+    p_cache_prune.add_argument(
+        "--all", default=False, action="store_true",
+        help="evict all bitstreams")
+
+    p_batch_build = subparsers.add_parser(
+        "batch-build", formatter_class=TextHelpFormatter,
+        help="(advanced) build applet logic for many applets and arguments in parallel",
+        description="""
+        Build the bitstreams listed in MANIFEST in parallel. Every line of the manifest
+        contains the arguments that would be passed to `glasgow build` to build one bitstream;
+        empty lines and lines starting with # are ignored. The bitstreams are stored
+        in the bitstream cache and, if requested, in a directory as <bitstream-id>.bin.
+        """)
+    p_batch_build.add_argument(
+        "-j", "--jobs", metavar="JOBS", type=int, default=os.cpu_count(),
+        help="run at most JOBS builds at once (default: %(default)s)")
+    p_batch_build.add_argument(
+        "-o", "--output-dir", metavar="DIRECTORY", type=str,
+        help="save bitstreams to DIRECTORY")
+    p_batch_build.add_argument(
+        "manifest", metavar="MANIFEST", type=argparse.FileType("r"),
+        help="read build arguments from MANIFEST")
+
+    p_trace_decode = subparsers.add_parser(
+        "trace-decode", formatter_class=TextHelpFormatter,
+        help="convert raw applet I/O traces to VCD or FST files",
+        description="""
+        Convert raw applet I/O traces recorded with `glasgow run --trace-raw` into VCD or FST
+        files. Several traces are converted in parallel.
+
+        An index of each trace is written to <trace-name>.index.json, which allows querying
+        a time range of the trace without decoding all of it (see `glasgow.trace.query_trace`).
+        """)
+    p_trace_decode.add_argument(
+        "-j", "--jobs", metavar="JOBS", type=int, default=os.cpu_count(),
+        help="convert at most JOBS traces at once (default: %(default)s)")
+    add_trace_format_arg(p_trace_decode, "-f", "--format")
+    p_trace_decode.add_argument(
+        "-o", "--output", metavar="FILENAME", type=str,
+        help="write trace to FILENAME (only for one trace; default: <trace-name>.<format>)")
+    p_trace_decode.add_argument(
+        "captures", metavar="TRACE", type=str, nargs="+",
+        help="read raw trace from TRACE")
+
     p_test = subparsers.add_parser(
         "test", formatter_class=TextHelpFormatter,
         help="(advanced) test applet logic without target hardware")
@@ -250,17 +486,25 @@ def get_argparser():
         default="B",
         help="revision letter (if not specified: %(default)s)")
     p_factory.add_argument(
-        "--serial", metavar="SERIAL", type=str,
+        "--serial", metavar="SERIAL", type=str, dest="factory_serial",
         default=datetime.now().strftime("%Y%m%dT%H%M%SZ"),
         help="serial number in ISO 8601 format (if not specified: %(default)s)")
 
     return parser
 
 
+def _with_analyzer(args):
+    return bool(getattr(args, "trace", None) or getattr(args, "trace_raw", None))
+
+
 # The name of this function appears in Verilog output, so keep it tidy.
-def _applet(args):
-    target = GlasgowHardwareTarget(multiplexer_cls=DirectMultiplexer,
-                                   with_analyzer=hasattr(args, "trace") and args.trace)
+def _applet(args, target=None):
+    from .target.hardware import GlasgowHardwareTarget
+    from .access.direct import DirectMultiplexer
+
+    if target is None:
+        target = GlasgowHardwareTarget(multiplexer_cls=DirectMultiplexer,
+                                       with_analyzer=_with_analyzer(args))
     applet = GlasgowApplet.all_applets[args.applet]()
     try:
         applet.build(target, args)
@@ -271,6 +515,359 @@ def _applet(args):
     return target, applet
 
 
+def _applet_elaboration_key(*applets_args):
+    from .access.direct import DirectArguments
+
+    parts = []
+    for args in applets_args:
+        applet_cls  = GlasgowApplet.all_applets[args.applet]
+        access_args = DirectArguments(applet_name=args.applet, default_port="AB", pin_count=16)
+        parser = argparse.ArgumentParser(add_help=False)
+        applet_cls.add_build_arguments(parser, access_args)
+        build_args = sorted((action.dest, getattr(args, action.dest, None))
+                            for action in parser._actions)
+        parts += [args.applet, build_args]
+    return elaboration_key(*parts, _with_analyzer(applets_args[0]))
+
+
+async def _download_applet_bitstream(device, applets_args, target, cache):
+    args = applets_args[0]
+
+    # Converting the design to Verilog just to compute its bitstream ID takes a while, so first
+    # check whether the device already has the bitstream that was built the last time for
+    # the same applets and build arguments.
+    device_bitstream_id = await device.bitstream_id()
+    build_key = None
+    if cache is not None:
+        try:
+            build_key = _applet_elaboration_key(*applets_args)
+        except TypeError as e:
+            logger.debug("not using the bitstream index: %s", e)
+    if build_key is not None:
+        bitstream_id = cache.get_bitstream_id(build_key)
+    else:
+        bitstream_id = None
+    if bitstream_id is None or device_bitstream_id != bitstream_id or args.force:
+        bitstream_id = target.get_bitstream_id()
+        if build_key is not None:
+            cache.put_bitstream_id(build_key, bitstream_id)
+    else:
+        target.finalize()
+
+    if device_bitstream_id == bitstream_id and not args.force:
+        logger.info("device already has bitstream ID %s", bitstream_id.hex())
+    else:
+        logger.info("building bitstream ID %s for applet(s) %s", bitstream_id.hex(),
+                    ", ".join(repr(applet_args.applet) for applet_args in applets_args))
+        await device.download_bitstream(
+            target.get_bitstream(debug=True, cache=cache, seeds=args.pnr_seeds),
+            bitstream_id)
+    return bitstream_id
+
+
+def _default_server_endpoint():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir is None:
+        # The temporary directory is shared with other users, so use a private directory in it.
+        runtime_dir = os.path.join(tempfile.gettempdir(),
+                                   "glasgow-{}".format(os.getuid() if hasattr(os, "getuid")
+                                                       else getpass.getuser()))
+    return ("unix", os.path.join(runtime_dir, "glasgow.sock"))
+
+
+def _server_endpoint(spec):
+    sock_addr = endpoint(spec)
+    if sock_addr[0] != "unix":
+        # A TCP endpoint would let anyone who can reach it perform operations (including
+        # writing files) as the user running the server.
+        raise argparse.ArgumentTypeError("only unix:PATH endpoints are supported")
+    return sock_addr
+
+
+def _check_private_directory(path):
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            stat.S_IMODE(st.st_mode) & 0o077):
+        raise PermissionError("{} is not a directory that only the current user can access"
+                              .format(path))
+
+
+def _check_socket_owner(path):
+    if os.lstat(path).st_uid != os.getuid():
+        raise ConnectionRefusedError("socket {} is owned by another user".format(path))
+
+
+def _peer_uid(sock):
+    # Only Linux reports the credentials of the peer; elsewhere, the permissions of the socket
+    # have to be relied upon.
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                        struct.calcsize("3i")))
+    return uid
+
+
+# The client sends a request as a line of JSON, and the server replies with a line containing
+# the exit code and the length of the output, followed by the output (everything the applet
+# printed or logged while performing the operation).
+#
+# Performing an operation changes the working directory and redirects the standard output of
+# the whole process, so only one operation is performed at a time.
+
+async def _serve_request(applet, parser, device, args, iface, request):
+    output  = io.TextIOWrapper(io.BytesIO(), encoding="utf-8", write_through=True)
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter(fmt="{levelname[0]:s}: {name:s}: {message:s}",
+                                           style="{"))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            applet_name, *argv = request["argv"]
+            if applet_name != applet.name:
+                logger.error("server is running applet %r, not %r", applet.name, applet_name)
+                return 1, output.buffer.getvalue()
+
+            try:
+                os.chdir(request["cwd"])
+            except OSError as e:
+                logger.error("cannot change directory: %s", e)
+                return 1, output.buffer.getvalue()
+
+            try:
+                request_args = parser.parse_args(argv, namespace=copy.copy(args))
+            except SystemExit as e:
+                return e.code, output.buffer.getvalue()
+
+            try:
+                await applet.interact(device, request_args, iface)
+            except GlasgowAppletError as e:
+                applet.logger.error(str(e))
+                return 1, output.buffer.getvalue()
+            return 0, output.buffer.getvalue()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Report the error to the client as well, rather than leaving it waiting for a reply.
+        logger.exception("operation failed")
+        return 1, output.buffer.getvalue()
+    finally:
+        os.chdir(cwd)
+        root_logger.removeHandler(handler)
+
+
+async def _serve_applet(sock_addr, applet, device, args, iface):
+    """
+    Start serving operations of ``applet`` at the Unix socket ``sock_addr``, and return
+    the :class:`asyncio.AbstractServer`.
+
+    The socket is only accessible by the current user, and connections from other users are
+    rejected.
+    """
+    parser = argparse.ArgumentParser(prog="glasgow client " + applet.name,
+                                     formatter_class=TextHelpFormatter)
+    applet.add_interact_arguments(parser)
+    lock = asyncio.Lock()
+
+    async def handle_connection(reader, writer):
+        try:
+            peer_uid = _peer_uid(writer.get_extra_info("socket"))
+            if peer_uid is not None and peer_uid != os.getuid():
+                logger.warning("rejecting connection from user %d", peer_uid)
+                return
+
+            request = json.loads((await reader.readline()).decode("utf-8"))
+            async with lock:
+                logger.info("performing operation %s",
+                            " ".join(map(shlex.quote, request["argv"])))
+                code, output = await _serve_request(applet, parser, device, args, iface,
+                                                    request)
+            writer.write(b"%d %d\n" % (code, len(output)) + output)
+            await writer.drain()
+        except (ValueError, KeyError, ConnectionError) as e:
+            logger.warning("invalid request: %s", e)
+        finally:
+            writer.close()
+
+    _, path = sock_addr
+    if os.path.exists(path):
+        _remove_stale_socket(path)
+    # Create the socket with no permissions for other users from the start, rather than
+    # changing them after it is already listening.
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handle_connection, path)
+    finally:
+        os.umask(umask)
+    logger.info("listening at unix:%s", path)
+    return server
+
+
+async def _client_request(sock_addr, cwd, argv):
+    _, path = sock_addr
+    _check_socket_owner(path)
+    reader, writer = await asyncio.open_unix_connection(path)
+    try:
+        writer.write(json.dumps({"cwd": cwd, "argv": argv}).encode("utf-8") + b"\n")
+        header = await reader.readline()
+        if not header:
+            raise ConnectionResetError("server closed the connection")
+        code, length = map(int, header.split())
+        output = await reader.readexactly(length)
+    finally:
+        writer.close()
+    return code, output
+
+
+def _remove_stale_socket(path):
+    # asyncio replaces any socket that exists at the path, so make sure that no server is
+    # listening at it first.
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            logger.debug("removing stale socket %s", path)
+            os.unlink(path)
+            return
+    raise FileExistsError("a server is already listening at unix:{}".format(path))
+
+
+def _trace_decode(args):
+    from .trace import decode_trace, trace_format
+
+    if args.output is not None and len(args.captures) > 1:
+        logger.error("--output can only be used with one trace")
+        return 1
+
+    if args.trace_format is not None:
+        format = args.trace_format
+    elif args.output is not None:
+        format = trace_format(args.output)
+    else:
+        format = "vcd"
+
+    failed = False
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for capture in args.captures:
+            output = args.output or os.path.splitext(capture)[0] + "." + format
+            futures[executor.submit(decode_trace, capture, output, format)] = (capture, output)
+        for future in concurrent.futures.as_completed(futures):
+            capture, output = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                logger.error("%s: %s", capture, e)
+                failed = True
+            else:
+                logger.info("decoded %d bytes from %s into %s", size, capture, output)
+    return 1 if failed else 0
+
+
+def _batch_build_job(argv, build):
+    # Runs in a worker process.
+    args = get_argparser().parse_args(["build", *argv])
+    started = time.perf_counter()
+    try:
+        target, applet = _applet(args)
+        if build:
+            result = target.get_bitstream(debug=True)
+        else:
+            result = target.get_bitstream_id()
+    except SystemExit:
+        raise GlasgowAppletError("failed to build subtarget for applet {!r}"
+                                 .format(args.applet)) from None
+    return result, time.perf_counter() - started
+
+
+def _batch_build(args, cache):
+    jobs = []
+    for line in args.manifest:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        argv = shlex.split(line)
+        # Report any invalid arguments right away, not from a worker process.
+        get_argparser().parse_args(["build", *argv])
+        jobs.append((line, argv))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    bitstream_ids = {}
+    elaborate_times = {}
+    build_times = {}
+    failed = False
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        logger.info("elaborating %d designs", len(jobs))
+        futures = {executor.submit(_batch_build_job, argv, build=False): line
+                   for line, argv in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            line = futures[future]
+            try:
+                bitstream_ids[line], elaborate_times[line] = future.result()
+            except Exception as e:
+                logger.error("%s: %s", line, e)
+                failed = True
+
+        # Only build each distinct design once, and only if it is not already cached.
+        builds = {}
+        for line, argv in jobs:
+            if line not in bitstream_ids or bitstream_ids[line] in builds:
+                continue
+            bitstream_id = bitstream_ids[line]
+            bitstream = cache.get(bitstream_id) if cache is not None else None
+            if bitstream is None:
+                builds[bitstream_id] = (line, executor.submit(_batch_build_job, argv, build=True))
+            else:
+                builds[bitstream_id] = (line, None)
+                if args.output_dir:
+                    with open(os.path.join(args.output_dir, bitstream_id.hex() + ".bin"),
+                              "wb") as f:
+                        f.write(bitstream)
+
+        logger.info("building %d distinct bitstreams",
+                    len([future for line, future in builds.values() if future]))
+        futures = {future: (bitstream_id, line)
+                   for bitstream_id, (line, future) in builds.items() if future}
+        for future in concurrent.futures.as_completed(futures):
+            bitstream_id, line = futures[future]
+            try:
+                bitstream, build_times[bitstream_id] = future.result()
+            except Exception as e:
+                logger.error("%s: %s", line, e)
+                failed = True
+                continue
+            if cache is not None:
+                cache.put(bitstream_id, bitstream)
+            if args.output_dir:
+                with open(os.path.join(args.output_dir, bitstream_id.hex() + ".bin"), "wb") as f:
+                    f.write(bitstream)
+            logger.info("built bitstream ID %s in %.1f s",
+                        bitstream_id.hex(), build_times[bitstream_id])
+
+    print("{:32}  {:>9}  {:>9}  {}".format("bitstream ID", "elaborate", "build", "arguments"))
+    first_line = {}
+    for line, argv in jobs:
+        if line not in bitstream_ids:
+            print("{:32}  {:>9}  {:>9}  {}".format("(failed)", "", "", line))
+            continue
+        bitstream_id = bitstream_ids[line]
+        if first_line.setdefault(bitstream_id, line) != line:
+            build_time = "duplicate"
+        elif bitstream_id in build_times:
+            build_time = "{:.1f} s".format(build_times[bitstream_id])
+        elif builds[bitstream_id][1] is None:
+            build_time = "cached"
+        else:
+            build_time = "failed"
+        print("{:32}  {:>9}  {:>9}  {}".format(
+            bitstream_id.hex(), "{:.1f} s".format(elaborate_times[line]), build_time, line))
+
+    return 1 if failed else 0
+
+
 class ANSIColorFormatter(logging.Formatter):
     LOG_COLORS = {
         "TRACE"   : "\033[37m",
@@ -301,12 +898,33 @@ async def _main():
 
     try:
         firmware_file = os.path.join(os.path.dirname(__file__), "glasgow.ihex")
-        if args.action in ("build", "test"):
+        if args.cache:
+            cache = BitstreamCache()
+        else:
+            cache = None
+
+        if args.action in ("build", "batch-build", "test", "cache", "trace-decode"):
             pass
+        elif args.action == "client":
+            try:
+                code, output = await _client_request(args.endpoint, os.getcwd(),
+                                                     [args.applet, *args.operation])
+            except OSError as e:
+                logger.error("cannot connect to server: %s", e)
+                return 1
+            sys.stdout.buffer.write(output)
+            sys.stdout.flush()
+            return code
+        elif args.action == "list":
+            for serial in GlasgowHardwareDevice.enumerate_serials(firmware_file):
+                print(serial)
+            return 0
         elif args.action == "factory":
-            device = GlasgowHardwareDevice(firmware_file, VID_CYPRESS, PID_FX2)
+            device = GlasgowHardwareDevice(firmware_file, VID_CYPRESS, PID_FX2,
+                                           poller=args.usb_poller, serial=args.serial)
         else:
-            device = GlasgowHardwareDevice(firmware_file)
+            device = GlasgowHardwareDevice(firmware_file,
+                                           poller=args.usb_poller, serial=args.serial)
 
         if args.action == "voltage":
             if args.voltage is not None:
@@ -348,108 +966,185 @@ async def _main():
 
         if args.action == "run":
             if args.applet:
-                target, applet = _applet(args)
-                device.demultiplexer = DirectDemultiplexer(device)
-
-                bitstream_id = target.get_bitstream_id()
-                if await device.bitstream_id() == bitstream_id and not args.force:
-                    logger.info("device already has bitstream ID %s", bitstream_id.hex())
-                else:
-                    logger.info("building bitstream ID %s for applet %r",
-                                bitstream_id.hex(), args.applet)
-                    await device.download_bitstream(target.get_bitstream(debug=True), bitstream_id)
-
-                if args.trace:
+                from .access.direct import DirectDemultiplexer
+                from .gateware.analyzer import TraceDecoder
+                from .trace import (TraceWriterError, TraceWriterThread, TraceRawWriter,
+                                    open_trace_writer, write_trace_header)
+
+                applets_args = [args]
+                if args.with_applet is not None:
+                    if _with_analyzer(args):
+                        logger.error("the applet analyzer cannot be used with several applets")
+                        return 1
+                    with_args = get_argparser().parse_args(["run", *args.with_applet])
+                    if with_args.applet is None or with_args.with_applet is not None:
+                        logger.error("--with must specify exactly one applet")
+                        return 1
+                    applets_args.append(with_args)
+
+                # All applets share one bitstream, where each one gets its own pair of FIFOs.
+                target = None
+                applets = []
+                for applet_args in applets_args:
+                    target, applet = _applet(applet_args, target)
+                    applets.append(applet)
+                device.demultiplexer = DirectDemultiplexer(device,
+                    quad_buffered=args.quad_buffering and target.multiplexer.single_interface)
+                bitstream_id = await _download_applet_bitstream(device, applets_args, target,
+                                                                cache)
+
+                if _with_analyzer(args):
                     logger.info("starting applet analyzer")
                     await device.write_register(target.analyzer.addr_done, 0)
                     analyzer_iface = await device.demultiplexer.claim_interface(
                         target.analyzer, target.analyzer.mux_interface, args=None)
-                    trace_decoder = TraceDecoder(target.analyzer.event_sources)
-                    vcd_writer = VCDWriter(args.trace, timescale="1 ns", check_values=False,
-                        comment='Generated by Glasgow for bitstream ID %s' % bitstream_id.hex())
+                    analyzer_done = asyncio.Event()
+                if args.trace_raw:
+                    write_trace_header(args.trace_raw.name, target.analyzer.event_sources,
+                                       target.sys_clk_freq, bitstream_id)
+                if args.trace:
+                    trace_decoder = TraceDecoder(target.analyzer.event_sources, columnar=True)
+                    try:
+                        trace_writer = TraceWriterThread(open_trace_writer(
+                            args.trace, trace_decoder, target.sys_clk_freq, args.trace_format,
+                            logger=target.analyzer.logger,
+                            comment="Generated by Glasgow for bitstream ID %s"
+                                    % bitstream_id.hex()))
+                    except (OSError, TraceWriterError) as e:
+                        logger.error("cannot write trace: %s", e)
+                        return 1
+
+                async def run_analyzer_raw():
+                    # Like the decoded trace, the raw trace is written by another thread, so that
+                    # the USB IN transfers are never held up by the disk.
+                    raw_writer = TraceWriterThread(TraceRawWriter(
+                        args.trace_raw, logger=target.analyzer.logger))
+                    try:
+                        # The end of the trace cannot be found without decoding it, so keep
+                        # reading until the analyzer goes quiet after the applets are done.
+                        analyzer_stream = analyzer_iface.stream()
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(analyzer_stream.__anext__(),
+                                                               timeout=0.1)
+                            except asyncio.TimeoutError:
+                                if analyzer_done.is_set():
+                                    break
+                                continue
+                            await raw_writer.put(chunk)
+
+                        target.analyzer.logger.debug("received %s", analyzer_stream)
+                    finally:
+                        await raw_writer.close()
 
                 async def run_analyzer():
+                    if args.trace_raw:
+                        return await run_analyzer_raw()
                     if not args.trace:
                         return
 
-                    signals = {}
-                    strobes = set()
-                    for field_name, field_trigger, field_width in trace_decoder.events():
-                        if field_trigger == "throttle":
-                            var_type = "wire"
-                            var_init = 0
-                        elif field_trigger == "change":
-                            var_type = "wire"
-                            var_init = "x"
-                        elif field_trigger == "strobe":
-                            if field_width > 0:
-                                var_type = "tri"
-                                var_init = "z"
-                            else:
-                                var_type = "event"
-                                var_init = ""
-                        else:
-                            assert False
-                        signals[field_name] = vcd_writer.register_var(
-                            scope="", name=field_name, var_type=var_type,
-                            size=field_width, init=var_init)
-                        if field_trigger == "strobe":
-                            strobes.add(field_name)
-
-                    init = True
-                    while not trace_decoder.is_done():
-                        trace_decoder.process(await analyzer_iface.read())
-                        for cycle, events in trace_decoder.flush():
-                            if events == "overrun":
-                                target.analyzer.logger.error("FIFO overrun, shutting down")
-
-                                for name in signals:
-                                    vcd_writer.change(signals[name], next_timestamp, "x")
-                                timestamp += 1e3 # 1us
+                    # Only decoding happens here; the trace file is written by another thread.
+                    try:
+                        analyzer_stream = analyzer_iface.stream()
+                        async for chunk in analyzer_stream:
+                            trace_decoder.process(chunk)
+                            await trace_writer.put(trace_decoder.flush())
+                            if trace_decoder.is_done():
                                 break
 
-                            event_repr = " ".join("{}={}".format(n, v)
-                                                  for n, v in events.items())
-                            target.analyzer.logger.trace("cycle %d: %s", cycle, event_repr)
-
-                            timestamp      = 1e9 * (cycle + 0) // target.sys_clk_freq
-                            next_timestamp = 1e9 * (cycle + 1) // target.sys_clk_freq
-                            if init:
-                                init = False
-                                vcd_writer._timestamp = timestamp
-                            for name, value in events.items():
-                                vcd_writer.change(signals[name], timestamp, value)
-                            for name, _value in events.items():
-                                if name in strobes:
-                                    vcd_writer.change(signals[name], next_timestamp, "z")
-                            vcd_writer.flush()
-
-                    vcd_writer.close(timestamp)
-
-                async def run_applet():
-                    logger.info("running handler for applet %r", args.applet)
+                        target.analyzer.logger.debug("received %s", analyzer_stream)
+                    finally:
+                        await trace_writer.close()
+
+                async def run_applet(applet, applet_args):
+                    logger.info("running handler for applet %r", applet_args.applet)
                     try:
-                        iface = await applet.run(device, args)
-                        await applet.interact(device, args, iface)
+                        iface = await applet.run(device, applet_args)
+                        await applet.interact(device, applet_args, iface)
                     except GlasgowAppletError as e:
                         applet.logger.error(str(e))
                     finally:
-                        if args.trace:
+                        if _with_analyzer(args):
                             await device.write_register(target.analyzer.addr_done, 1)
-
-                done, pending = await asyncio.wait([run_analyzer(), run_applet()],
-                                                   return_when=asyncio.FIRST_EXCEPTION)
-                for task in done:
-                    await task
+                            analyzer_done.set()
+
+                tasks = [asyncio.ensure_future(coro) for coro in
+                         [run_analyzer(), *map(run_applet, applets, applets_args)]]
+                loop = asyncio.get_event_loop()
+                if _with_analyzer(args):
+                    # Interrupting the event loop would leave the trace file partially written,
+                    # so on Ctrl+C, cancel the tasks instead and let them finish writing it.
+                    try:
+                        loop.add_signal_handler(signal.SIGINT,
+                                                lambda: [task.cancel() for task in tasks])
+                    except NotImplementedError:
+                        pass
+                try:
+                    done, pending = await asyncio.wait(tasks,
+                                                       return_when=asyncio.FIRST_EXCEPTION)
+                    for task in pending:
+                        task.cancel()
+                    if pending:
+                        await asyncio.wait(pending)
+                finally:
+                    if _with_analyzer(args):
+                        try:
+                            loop.remove_signal_handler(signal.SIGINT)
+                        except NotImplementedError:
+                            pass
+                for task in tasks:
+                    if not task.cancelled():
+                        await task
 
                 # Work around bugs in python-libusb1 that cause segfaults on interpreter shutdown.
                 await device.demultiplexer.flush()
+                await device.demultiplexer.cancel()
 
             else:
                 with args.bitstream as f:
                     logger.info("downloading bitstream from %r", f.name)
                     await device.download_bitstream(f.read())
 
+        if args.action == "server":
+            from .access.direct import DirectDemultiplexer
+
+            target, applet = _applet(args)
+            device.demultiplexer = DirectDemultiplexer(device,
+                quad_buffered=args.quad_buffering and target.multiplexer.single_interface)
+            await _download_applet_bitstream(device, [args], target, cache)
+
+            logger.info("running handler for applet %r", args.applet)
+            try:
+                iface = await applet.run(device, args)
+            except GlasgowAppletError as e:
+                applet.logger.error(str(e))
+                return 1
+
+            try:
+                if args.endpoint == _default_server_endpoint():
+                    socket_dir = os.path.dirname(args.endpoint[1])
+                    os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+                    _check_private_directory(socket_dir)
+                server = await _serve_applet(args.endpoint, applet, device, args, iface)
+            except OSError as e:
+                logger.error("cannot listen at unix:%s: %s", args.endpoint[1], e)
+                return 1
+
+            loop = asyncio.get_event_loop()
+            stop = asyncio.Future()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+            try:
+                await stop
+            finally:
+                logger.info("shutting down")
+                server.close()
+                await server.wait_closed()
+                os.unlink(args.endpoint[1])
+
+                await device.demultiplexer.flush()
+                await device.demultiplexer.cancel()
+
         if args.action == "flash":
             logger.info("reading device configuration")
             header = await device.read_eeprom("fx2", 0, 8 + 4 + GlasgowConfig.size)
@@ -489,7 +1184,7 @@ async def _main():
                 logger.info("building bitstream for applet %s", args.applet)
                 target, applet = _applet(args)
                 new_bitstream_id = target.get_bitstream_id()
-                new_bitstream = target.get_bitstream(debug=True)
+                new_bitstream = target.get_bitstream(debug=True, cache=cache)
 
                 # We always build and reflash the bitstream in case the one currently
                 # in EEPROM is corrupted. If we only compared the ID, there would be
@@ -520,11 +1215,7 @@ async def _main():
                 logger.info("programming bitstream")
                 old_bitstream = await device.read_eeprom("ice", 0, len(new_bitstream))
                 if old_bitstream != new_bitstream:
-                    for (addr, chunk) in diff_data(old_bitstream, new_bitstream):
-                        await device.write_eeprom("ice", addr, chunk)
-
-                    logger.info("verifying bitstream")
-                    if await device.read_eeprom("ice", 0, len(new_bitstream)) != new_bitstream:
+                    if not await device.update_eeprom("ice", old_bitstream, new_bitstream):
                         logger.critical("bitstream programming failed")
                         return 1
                 else:
@@ -533,11 +1224,7 @@ async def _main():
             logger.info("programming configuration and firmware")
             old_image = await device.read_eeprom("fx2", 0, len(new_image))
             if old_image != new_image:
-                for (addr, chunk) in diff_data(old_image, new_image):
-                    await device.write_eeprom("fx2", addr, chunk)
-
-                logger.info("verifying configuration and firmware")
-                if await device.read_eeprom("fx2", 0, len(new_image)) != new_image:
+                if not await device.update_eeprom("fx2", old_image, new_image):
                     logger.critical("configuration/firmware programming failed")
                     return 1
             else:
@@ -550,7 +1237,8 @@ async def _main():
                 target.get_verilog().write(args.filename or args.applet + ".v")
             if args.type in ("bin", "bitstream"):
                 with open(args.filename or args.applet + ".bin", "wb") as f:
-                    f.write(target.get_bitstream(debug=True))
+                    f.write(target.get_bitstream(debug=True, cache=cache,
+                                                 seeds=args.pnr_seeds))
             if args.type in ("zip", "archive"):
                 with target.get_build_tree() as tree:
                     if args.filename:
@@ -559,9 +1247,34 @@ async def _main():
                         basename = args.applet
                     shutil.make_archive(basename, format="zip", root_dir=tree, logger=logger)
 
+        if args.action == "batch-build":
+            if cache is None and not args.output_dir:
+                logger.error("either the bitstream cache or an output directory must be used")
+                return 1
+            return _batch_build(args, cache)
+
+        if args.action == "cache":
+            if cache is None:
+                cache = BitstreamCache()
+            if args.cache_action == "list":
+                for bitstream_id, salt, size, atime in cache.entries():
+                    print("{} {:8d} {}{}".format(
+                        bitstream_id.hex(), size,
+                        datetime.fromtimestamp(atime).strftime("%Y-%m-%d %H:%M:%S"),
+                        "" if salt == cache.salt else " (other toolchain)"))
+            if args.cache_action == "prune":
+                evicted = cache.prune(max_size=0 if args.all else None, stale=True)
+                logger.info("evicted %d bitstreams from %s", evicted, cache.path)
+
+        if args.action == "trace-decode":
+            return _trace_decode(args)
+
         if args.action == "test":
             logger.info("testing applet %r", args.applet)
             applet = GlasgowApplet.all_applets[args.applet]()
+            if not hasattr(applet, "test_cls"):
+                logger.error("applet %r has no tests", args.applet)
+                return 1
             loader = unittest.TestLoader()
             stream = unittest.runner._WritelnDecorator(sys.stderr)
             result = unittest.TextTestResult(stream=stream, descriptions=True, verbosity=2)
@@ -583,6 +1296,9 @@ async def _main():
                 return 1
 
         if args.action == "internal-test":
+            from .internal_test import (TestToggleIO, TestMirrorI2C, TestShiftOut, TestGenSeq,
+                                        TestPLL, TestRegisters)
+
             if args.mode == "toggle-io":
                 await device.download_bitstream(TestToggleIO().get_bitstream(debug=True))
                 await device.set_voltage("AB", 3.3)
@@ -615,7 +1331,7 @@ async def _main():
             fx2_config = FX2Config(vendor_id=VID_QIHW, product_id=PID_GLASGOW,
                                    device_id=1 + ord(args.revision) - ord('A'),
                                    i2c_400khz=True)
-            glasgow_config = GlasgowConfig(args.revision, args.serial)
+            glasgow_config = GlasgowConfig(args.revision, args.factory_serial)
             fx2_config.append(0x4000 - GlasgowConfig.size, glasgow_config.encode())
 
             image = fx2_config.encode()
@@ -643,6 +1359,257 @@ def main():
     loop = asyncio.get_event_loop()
     exit(loop.run_until_complete(_main()))
 
+# -------------------------------------------------------------------------------------------------
+
+import subprocess
+import unittest.mock
+
+
+class CLIStartupTestCase(unittest.TestCase):
+    # Commands that do not use any applet should not import applets, migen or the toolchain
+    # integration, since importing those takes several times longer than everything else.
+    _startup_script = """if True:
+        import io, sys, contextlib
+        from glasgow.cli import get_argparser
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                get_argparser().parse_args(sys.argv[1:])
+            except SystemExit:
+                pass
+        print(" ".join(sorted(sys.modules)))
+    """
+
+    def imported_modules(self, *argv):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        result = subprocess.run([sys.executable, "-c", self._startup_script, *argv],
+                                cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                check=True)
+        return result.stdout.decode().split()
+
+    def assertImportsNoApplets(self, *argv):
+        modules = self.imported_modules(*argv)
+        self.assertEqual([module for module in modules
+                          if module == "migen" or module.startswith("migen.")], [])
+        self.assertEqual([module for module in modules
+                          if module.startswith(("glasgow.applet.", "glasgow.target.hardware",
+                                                "glasgow.target.pnr", "glasgow.platform",
+                                                "glasgow.gateware"))], [])
+
+    def test_help(self):
+        self.assertImportsNoApplets("--help")
+
+    def test_list(self):
+        self.assertImportsNoApplets("list")
+
+    def test_voltage(self):
+        self.assertImportsNoApplets("voltage", "AB", "3.3")
+
+    def test_applet_imported_when_selected(self):
+        modules = self.imported_modules("build", "uart")
+        self.assertIn("glasgow.applet.uart", modules)
+        self.assertNotIn("glasgow.applet.spi.master", modules)
+
+
+class PnRSeedsArgumentTestCase(unittest.TestCase):
+    def test_positive(self):
+        self.assertEqual(get_argparser().parse_args(["build", "--pnr-seeds", "4", "uart"])
+                         .pnr_seeds, 4)
+
+    def test_invalid(self):
+        for count in ("0", "-1", "x"):
+            with self.subTest(count=count), \
+                    contextlib.redirect_stderr(io.StringIO()) as stderr, \
+                    self.assertRaises(SystemExit):
+                get_argparser().parse_args(["build", "--pnr-seeds", count, "uart"])
+            self.assertIn("{} is not a positive integer".format(count), stderr.getvalue())
+
+
+class MultipleAppletsTestCase(unittest.TestCase):
+    def test_build(self):
+        args = get_argparser().parse_args(
+            ["run", "--with", "spi-master --port B --pin-sck 0 -V 3.3 00", "uart", "--port", "A",
+             "-V", "3.3", "tty"])
+        with_args = get_argparser().parse_args(["run", *args.with_applet])
+        target, uart = _applet(args)
+        target, spi_master = _applet(with_args, target)
+        self.assertEqual((uart.name, spi_master.name), ("uart", "spi-master"))
+        self.assertEqual(target.multiplexer._claimed_ports, {"A", "B"})
+        self.assertNotEqual(_applet_elaboration_key(args),
+                            _applet_elaboration_key(args, with_args))
+
+
+class _EchoApplet:
+    name   = "echo"
+    logger = logging.getLogger(__name__ + ".echo")
+
+    def __init__(self):
+        self.active     = 0
+        self.max_active = 0
+
+    @classmethod
+    def add_interact_arguments(cls, parser):
+        parser.add_argument("words", metavar="WORD", nargs="+")
+
+    async def interact(self, device, args, interface):
+        if args.words == ["fail"]:
+            raise GlasgowAppletError("failed as requested")
+        if args.words == ["crash"]:
+            raise OSError("crashed as requested")
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            print(args.prefix, args.words[0], end="")
+            await asyncio.sleep(0.01)
+            print("", *args.words[1:], interface, os.path.basename(os.getcwd()))
+        finally:
+            self.active -= 1
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sock_addr = ("unix", os.path.join(self.tempdir.name, "glasgow.sock"))
+        self.applet = _EchoApplet()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    async def serve(self):
+        return await _serve_applet(self.sock_addr, self.applet, None,
+                                   argparse.Namespace(prefix=">"), "iface")
+
+    async def do_test_requests(self):
+        server = await self.serve()
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.sock_addr[1]).st_mode), 0o600)
+
+            cwd = self.tempdir.name
+            name = os.path.basename(cwd).encode()
+            self.assertEqual(await _client_request(self.sock_addr, cwd, ["echo", "a", "b"]),
+                             (0, b"> a b iface " + name + b"\n"))
+            self.assertEqual(await _client_request(self.sock_addr, cwd, ["echo", "c"]),
+                             (0, b"> c iface " + name + b"\n"))
+
+            code, output = await _client_request(self.sock_addr, cwd, ["echo", "fail"])
+            self.assertEqual(code, 1)
+            self.assertIn(b"failed as requested", output)
+
+            code, output = await _client_request(self.sock_addr, cwd, ["echo"])
+            self.assertEqual(code, 2)
+            self.assertIn(b"usage: glasgow client echo", output)
+
+            code, output = await _client_request(self.sock_addr, cwd, ["uart", "tty"])
+            self.assertEqual(code, 1)
+            self.assertIn(b"not 'uart'", output)
+
+            code, output = await _client_request(self.sock_addr,
+                                                 os.path.join(cwd, "nonexistent"), ["echo", "a"])
+            self.assertEqual(code, 1)
+            self.assertIn(b"cannot change directory", output)
+
+            code, output = await _client_request(self.sock_addr, cwd, ["echo", "crash"])
+            self.assertEqual(code, 1)
+            self.assertIn(b"OSError: crashed as requested", output)
+
+            self.assertEqual(await _client_request(self.sock_addr, cwd, ["echo", "d"]),
+                             (0, b"> d iface " + name + b"\n"))
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_requests(self):
+        self.loop.run_until_complete(self.do_test_requests())
+
+    async def do_test_concurrent_requests(self):
+        server = await self.serve()
+        try:
+            cwd = os.getcwd()
+            results = await asyncio.gather(*[
+                _client_request(self.sock_addr, self.tempdir.name, ["echo", str(n)])
+                for n in range(3)
+            ])
+            name = os.path.basename(self.tempdir.name).encode()
+            self.assertEqual(sorted(results), [
+                (0, b"> %d iface %s\n" % (n, name)) for n in range(3)
+            ])
+            self.assertEqual(self.applet.max_active, 1)
+            self.assertEqual(os.getcwd(), cwd)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_concurrent_requests(self):
+        self.loop.run_until_complete(self.do_test_concurrent_requests())
+
+    async def do_test_other_user(self):
+        server = await self.serve()
+        try:
+            with unittest.mock.patch(__name__ + "._peer_uid", return_value=os.getuid() + 1), \
+                    self.assertLogs(__name__, "WARNING") as logs:
+                with self.assertRaises(ConnectionError):
+                    await _client_request(self.sock_addr, os.getcwd(), ["echo", "a"])
+            self.assertIn("rejecting connection from user", logs.output[0])
+            self.assertEqual(self.applet.max_active, 0)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "POSIX only")
+    def test_other_user(self):
+        self.loop.run_until_complete(self.do_test_other_user())
+
+    @unittest.skipUnless(hasattr(socket, "SO_PEERCRED"), "Linux only")
+    def test_peer_uid(self):
+        sock_a, sock_b = socket.socketpair(socket.AF_UNIX)
+        with sock_a, sock_b:
+            self.assertEqual(_peer_uid(sock_a), os.getuid())
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "POSIX only")
+    def test_private_directory(self):
+        _check_private_directory(self.tempdir.name)
+        os.chmod(self.tempdir.name, 0o755)
+        with self.assertRaisesRegex(PermissionError, r"is not a directory that only"):
+            _check_private_directory(self.tempdir.name)
+
+    async def do_test_server_running(self):
+        server = await self.serve()
+        try:
+            with self.assertRaisesRegex(FileExistsError,
+                    r"^a server is already listening at unix:"):
+                await self.serve()
+            self.assertEqual((await _client_request(self.sock_addr, self.tempdir.name,
+                                                    ["echo", "a"]))[0], 0)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_server_running(self):
+        self.loop.run_until_complete(self.do_test_server_running())
+
+    async def do_test_stale_socket(self):
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.bind(self.sock_addr[1])
+        server = await self.serve()
+        try:
+            self.assertEqual((await _client_request(self.sock_addr, self.tempdir.name,
+                                                    ["echo", "a"]))[0], 0)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def test_stale_socket(self):
+        self.loop.run_until_complete(self.do_test_stale_socket())
+
+    def test_tcp_endpoint(self):
+        with contextlib.redirect_stderr(io.StringIO()) as stderr, \
+                self.assertRaises(SystemExit):
+            get_argparser().parse_args(["client", "--endpoint", "tcp::1234", "uart", "tty"])
+        self.assertIn("only unix:PATH endpoints are supported", stderr.getvalue())
+        self.assertEqual(get_argparser().parse_args(["client", "--endpoint", "unix:/x/y",
+                                                     "uart", "tty"]).endpoint,
+                         ("unix", "/x/y"))
+
 
 if __name__ == "__main__":
     main()
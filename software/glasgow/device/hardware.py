@@ -3,12 +3,16 @@ import time
 import struct
 import logging
 import usb1
+import select
 import asyncio
 import threading
+from collections import defaultdict
 from fx2 import REQ_RAM, REG_CPUCS
-from fx2.format import input_data
+from fx2.format import input_data, diff_data
 
 from . import GlasgowDeviceError
+from ..support.logging import *
+from ..support.task_queue import *
 
 
 __all__ = ["GlasgowHardwareDevice"]
@@ -50,82 +54,330 @@ class _PollerThread(threading.Thread):
             self.context.handleEvents()
 
 
+class _LoopPoller:
+    """
+    Handles libusb events on the asyncio event loop by watching libusb file descriptors
+    and scheduling libusb timeouts, so that transfer completions are processed on the loop
+    thread without a thread switch.
+    """
+    def __init__(self, context, loop):
+        self.context = context
+        self.loop    = loop
+        self._fds    = {}
+        self._timer  = None
+
+        context.setPollFDNotifiers(self._add_fd, self._remove_fd)
+        try:
+            for fd, events in context.getPollFDList():
+                self._add_fd(fd, events)
+        except NotImplementedError:
+            raise GlasgowDeviceError("libusb does not support polling on this platform")
+        self.schedule_timeout()
+
+    def _add_fd(self, fd, events, user_data=None):
+        self._remove_fd(fd)
+        try:
+            if events & select.POLLIN:
+                self.loop.add_reader(fd, self._handle_events)
+            if events & select.POLLOUT:
+                self.loop.add_writer(fd, self._handle_events)
+        except NotImplementedError:
+            raise GlasgowDeviceError("event loop does not support polling file descriptors")
+        self._fds[fd] = events
+
+    def _remove_fd(self, fd, user_data=None):
+        events = self._fds.pop(fd, 0)
+        if events & select.POLLIN:
+            self.loop.remove_reader(fd)
+        if events & select.POLLOUT:
+            self.loop.remove_writer(fd)
+
+    def _handle_events(self):
+        self.context.handleEventsTimeout(0)
+        self.schedule_timeout()
+
+    def schedule_timeout(self):
+        """Arm a timer for the nearest libusb timeout, if any."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        timeout = self.context.getNextTimeout()
+        if timeout is not None:
+            self._timer = self.loop.call_later(timeout, self._handle_events)
+
+
+class _PooledTransfer:
+    """
+    A libusb transfer that is reused across submissions, along with the state associated
+    with the current submission.
+    """
+    __slots__ = ("key", "transfer", "buffer", "is_read", "future")
+
+    def __init__(self, key, transfer):
+        self.key      = key
+        self.transfer = transfer
+        self.buffer   = None
+        self.is_read  = False
+        self.future   = None
+
+
 class GlasgowHardwareDevice:
-    def _open_device(self, vendor_id, product_id):
+    # Maximum amount of idle transfers kept for reuse per endpoint.
+    transfer_pool_size = 64
+
+    @staticmethod
+    def _open_usb_device(usb_device):
         try:
-            self.usb = self.usb_context.openByVendorIDAndProductID(vendor_id, product_id)
+            return usb_device.open()
         except usb1.USBErrorAccess:
             raise GlasgowDeviceError("cannot access device {:04x}:{:04x}"
-                                     .format(vendor_id, product_id))
-        if self.usb is None:
-            raise GlasgowDeviceError("device {:04x}:{:04x} not found"
-                                     .format(vendor_id, product_id))
-
-        try:
-            self.usb.setAutoDetachKernelDriver(True)
-        except usb1.USBErrorNotSupported:
-            pass
+                                     .format(usb_device.getVendorID(), usb_device.getProductID()))
+        except usb1.USBError as e:
+            raise GlasgowDeviceError("cannot open device {:04x}:{:04x}: {}"
+                                     .format(usb_device.getVendorID(), usb_device.getProductID(),
+                                             e))
 
-    def _write_ram(self, addr, data):
-        self.usb.controlWrite(usb1.REQUEST_TYPE_VENDOR, REQ_RAM, addr, 0, data)
+    @staticmethod
+    def _write_ram(usb, addr, data):
+        usb.controlWrite(usb1.REQUEST_TYPE_VENDOR, REQ_RAM, addr, 0, data)
 
-    def _cpu_reset(self, is_reset):
-        self._write_ram(REG_CPUCS, [1 if is_reset else 0])
+    @classmethod
+    def _cpu_reset(cls, usb, is_reset):
+        cls._write_ram(usb, REG_CPUCS, [1 if is_reset else 0])
 
-    def _download_firmware(self, chunks):
-        self._cpu_reset(True)
+    @classmethod
+    def _download_firmware(cls, usb, chunks):
+        cls._cpu_reset(usb, True)
         for address, data in chunks:
-            self._write_ram(address, data)
-        self._cpu_reset(False)
+            cls._write_ram(usb, address, data)
+        cls._cpu_reset(usb, False)
 
-    def __init__(self, firmware_file=None, vendor_id=VID_QIHW, product_id=PID_GLASGOW):
-        self.usb_context = usb1.USBContext()
-        self.usb_poller = _PollerThread(self.usb_context)
-        self.usb_poller.start()
+    @staticmethod
+    def _device_location(usb_device):
+        return (usb_device.getBusNumber(), tuple(usb_device.getPortNumberList()))
 
-        self._open_device(vendor_id, product_id)
+    @staticmethod
+    def _has_firmware(usb_device):
+        return usb_device.getbcdDevice() & 0xFF00 not in (0x0000, 0xA000)
 
-        device_id = self.usb.getDevice().getbcdDevice()
-        if device_id & 0xFF00 in (0x0000, 0xA000):
-            revision = chr(ord("A") + (device_id & 0xFF) - 1)
-            logger.debug("found rev%s device without firmware", revision)
+    @classmethod
+    def _wait_for_reenumeration(cls, usb_context, locations, timeout, interval=0.01):
+        started = time.perf_counter()
+        while True:
+            for usb_device in usb_context.getDeviceList(skip_on_error=True):
+                if ((usb_device.getVendorID(), usb_device.getProductID()) ==
+                        (VID_QIHW, PID_GLASGOW) and cls._has_firmware(usb_device)):
+                    locations = locations - {cls._device_location(usb_device)}
+            elapsed = time.perf_counter() - started
+            if not locations:
+                logger.debug("devices re-enumerated in %.3f s", elapsed)
+                return
+            if elapsed > timeout:
+                raise GlasgowDeviceError("firmware upload failed")
+            time.sleep(interval)
+
+    @classmethod
+    def _read_serial(cls, usb_device):
+        """
+        Open ``usb_device`` and read its serial number. Returns a ``(serial, handle)`` tuple,
+        or ``None`` if the device cannot be opened (e.g. it is in use or not accessible).
+        """
+        try:
+            usb = cls._open_usb_device(usb_device)
+        except GlasgowDeviceError as e:
+            logger.warning("skipping device at bus %d port %s: %s",
+                           *cls._device_location(usb_device), e)
+            return None
+        try:
+            # https://github.com/vpelletier/python-libusb1/issues/39
+            # serial = usb_device.getSerialNumber()
+            serial = usb.getASCIIStringDescriptor(usb_device.device_descriptor.iSerialNumber)
+        except usb1.USBError as e:
+            logger.warning("skipping device at bus %d port %s: cannot read serial number: %s",
+                           *cls._device_location(usb_device), e)
+            usb.close()
+            return None
+        logger.debug("found device with serial %s", serial)
+        return serial, usb
+
+    @classmethod
+    def _enumerate_devices(cls, usb_context, firmware_file, vendor_id, product_id,
+                           serial=None, reenumeration_timeout=10):
+        """
+        Find all devices with ``vendor_id`` and ``product_id``, uploading firmware to those
+        that do not have it, and return a ``dict`` mapping serial numbers to open handles.
+
+        If ``serial`` is not ``None`` and a device that already has firmware has that serial
+        number, only its handle is returned, and no firmware is uploaded. (The serial number
+        of a device without firmware cannot be read, so otherwise firmware is uploaded to
+        every device that lacks it.) Devices that cannot be opened are skipped.
+        """
+        def collect(locations=None):
+            for usb_device in usb_context.getDeviceList(skip_on_error=True):
+                if ((usb_device.getVendorID(), usb_device.getProductID()) !=
+                        (VID_QIHW, PID_GLASGOW) or not cls._has_firmware(usb_device)):
+                    continue
+                if locations is not None and cls._device_location(usb_device) not in locations:
+                    continue
+                result = cls._read_serial(usb_device)
+                if result is not None:
+                    device_serial, usb = result
+                    handles[device_serial] = usb
+
+        def select():
+            for device_serial in list(handles):
+                if device_serial != serial:
+                    handles.pop(device_serial).close()
+            return handles
+
+        handles = {}
+        if (vendor_id, product_id) == (VID_QIHW, PID_GLASGOW):
+            collect()
+            if serial is not None and serial in handles:
+                return select()
+
+        uploaded = set()
+        for usb_device in usb_context.getDeviceList(skip_on_error=True):
+            if (usb_device.getVendorID(), usb_device.getProductID()) != (vendor_id, product_id):
+                continue
+
+            device_id = usb_device.getbcdDevice()
+            if not cls._has_firmware(usb_device):
+                revision = chr(ord("A") + (device_id & 0xFF) - 1)
+                logger.debug("found rev%s device without firmware", revision)
+
+                if firmware_file is None:
+                    raise GlasgowDeviceError("firmware is not uploaded")
 
-            if firmware_file is None:
-                raise GlasgowDeviceError("firmware is not uploaded")
-            else:
                 logger.debug("loading firmware from %s", firmware_file)
-                with open(firmware_file, "rb") as f:
-                    self._download_firmware(input_data(f, fmt="ihex"))
+                location = cls._device_location(usb_device)
+                try:
+                    usb = cls._open_usb_device(usb_device)
+                    try:
+                        with open(firmware_file, "rb") as f:
+                            cls._download_firmware(usb, input_data(f, fmt="ihex"))
+                    finally:
+                        usb.close()
+                except (GlasgowDeviceError, usb1.USBError) as e:
+                    logger.warning("skipping device at bus %d port %s: %s", *location, e)
+                    continue
+                uploaded.add(location)
+
+        if uploaded:
+            # wait until the devices re-enumerate with the Glasgow firmware
+            cls._wait_for_reenumeration(usb_context, uploaded, reenumeration_timeout)
+            # only consider devices that were found with a non-Glasgow VID/PID if they were
+            # just given firmware
+            collect(uploaded)
+
+        if serial is not None and serial in handles:
+            return select()
+        return handles
 
-                # let the device re-enumerate and re-acquire it
-                time.sleep(1)
-                self._open_device(VID_QIHW, PID_GLASGOW)
+    @staticmethod
+    def _select_device(handles, serial, vendor_id, product_id):
+        if serial is not None:
+            if serial not in handles:
+                raise GlasgowDeviceError("device with serial number {} not found"
+                                         .format(serial))
+            return serial
+        elif len(handles) == 0:
+            raise GlasgowDeviceError("device {:04x}:{:04x} not found"
+                                     .format(vendor_id, product_id))
+        elif len(handles) > 1:
+            raise GlasgowDeviceError("found {} devices (serial numbers {}), "
+                                     "one must be selected by serial number"
+                                     .format(len(handles), ", ".join(sorted(handles))))
+        else:
+            serial, = handles
+            return serial
 
-                # still not the right firmware?
-                if self.usb.getDevice().getbcdDevice() & 0xFF00 in (0x0000, 0xA000):
-                    raise GlasgowDeviceError("firmware upload failed")
+    @classmethod
+    def enumerate_serials(cls, firmware_file=None, vendor_id=VID_QIHW, product_id=PID_GLASGOW):
+        """
+        Return the sorted serial numbers of all connected devices, uploading firmware from
+        ``firmware_file`` to the devices that do not have it.
 
-        # https://github.com/vpelletier/python-libusb1/issues/39
-        # serial = self.usb.getDevice().getSerialNumber()
-        serial = self.usb.getASCIIStringDescriptor(
-            self.usb.getDevice().device_descriptor.iSerialNumber)
-        logger.debug("found device with serial %s", serial)
+        Several devices may be driven from one event loop by creating
+        a :class:`GlasgowHardwareDevice` for each of the returned serial numbers.
+        """
+        with usb1.USBContext() as usb_context:
+            handles = cls._enumerate_devices(usb_context, firmware_file, vendor_id, product_id)
+            for usb in handles.values():
+                usb.close()
+            return sorted(handles)
+
+    def _open_device(self, firmware_file, vendor_id, product_id, serial):
+        # Transfers are tied to a device handle, so they cannot be reused once it is reopened.
+        self._transfer_pool = defaultdict(list)
+
+        handles = self._enumerate_devices(self.usb_context, firmware_file,
+                                          vendor_id, product_id, serial)
+        try:
+            self.serial = self._select_device(handles, serial, vendor_id, product_id)
+            self.usb = handles.pop(self.serial)
+        finally:
+            for usb in handles.values():
+                usb.close()
 
-    async def _do_transfer(self, is_read, setup):
-        transfer = self.usb.getTransfer()
-        future = asyncio.Future()
-        setup(transfer)
+        try:
+            self.usb.setAutoDetachKernelDriver(True)
+        except usb1.USBErrorNotSupported:
+            pass
 
-        def usb_callback(transfer):
-            if transfer.isSubmitted():
-                return # transfer not completed
-            if future.cancelled():
-                return # future cancelled
+    def __init__(self, firmware_file=None, vendor_id=VID_QIHW, product_id=PID_GLASGOW,
+                 poller="thread", serial=None):
+        self._loop = asyncio.get_event_loop()
 
+        self.usb_context = usb1.USBContext()
+        if poller == "thread":
+            self._poll_in_loop = False
+            self.usb_poller = _PollerThread(self.usb_context)
+            self.usb_poller.start()
+        elif poller == "loop":
+            self._poll_in_loop = True
+            self.usb_poller = _LoopPoller(self.usb_context, self._loop)
+        else:
+            raise ValueError("unknown poller {!r}".format(poller))
+
+        self._open_device(firmware_file, vendor_id, product_id, serial)
+        logger.debug("opened device with serial %s", self.serial)
+
+    def _acquire_transfer(self, key, is_read):
+        pool = self._transfer_pool[key]
+        if pool:
+            pooled = pool.pop()
+        else:
+            pooled = _PooledTransfer(key, self.usb.getTransfer())
+        pooled.is_read = is_read
+        pooled.future  = self._loop.create_future()
+        return pooled
+
+    def _release_transfer(self, pooled):
+        pooled.future = None
+        pool = self._transfer_pool[pooled.key]
+        if len(pool) < self.transfer_pool_size:
+            pool.append(pooled)
+
+    def _usb_callback(self, transfer):
+        # Called on the thread that handles libusb events.
+        if self._poll_in_loop:
+            self._complete_transfer(transfer.getUserData())
+        else:
+            self._loop.call_soon_threadsafe(self._complete_transfer, transfer.getUserData())
+
+    def _complete_transfer(self, pooled):
+        transfer, future = pooled.transfer, pooled.future
+        if transfer.isSubmitted():
+            return # transfer not completed
+
+        if not future.cancelled():
             status = transfer.getStatus()
             if status == usb1.TRANSFER_COMPLETED:
-                if is_read:
-                    future.set_result(transfer.getBuffer()[:transfer.getActualLength()])
+                if pooled.is_read:
+                    # The buffer will be reused by the next submission, so copy the data out.
+                    future.set_result(bytearray(transfer.getBuffer()
+                                                [:transfer.getActualLength()]))
                 else:
                     future.set_result(None)
             elif status == usb1.TRANSFER_CANCELLED:
@@ -137,25 +389,37 @@ class GlasgowHardwareDevice:
             else:
                 future.set_exception(GlasgowDeviceError("transfer error: {}".format(status)))
 
-        loop = asyncio.get_event_loop()
-        transfer.setCallback(lambda transfer: loop.call_soon_threadsafe(usb_callback, transfer))
+        self._release_transfer(pooled)
 
-        def done_callback(future):
-            if future.cancelled():
-                transfer.cancel()
-        future.add_done_callback(done_callback)
-
-        transfer.submit()
+    async def _do_transfer(self, pooled):
+        try:
+            pooled.transfer.submit()
+        except:
+            self._release_transfer(pooled)
+            raise
+        if self._poll_in_loop:
+            self.usb_poller.schedule_timeout()
 
-        return await future
+        try:
+            return await pooled.future
+        except asyncio.CancelledError:
+            if pooled.transfer.isSubmitted():
+                # The transfer is returned to the pool once libusb reports it as cancelled.
+                try:
+                    pooled.transfer.cancel()
+                except usb1.USBErrorNotFound:
+                    pass # completed in the meantime
+            raise
 
     async def control_read(self, request_type, request, value, index, length):
         logger.trace("USB: CONTROL IN type=%#04x request=%#04x "
                      "value=%#06x index=%#06x length=%d (submit)",
                      request_type, request, value, index, length)
-        data = await self._do_transfer(is_read=True, setup=lambda transfer:
-            transfer.setControl(request_type|usb1.ENDPOINT_IN, request, value, index, length))
-        logger.trace("USB: CONTROL IN data=<%s> (completed)", data.hex())
+        pooled = self._acquire_transfer(None, is_read=True)
+        pooled.transfer.setControl(request_type|usb1.ENDPOINT_IN, request, value, index, length,
+                                   callback=self._usb_callback, user_data=pooled)
+        data = await self._do_transfer(pooled)
+        logger.trace("USB: CONTROL IN data=<%s> (completed)", dump_hex(data))
         return data
 
     async def control_write(self, request_type, request, value, index, data):
@@ -163,55 +427,78 @@ class GlasgowHardwareDevice:
             data = bytes(data)
         logger.trace("USB: CONTROL OUT type=%#04x request=%#04x "
                      "value=%#06x index=%#06x data=<%s> (submit)",
-                     request_type, request, value, index, data.hex())
-        await self._do_transfer(is_read=False, setup=lambda transfer:
-            transfer.setControl(request_type|usb1.ENDPOINT_OUT, request, value, index, data))
+                     request_type, request, value, index, dump_hex(data))
+        pooled = self._acquire_transfer(None, is_read=False)
+        pooled.transfer.setControl(request_type|usb1.ENDPOINT_OUT, request, value, index, data,
+                                   callback=self._usb_callback, user_data=pooled)
+        await self._do_transfer(pooled)
         logger.trace("USB: CONTROL OUT (completed)")
 
     async def bulk_read(self, endpoint, length):
         logger.trace("USB: BULK EP%d IN length=%d (submit)", endpoint & 0x7f, length)
-        data = await self._do_transfer(is_read=True, setup=lambda transfer:
-            transfer.setBulk(endpoint|usb1.ENDPOINT_IN, length))
-        logger.trace("USB: BULK EP%d IN data=<%s> (completed)", endpoint & 0x7f, data.hex())
+        pooled = self._acquire_transfer(endpoint|usb1.ENDPOINT_IN, is_read=True)
+        if pooled.buffer is None or len(pooled.buffer) != length:
+            pooled.buffer = bytearray(length)
+        pooled.transfer.setBulk(endpoint|usb1.ENDPOINT_IN, pooled.buffer,
+                                callback=self._usb_callback, user_data=pooled)
+        data = await self._do_transfer(pooled)
+        logger.trace("USB: BULK EP%d IN data=<%s> (completed)", endpoint & 0x7f, dump_hex(data))
         return data
 
     async def bulk_write(self, endpoint, data):
         if not isinstance(data, (bytes, bytearray)):
             data = bytes(data)
-        logger.trace("USB: BULK EP%d OUT data=<%s> (submit)", endpoint & 0x7f, data.hex())
-        await self._do_transfer(is_read=False, setup=lambda transfer:
-            transfer.setBulk(endpoint|usb1.ENDPOINT_OUT, data))
+        logger.trace("USB: BULK EP%d OUT data=<%s> (submit)", endpoint & 0x7f, dump_hex(data))
+        pooled = self._acquire_transfer(endpoint|usb1.ENDPOINT_OUT, is_read=False)
+        pooled.transfer.setBulk(endpoint|usb1.ENDPOINT_OUT, data,
+                                callback=self._usb_callback, user_data=pooled)
+        await self._do_transfer(pooled)
         logger.trace("USB: BULK EP%d OUT (completed)", endpoint & 0x7f)
 
-    async def _read_eeprom_raw(self, idx, addr, length, chunk_size=0x1000):
+    async def _read_eeprom_raw(self, idx, addr, length, chunk_size=0x1000, window=4):
         """
         Read ``length`` bytes at ``addr`` from EEPROM at index ``idx``
-        in ``chunk_size`` byte chunks.
+        in ``chunk_size`` byte chunks, with up to ``window`` chunks in flight.
         """
-        data = bytearray()
-        while length > 0:
-            chunk_length = min(length, chunk_size)
-            logger.debug("reading EEPROM chip %d range %04x-%04x",
-                         idx, addr, addr + chunk_length - 1)
-            data += await self.control_read(usb1.REQUEST_TYPE_VENDOR, REQ_EEPROM,
-                                            addr, idx, chunk_length)
-            addr += chunk_length
-            length -= chunk_length
-        return data
-
-    async def _write_eeprom_raw(self, idx, addr, data, chunk_size=0x1000):
+        queue  = TaskQueue()
+        chunks = []
+        try:
+            while length > 0:
+                chunk_length = min(length, chunk_size)
+                logger.debug("reading EEPROM chip %d range %04x-%04x",
+                             idx, addr, addr + chunk_length - 1)
+                if len(queue) >= window:
+                    await queue.wait_one()
+                chunks.append(queue.submit(
+                    self.control_read(usb1.REQUEST_TYPE_VENDOR, REQ_EEPROM,
+                                      addr, idx, chunk_length)))
+                addr += chunk_length
+                length -= chunk_length
+            await queue.wait_all()
+        finally:
+            await queue.cancel()
+        return bytearray().join(chunk.result() for chunk in chunks)
+
+    async def _write_eeprom_raw(self, idx, addr, data, chunk_size=0x1000, window=4):
         """
         Write ``data`` to ``addr`` in EEPROM at index ``idx``
-        in ``chunk_size`` byte chunks.
+        in ``chunk_size`` byte chunks, with up to ``window`` chunks in flight.
         """
-        while len(data) > 0:
-            chunk_length = min(len(data), chunk_size)
-            logger.debug("writing EEPROM chip %d range %04x-%04x",
-                         idx, addr, addr + chunk_length - 1)
-            await self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_EEPROM,
-                                     addr, idx, data[:chunk_length])
-            addr += chunk_length
-            data  = data[chunk_length:]
+        queue = TaskQueue()
+        try:
+            while len(data) > 0:
+                chunk_length = min(len(data), chunk_size)
+                logger.debug("writing EEPROM chip %d range %04x-%04x",
+                             idx, addr, addr + chunk_length - 1)
+                if len(queue) >= window:
+                    await queue.wait_one()
+                queue.submit(self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_EEPROM,
+                                                addr, idx, data[:chunk_length]))
+                addr += chunk_length
+                data  = data[chunk_length:]
+            await queue.wait_all()
+        finally:
+            await queue.cancel()
 
     @staticmethod
     def _adjust_eeprom_addr_for_kind(kind, addr):
@@ -255,6 +542,35 @@ class GlasgowHardwareDevice:
             addr += chunk_length
             data  = data[chunk_length:]
 
+    async def update_eeprom(self, kind, old_data, new_data, chunk_size=0x1000, window=2):
+        """
+        Write the bytes of ``new_data`` that differ from ``old_data``, the current contents of
+        EEPROM of kind ``kind`` starting at address 0, and read them back.
+
+        The changes are written in ``chunk_size`` byte chunks; each chunk is read back while
+        the following ones are being written, with up to ``window`` chunks in flight.
+        Returns ``True`` if the data read back matches.
+        """
+        async def write_verify(addr, chunk):
+            await self.write_eeprom(kind, addr, chunk)
+            return await self.read_eeprom(kind, addr, len(chunk)) == chunk
+
+        queue  = TaskQueue()
+        chunks = []
+        try:
+            for (addr, data) in diff_data(old_data, new_data):
+                while len(data) > 0:
+                    chunk_length = min(len(data), chunk_size - addr % chunk_size)
+                    if len(queue) >= window:
+                        await queue.wait_one()
+                    chunks.append(queue.submit(write_verify(addr, data[:chunk_length])))
+                    addr += chunk_length
+                    data  = data[chunk_length:]
+            await queue.wait_all()
+        finally:
+            await queue.cancel()
+        return all(chunk.result() for chunk in chunks)
+
     async def _status(self):
         result = await self.control_read(usb1.REQUEST_TYPE_VENDOR, REQ_STATUS, 0, 0, 1)
         return result[0]
@@ -286,15 +602,31 @@ class GlasgowHardwareDevice:
             return None
         return bytes(bitstream_id)
 
-    async def download_bitstream(self, bitstream, bitstream_id=b"\xff" * 16):
-        """Download ``bitstream`` with ID ``bitstream_id`` to FPGA."""
+    async def download_bitstream(self, bitstream, bitstream_id=b"\xff" * 16, window=8):
+        """
+        Download ``bitstream`` with ID ``bitstream_id`` to FPGA.
+
+        Up to ``window`` chunks of the bitstream are submitted at once. The control endpoint
+        still processes them strictly in order, but the next chunk is sent without waiting
+        for the previous one to round-trip through the host.
+        """
+        started = time.perf_counter()
+
         # Send consecutive chunks of bitstream.
         # Sending 0th chunk resets the FPGA.
-        index = 0
-        while index * 1024 < len(bitstream):
-            await self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_FPGA_CFG,
-                                     0, index, bitstream[index * 1024:(index + 1) * 1024])
-            index += 1
+        chunks = TaskQueue()
+        try:
+            index = 0
+            while index * 1024 < len(bitstream):
+                if len(chunks) >= window:
+                    await chunks.wait_one()
+                chunks.submit(self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_FPGA_CFG,
+                    0, index, bitstream[index * 1024:(index + 1) * 1024]))
+                index += 1
+            await chunks.wait_all()
+        finally:
+            await chunks.cancel()
+
         # Complete configuration by setting bitstream ID.
         # This starts the FPGA.
         try:
@@ -303,6 +635,9 @@ class GlasgowHardwareDevice:
         except usb1.USBErrorPipe:
             raise GlasgowDeviceError("FPGA configuration failed")
 
+        logger.info("FPGA configured in %.3f s (%d bytes)",
+                    time.perf_counter() - started, len(bitstream))
+
     async def _iobuf_enable(self, on):
         await self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_IOBUF_ENABLE, on, 0, [])
 
@@ -445,3 +780,435 @@ class GlasgowHardwareDevice:
             await self.control_write(usb1.REQUEST_TYPE_VENDOR, REQ_REGISTER, addr, 0, [value])
         except usb1.USBErrorPipe:
             await self._register_error(addr)
+
+# -------------------------------------------------------------------------------------------------
+
+import os
+import ctypes
+import tempfile
+import unittest
+from fx2 import VID_CYPRESS, PID_FX2
+
+
+class _FakeUSBTransfer:
+    # Allocating a transfer in python-libusb1 involves libusb_alloc_transfer() and creating
+    # a ctypes callback trampoline; the latter is reproduced here to get comparable overhead.
+    _callback_type = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+
+    def __init__(self, handle):
+        self._handle     = handle
+        self._trampoline = self._callback_type(lambda transfer: None)
+        self._submitted  = False
+        self._status     = None
+        self._buffer     = None
+        self._length     = 0
+
+    def _set(self, buffer_or_len, callback, user_data):
+        if isinstance(buffer_or_len, int):
+            self._buffer = bytearray(buffer_or_len)
+        else:
+            self._buffer = buffer_or_len
+        self._callback  = callback
+        self._user_data = user_data
+
+    def setControl(self, request_type, request, value, index, buffer_or_len,
+                   callback=None, user_data=None, timeout=0):
+        self._set(buffer_or_len, callback, user_data)
+        self.setup = (request_type, request, value, index)
+
+    def setBulk(self, endpoint, buffer_or_len, callback=None, user_data=None, timeout=0):
+        self._set(buffer_or_len, callback, user_data)
+
+    def submit(self):
+        assert not self._submitted
+        self._submitted = True
+        self._handle.submitted.append(self)
+
+    def cancel(self):
+        if not self._submitted:
+            raise usb1.USBErrorNotFound
+        self._handle.complete(self, usb1.TRANSFER_CANCELLED)
+
+    def isSubmitted(self):
+        return self._submitted
+
+    def getStatus(self):
+        return self._status
+
+    def getBuffer(self):
+        return memoryview(self._buffer)
+
+    def getActualLength(self):
+        return self._length
+
+    def getUserData(self):
+        return self._user_data
+
+
+class _FakeUSBDeviceHandle:
+    def __init__(self, loop):
+        self.loop       = loop
+        self.submitted  = []
+        self.allocated  = 0
+
+    def getTransfer(self):
+        self.allocated += 1
+        return _FakeUSBTransfer(self)
+
+    def complete(self, transfer, status=usb1.TRANSFER_COMPLETED):
+        self.submitted.remove(transfer)
+        transfer._submitted = False
+        transfer._status    = status
+        transfer._length    = len(transfer._buffer)
+        # Completion callbacks are normally invoked from the poller thread.
+        self.loop.call_soon(transfer._callback, transfer)
+
+    def complete_all(self):
+        for transfer in list(self.submitted):
+            self.complete(transfer)
+
+
+def _make_fake_device(loop, transfer_pool_size=GlasgowHardwareDevice.transfer_pool_size):
+    device = GlasgowHardwareDevice.__new__(GlasgowHardwareDevice)
+    device._loop = loop
+    device._poll_in_loop = False
+    device._transfer_pool = defaultdict(list)
+    device.transfer_pool_size = transfer_pool_size
+    device.usb = _FakeUSBDeviceHandle(loop)
+    return device
+
+
+async def _fake_transfers(device, count, length):
+    for _ in range(count):
+        future = asyncio.ensure_future(device.bulk_read(0x86, length))
+        while not device.usb.submitted:
+            await asyncio.sleep(0)
+        device.usb.complete_all()
+        await future
+
+
+class GlasgowHardwareDeviceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop   = asyncio.get_event_loop()
+        self.device = _make_fake_device(self.loop)
+
+    def test_transfer_reuse(self):
+        self.loop.run_until_complete(_fake_transfers(self.device, 8, 512))
+        self.assertEqual(self.device.usb.allocated, 1)
+
+    def test_transfer_no_pool(self):
+        self.device.transfer_pool_size = 0
+        self.loop.run_until_complete(_fake_transfers(self.device, 8, 512))
+        self.assertEqual(self.device.usb.allocated, 8)
+
+    def test_transfer_result_copied(self):
+        async def do_test():
+            future = asyncio.ensure_future(self.device.bulk_read(0x86, 4))
+            await asyncio.sleep(0)
+            transfer, = self.device.usb.submitted
+            transfer._buffer[:] = b"abcd"
+            self.device.usb.complete(transfer)
+            data = await future
+            transfer._buffer[:] = b"efgh"
+            return data
+        self.assertEqual(self.loop.run_until_complete(do_test()), b"abcd")
+
+    def test_transfer_cancel(self):
+        async def do_test():
+            future = asyncio.ensure_future(self.device.bulk_read(0x86, 4))
+            await asyncio.sleep(0)
+            future.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await future
+            await asyncio.sleep(0)
+        self.loop.run_until_complete(do_test())
+        self.assertEqual(self.device.usb.submitted, [])
+        self.assertEqual(len(self.device._transfer_pool[0x86]), 1)
+
+    def test_download_bitstream(self):
+        max_submitted = 0
+        setups = []
+        async def complete():
+            nonlocal max_submitted
+            while True:
+                await asyncio.sleep(0)
+                max_submitted = max(max_submitted, len(self.device.usb.submitted))
+                for transfer in self.device.usb.submitted:
+                    setups.append(transfer.setup)
+                self.device.usb.complete_all()
+
+        completer = asyncio.ensure_future(complete())
+        try:
+            self.loop.run_until_complete(
+                self.device.download_bitstream(bytes(10 * 1024 + 1), window=4))
+        finally:
+            completer.cancel()
+        self.assertEqual(max_submitted, 4)
+        self.assertEqual([(request, index) for _, request, _, index in setups],
+                         [(REQ_FPGA_CFG, index) for index in range(11)] +
+                         [(REQ_BITSTREAM_ID, 0)])
+
+
+class _FakeUSBDevice:
+    def __init__(self, serial, port, vendor_id=VID_QIHW, product_id=PID_GLASGOW,
+                 device_id=0xE001, open_error=None):
+        self.serial     = serial
+        self.port       = port
+        self.vendor_id  = vendor_id
+        self.product_id = product_id
+        self.device_id  = device_id
+        self.open_error = open_error
+        self.writes     = 0
+        self.device_descriptor = self
+        self.iSerialNumber     = 3
+
+    def getVendorID(self):
+        return self.vendor_id
+
+    def getProductID(self):
+        return self.product_id
+
+    def getbcdDevice(self):
+        return self.device_id
+
+    def getBusNumber(self):
+        return 1
+
+    def getPortNumberList(self):
+        return [self.port]
+
+    def open(self):
+        if self.open_error is not None:
+            raise self.open_error
+        return self
+
+    def close(self):
+        pass
+
+    def getASCIIStringDescriptor(self, index):
+        assert index == self.iSerialNumber
+        return self.serial
+
+    def controlWrite(self, request_type, request, value, index, data):
+        self.writes += 1
+
+
+class _FakeUSBContextDevices:
+    def __init__(self, *device_lists):
+        self.device_lists = list(device_lists)
+
+    def getDeviceList(self, skip_on_error=False):
+        if len(self.device_lists) > 1:
+            return self.device_lists.pop(0)
+        return self.device_lists[0]
+
+
+class GlasgowHardwareDeviceEnumerationTestCase(unittest.TestCase):
+    def enumerate(self, *device_lists, firmware_file=None,
+                  vendor_id=VID_QIHW, product_id=PID_GLASGOW, **kwargs):
+        return GlasgowHardwareDevice._enumerate_devices(_FakeUSBContextDevices(*device_lists),
+            firmware_file, vendor_id, product_id, **kwargs)
+
+    def firmware_file(self):
+        f = tempfile.NamedTemporaryFile("w", suffix=".ihex")
+        f.write(":00000001FF\n")
+        f.flush()
+        return f
+
+    def test_enumerate(self):
+        handles = self.enumerate([
+            _FakeUSBDevice("C3-20190101T000000Z", 1),
+            _FakeUSBDevice(None, 2, vendor_id=0x1234),
+            _FakeUSBDevice("C3-20190202T000000Z", 3),
+        ])
+        self.assertEqual(sorted(handles), ["C3-20190101T000000Z", "C3-20190202T000000Z"])
+
+    def test_enumerate_serial(self):
+        without_firmware = _FakeUSBDevice(None, 1, device_id=0xA001)
+        with self.firmware_file() as f:
+            handles = self.enumerate([
+                without_firmware,
+                _FakeUSBDevice("C3-1", 2),
+                _FakeUSBDevice("C3-2", 3),
+            ], firmware_file=f.name, serial="C3-2")
+        self.assertEqual(list(handles), ["C3-2"])
+        self.assertEqual(without_firmware.writes, 0)
+
+    def test_enumerate_inaccessible(self):
+        with self.assertLogs(__name__, "WARNING") as logs:
+            handles = self.enumerate([
+                _FakeUSBDevice("C3-1", 1, open_error=usb1.USBErrorAccess()),
+                _FakeUSBDevice("C3-2", 2, open_error=usb1.USBErrorBusy()),
+                _FakeUSBDevice("C3-3", 3),
+            ], serial="C3-3")
+        self.assertEqual(list(handles), ["C3-3"])
+        self.assertEqual(logs.output, [
+            "WARNING:{}:skipping device at bus 1 port (1,): "
+            "cannot access device 20b7:9db1".format(__name__),
+            "WARNING:{}:skipping device at bus 1 port (2,): "
+            "cannot open device 20b7:9db1: LIBUSB_ERROR_BUSY [-6]".format(__name__),
+        ])
+
+    def test_enumerate_no_firmware(self):
+        with self.assertRaisesRegex(GlasgowDeviceError, r"^firmware is not uploaded$"):
+            self.enumerate([_FakeUSBDevice(None, 1, device_id=0xA003)])
+
+    def test_enumerate_reenumeration(self):
+        without_firmware = [
+            _FakeUSBDevice(None, 1, vendor_id=VID_CYPRESS, product_id=PID_FX2,
+                           device_id=0xA001),
+            _FakeUSBDevice("C3-1", 2),
+        ]
+        with_firmware = [
+            _FakeUSBDevice("C3-0", 1),
+            _FakeUSBDevice("C3-1", 2),
+        ]
+        with self.firmware_file() as f:
+            handles = self.enumerate(without_firmware, without_firmware, with_firmware,
+                                     firmware_file=f.name,
+                                     vendor_id=VID_CYPRESS, product_id=PID_FX2)
+        self.assertEqual(list(handles), ["C3-0"])
+
+    def test_enumerate_reenumeration_timeout(self):
+        devices = [_FakeUSBDevice(None, 1, device_id=0xA001)]
+        with self.firmware_file() as f:
+            with self.assertRaisesRegex(GlasgowDeviceError, r"^firmware upload failed$"):
+                self.enumerate(devices, firmware_file=f.name, reenumeration_timeout=0.02)
+
+    def test_select(self):
+        handles = {"C3-1": None, "C3-2": None}
+        self.assertEqual(GlasgowHardwareDevice._select_device(
+            handles, "C3-2", VID_QIHW, PID_GLASGOW), "C3-2")
+        self.assertEqual(GlasgowHardwareDevice._select_device(
+            {"C3-1": None}, None, VID_QIHW, PID_GLASGOW), "C3-1")
+        with self.assertRaisesRegex(GlasgowDeviceError,
+                r"^found 2 devices \(serial numbers C3-1, C3-2\), "):
+            GlasgowHardwareDevice._select_device(handles, None, VID_QIHW, PID_GLASGOW)
+        with self.assertRaisesRegex(GlasgowDeviceError,
+                r"^device with serial number C3-3 not found$"):
+            GlasgowHardwareDevice._select_device(handles, "C3-3", VID_QIHW, PID_GLASGOW)
+        with self.assertRaisesRegex(GlasgowDeviceError,
+                r"^device 20b7:9db1 not found$"):
+            GlasgowHardwareDevice._select_device({}, None, VID_QIHW, PID_GLASGOW)
+
+
+class GlasgowHardwareDeviceEEPROMTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop   = asyncio.get_event_loop()
+        self.device = _make_fake_device(self.loop)
+        self.memory = bytearray(64)
+        self.broken = set()
+        self.max_submitted = 0
+
+    async def _complete(self):
+        while True:
+            await asyncio.sleep(0)
+            self.max_submitted = max(self.max_submitted, len(self.device.usb.submitted))
+            for transfer in list(self.device.usb.submitted):
+                request_type, request, addr, idx = transfer.setup
+                self.assertEqual((request, idx), (REQ_EEPROM, 0))
+                length = len(transfer._buffer)
+                if request_type & usb1.ENDPOINT_IN:
+                    transfer._buffer[:] = self.memory[addr:addr + length]
+                else:
+                    for offset, byte in enumerate(transfer._buffer):
+                        if addr + offset not in self.broken:
+                            self.memory[addr + offset] = byte
+                self.device.usb.complete(transfer)
+
+    def run_with_eeprom(self, coro):
+        completer = asyncio.ensure_future(self._complete())
+        try:
+            return self.loop.run_until_complete(coro)
+        finally:
+            completer.cancel()
+
+    def test_read(self):
+        self.memory[:] = range(64)
+        data = self.run_with_eeprom(self.device.read_eeprom("fx2", 2, 40))
+        self.assertEqual(data, bytes(range(2, 42)))
+
+    def test_read_pipelined(self):
+        self.memory[:] = range(64)
+        data = self.run_with_eeprom(
+            self.device._read_eeprom_raw(0, 0, 64, chunk_size=8, window=3))
+        self.assertEqual(data, bytes(range(64)))
+        self.assertEqual(self.max_submitted, 3)
+
+    def test_update(self):
+        new_data = bytearray(64)
+        new_data[3:5]   = b"\x01\x02"
+        new_data[20:40] = range(1, 21)
+        self.assertTrue(self.run_with_eeprom(
+            self.device.update_eeprom("fx2", bytes(64), new_data, chunk_size=8)))
+        self.assertEqual(self.memory, new_data)
+
+    def test_update_fail(self):
+        self.broken.add(30)
+        new_data = bytes(range(1, 65))
+        self.assertFalse(self.run_with_eeprom(
+            self.device.update_eeprom("fx2", bytes(64), new_data, chunk_size=8)))
+
+
+class _FakeUSBContext:
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.handled = 0
+        self.timeout = None
+
+    def setPollFDNotifiers(self, added_cb=None, removed_cb=None, user_data=None):
+        self.added_cb   = added_cb
+        self.removed_cb = removed_cb
+
+    def getPollFDList(self):
+        return [(self.read_fd, select.POLLIN)]
+
+    def getNextTimeout(self):
+        return self.timeout
+
+    def handleEventsTimeout(self, tv=0):
+        try:
+            os.read(self.read_fd, 1)
+        except BlockingIOError:
+            pass
+        self.handled += 1
+
+
+class LoopPollerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop    = asyncio.get_event_loop()
+        self.context = _FakeUSBContext()
+        self.poller  = _LoopPoller(self.context, self.loop)
+
+    def tearDown(self):
+        self.context.removed_cb(self.context.read_fd, None)
+        os.close(self.context.read_fd)
+        os.close(self.context.write_fd)
+
+    def test_handle_events(self):
+        os.write(self.context.write_fd, b"\x00")
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(self.context.handled, 1)
+
+    def test_timeout(self):
+        self.context.timeout = 0.005
+        self.poller.schedule_timeout()
+        self.context.timeout = None
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(self.context.handled, 1)
+
+
+def _benchmark_transfers(count=100000, length=16384):
+    loop = asyncio.get_event_loop()
+    for name, pool_size in (("unpooled", 0), ("pooled", GlasgowHardwareDevice.transfer_pool_size)):
+        device  = _make_fake_device(loop, pool_size)
+        started = time.perf_counter()
+        loop.run_until_complete(_fake_transfers(device, count, length))
+        elapsed = time.perf_counter() - started
+        print("{:>8}: {:.2f} us/transfer, {} transfers allocated"
+              .format(name, elapsed / count * 1e6, device.usb.allocated))
+
+
+if __name__ == "__main__":
+    _benchmark_transfers()
@@ -1,3 +1,4 @@
+import array
 from functools import reduce
 from collections import OrderedDict
 from migen import *
@@ -7,7 +8,8 @@ from migen.genlib.coding import PriorityEncoder, PriorityDecoder
 from migen.genlib.fsm import FSM
 
 
-__all__ = ["EventSource", "EventAnalyzer", "TraceDecodingError", "TraceDecoder"]
+__all__  = ["EventSource", "EventAnalyzer", "TraceDecodingError", "TraceDecoder"]
+__all__ += ["TraceColumns", "TRACE_THROTTLE", "TRACE_DONE", "TRACE_OVERRUN"]
 
 
 REPORT_DELAY        = 0b10000000
@@ -350,16 +352,69 @@ class TraceDecodingError(Exception):
     pass
 
 
+# Pseudo event source indices used in the ``source`` column of :class:`TraceColumns`.
+TRACE_THROTTLE = -1
+TRACE_DONE     = -2
+TRACE_OVERRUN  = -3
+
+
+class TraceColumns:
+    """
+    A batch of decoded analyzer events in columnar form.
+
+    Every row is one event: ``timestamp[n]`` is the cycle it happened at, ``source[n]`` is
+    the index of its event source (or ``TRACE_THROTTLE``, ``TRACE_DONE`` or ``TRACE_OVERRUN``),
+    and ``data[n]`` is the raw event data (zero for sources without data). Rows are ordered by
+    timestamp.
+
+    The columns are :class:`array.array` objects, so they can be wrapped in NumPy arrays without
+    copying, e.g. ``numpy.frombuffer(columns.timestamp, dtype=numpy.int64)``.
+    """
+    def __init__(self, timestamp=None, source=None, data=None):
+        self.timestamp = array.array("q") if timestamp is None else timestamp
+        self.source    = array.array("h") if source    is None else source
+        self.data      = array.array("Q") if data      is None else data
+
+    def append(self, timestamp, source, data):
+        self.timestamp.append(timestamp)
+        self.source.append(source)
+        self.data.append(data)
+
+    def split(self, index):
+        """Return two batches with the rows before and after ``index``."""
+        return (TraceColumns(self.timestamp[:index], self.source[:index], self.data[:index]),
+                TraceColumns(self.timestamp[index:], self.source[index:], self.data[index:]))
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def __iter__(self):
+        return zip(self.timestamp, self.source, self.data)
+
+
 class TraceDecoder:
     """
     Event analyzer trace decoder.
 
     Decodes raw analyzer traces into a timestamped sequence of maps from event fields to
     their values.
+
+    If ``columnar`` is true, the decoder instead parses whole chunks at once using tables
+    precomputed for every event source, and :meth:`flush` returns :class:`TraceColumns`.
+    Every row is decoded from at least one byte of trace, so the memory used between flushes is
+    bounded by the amount of trace processed; :meth:`expand` converts the rows back into
+    the timeline returned in the default mode.
+
+    If ``checkpoint_interval`` is not ``None``, the columnar decoder also records a checkpoint
+    whenever at least that many cycles passed since the previous one, including in the middle of
+    a chunk; see :meth:`flush_checkpoints`.
     """
-    def __init__(self, event_sources, absolute_timestamps=True):
+    def __init__(self, event_sources, absolute_timestamps=True, columnar=False,
+                 checkpoint_interval=None):
         self.event_sources       = event_sources
         self.absolute_timestamps = absolute_timestamps
+        self.columnar            = columnar
+        self.checkpoint_interval = checkpoint_interval
 
         self._state      = "IDLE"
         self._byte_off   = 0
@@ -371,6 +426,39 @@ class TraceDecoder:
         self._pending    = OrderedDict()
         self._timeline   = []
 
+        # For every event source, the names of its fields with their offsets and masks, or
+        # ``None`` as the mask for sources without data.
+        self._source_fields = []
+        for event_src in self.event_sources:
+            if event_src.width == 0:
+                self._source_fields.append(((event_src.name, 0, None),))
+            elif event_src.fields:
+                fields, offset = [], 0
+                for field_name, field_width in event_src.fields:
+                    fields.append(("%s-%s" % (field_name, event_src.name),
+                                   offset, (1 << field_width) - 1))
+                    offset += field_width
+                self._source_fields.append(tuple(fields))
+            else:
+                self._source_fields.append(((event_src.name, 0, ~0),))
+
+        if self.columnar:
+            for event_src in self.event_sources:
+                if event_src.width > 64:
+                    raise ValueError("event source {!r} is wider than 64 bits and cannot be "
+                                     "decoded into columns".format(event_src.name))
+            self._source_octets = [(event_src.width + 7) // 8
+                                   for event_src in self.event_sources]
+            self._columns = TraceColumns()
+            self._closed  = 0
+            self._carry   = b""
+
+        if self.checkpoint_interval is not None:
+            if not self.columnar or not self.absolute_timestamps:
+                raise ValueError("checkpoints require columnar mode with absolute timestamps")
+            self._checkpoints   = [self.save_state()]
+            self._checkpoint_at = self.checkpoint_interval
+
     def events(self):
         """
         Return names and widths for all events that may be emitted by this trace decoder.
@@ -402,6 +490,9 @@ class TraceDecoder:
         """
         Incrementally parse a chunk of analyzer trace, and record events in it.
         """
+        if self.columnar:
+            return self._process_columnar(data)
+
         for octet in data:
             is_delay   = ((octet & REPORT_DELAY_MASK)   == REPORT_DELAY)
             is_event   = ((octet & REPORT_EVENT_MASK)   == REPORT_EVENT)
@@ -427,15 +518,17 @@ class TraceDecoder:
             elif self._state in ("IDLE", "DELAY") and is_event:
                 self._flush_timestamp()
 
-                if (octet & ~REPORT_EVENT_MASK) > len(self.event_sources):
+                if (octet & ~REPORT_EVENT_MASK) >= len(self.event_sources):
                     raise TraceDecodingError("at byte offset %d: event source out of bounds" %
                                              self._byte_off)
-                self._event_src = self.event_sources[octet & ~REPORT_EVENT_MASK]
-                if self._event_src.width == 0:
-                    self._pending[self._event_src.name] = None
+                self._event_src = octet & ~REPORT_EVENT_MASK
+                width = self.event_sources[self._event_src].width
+                if width == 0:
+                    (name, _, _), = self._source_fields[self._event_src]
+                    self._pending[name] = None
                     self._state = "IDLE"
                 else:
-                    self._event_off  = self._event_src.width
+                    self._event_off  = width
                     self._event_data = 0
                     self._state = "EVENT"
 
@@ -445,14 +538,8 @@ class TraceDecoder:
                 if self._event_off > 8:
                     self._event_off -= 8
                 else:
-                    if self._event_src.fields:
-                        offset = 0
-                        for field_name, field_width in self._event_src.fields:
-                            self._pending["%s-%s" % (field_name, self._event_src.name)] = \
-                                (self._event_data >> offset) & ((1 << field_width) - 1)
-                            offset += field_width
-                    else:
-                        self._pending[self._event_src.name] = self._event_data
+                    for name, offset, mask in self._source_fields[self._event_src]:
+                        self._pending[name] = (self._event_data >> offset) & mask
 
                     self._state = "IDLE"
 
@@ -470,12 +557,119 @@ class TraceDecoder:
 
             self._byte_off += 1
 
+    def _process_columnar(self, data):
+        if self._carry:
+            # The previous chunk ended in the middle of an event; reparse it from the start.
+            data, self._carry = self._carry + bytes(data), b""
+
+        append_timestamp = self._columns.timestamp.append
+        append_source    = self._columns.source.append
+        append_data      = self._columns.data.append
+        source_octets    = self._source_octets
+        source_count     = len(source_octets)
+        absolute         = self.absolute_timestamps
+        from_bytes       = int.from_bytes
+        if self.checkpoint_interval is None:
+            checkpoint_at = float("inf")
+        else:
+            checkpoint_at = self._checkpoint_at
+
+        state     = self._state
+        timestamp = self._timestamp
+        delay     = self._delay
+        closed    = self._closed
+        rows      = len(self._columns)
+        offset, end = 0, len(data)
+        try:
+            while offset < end:
+                octet = data[offset]
+                if octet & REPORT_DELAY_MASK == REPORT_DELAY:
+                    if state not in ("IDLE", "DELAY"):
+                        break
+                    if not delay and timestamp >= checkpoint_at:
+                        # Every event at or before ``timestamp`` has been decoded, and this delay
+                        # precedes every event after it.
+                        self._checkpoints.append((self._byte_off + offset,
+                                                  (state, timestamp, 0)))
+                        checkpoint_at = timestamp + self.checkpoint_interval
+                    state = "DELAY"
+                    delay = (delay << 7) | (octet & ~REPORT_DELAY_MASK)
+                    offset += 1
+                    continue
+
+                if state not in ("IDLE", "DELAY"):
+                    break
+
+                if octet & REPORT_EVENT_MASK == REPORT_EVENT:
+                    source = octet & ~REPORT_EVENT_MASK
+                    if source >= source_count:
+                        raise TraceDecodingError("at byte offset %d: event source out of bounds" %
+                                                 (self._byte_off + offset))
+                    length = source_octets[source]
+                    if offset + 1 + length > end:
+                        self._carry = bytes(data[offset:])
+                        break
+                    value = from_bytes(data[offset + 1:offset + 1 + length], "big")
+                    offset += 1 + length
+                    state = "IDLE"
+                else:
+                    special = octet & ~REPORT_SPECIAL
+                    if state != "DELAY":
+                        break
+                    if special == SPECIAL_THROTTLE:
+                        source, value = TRACE_THROTTLE, 1
+                    elif special == SPECIAL_DETHROTTLE:
+                        source, value = TRACE_THROTTLE, 0
+                    elif special == SPECIAL_DONE:
+                        source, value, state = TRACE_DONE, 0, "DONE"
+                    elif special == SPECIAL_OVERRUN:
+                        source, value, state = TRACE_OVERRUN, 0, "OVERRUN"
+                    else:
+                        break
+                    offset += 1
+
+                if delay:
+                    closed = rows
+                    timestamp = timestamp + delay if absolute else delay
+                    delay = 0
+                append_timestamp(timestamp)
+                append_source(source)
+                append_data(value)
+                rows += 1
+                if state in ("DONE", "OVERRUN"):
+                    closed = rows
+            else:
+                offset = None
+        finally:
+            self._state     = state
+            self._timestamp = timestamp
+            self._delay     = delay
+            self._closed    = closed
+            if self.checkpoint_interval is not None:
+                self._checkpoint_at = checkpoint_at
+
+        if offset is not None and not self._carry:
+            self._byte_off += offset
+            raise TraceDecodingError("at byte offset %d: invalid byte %#04x for state %s" %
+                                     (self._byte_off, data[offset], self._state))
+        self._byte_off += end - len(self._carry)
+
     def flush(self, pending=False):
         """
         Return the complete event timeline since the start of decoding or the previous flush.
         If ``pending`` is ``True``, also flushes pending events; this may cause duplicate
         timestamps if more events arrive after the flush.
+
+        In columnar mode, returns the rows of that timeline as :class:`TraceColumns`.
         """
+        if self.columnar:
+            if pending or self._closed == len(self._columns):
+                columns, self._columns = self._columns, TraceColumns()
+            else:
+                columns, self._columns = self._columns.split(self._closed)
+            self._closed = 0
+            return columns
+
         if self._state == "OVERRUN":
             self._timeline.append((self._timestamp, "overrun"))
         elif pending and self._pending or self._state == "DONE":
@@ -485,9 +679,71 @@ class TraceDecoder:
         timeline, self._timeline = self._timeline, []
         return timeline
 
+    def expand(self, columns):
+        """
+        Convert :class:`TraceColumns` returned by :meth:`flush` into a timeline of
+        ``(timestamp, events)`` tuples, as returned by :meth:`flush` in the default mode.
+        """
+        timeline = []
+        events   = None
+        for timestamp, source, data in columns:
+            if source == TRACE_OVERRUN:
+                timeline.append((timestamp, "overrun"))
+                events = None
+                continue
+            if events is None or timeline[-1][0] != timestamp:
+                events = OrderedDict()
+                timeline.append((timestamp, events))
+            if source == TRACE_THROTTLE:
+                events["throttle"] = data
+            elif source >= 0:
+                for name, offset, mask in self._source_fields[source]:
+                    events[name] = None if mask is None else (data >> offset) & mask
+        return timeline
+
     def is_done(self):
         return self._state in ("DONE", "OVERRUN")
 
+    def save_state(self):
+        """
+        Return a ``(byte_offset, state)`` tuple, where ``state`` can be passed together with
+        ``byte_offset`` to :meth:`restore_state` of another decoder for the same event sources
+        to resume decoding the same trace from that byte offset. Columnar mode only.
+        """
+        assert self.columnar
+        # An event split across chunks is reparsed from its first byte, so the carried over
+        # bytes are not counted in the byte offset.
+        return (self._byte_off, (self._state, self._timestamp, self._delay))
+
+    def restore_state(self, byte_offset, state):
+        """
+        Discard everything decoded so far, and continue decoding at ``byte_offset`` with
+        the ``state`` returned by :meth:`save_state`. Columnar mode only.
+        """
+        assert self.columnar
+        self._state, self._timestamp, self._delay = state
+        self._byte_off = byte_offset
+        self._columns  = TraceColumns()
+        self._closed   = 0
+        self._carry    = b""
+        if self.checkpoint_interval is not None:
+            self._checkpoints   = [(byte_offset, state)]
+            self._checkpoint_at = self._timestamp + self.checkpoint_interval
+
+    def flush_checkpoints(self):
+        """
+        Return the checkpoints recorded since the start of decoding or the previous call, as
+        a list of ``(byte_offset, state)`` tuples like those returned by :meth:`save_state`.
+        Requires ``checkpoint_interval``.
+
+        The first checkpoint is at the start of decoding, and every other checkpoint is taken
+        at the first delay after at least ``checkpoint_interval`` cycles passed since
+        the previous one, regardless of how the trace was split into chunks.
+        """
+        assert self.checkpoint_interval is not None
+        checkpoints, self._checkpoints = self._checkpoints, []
+        return checkpoints
+
 # -------------------------------------------------------------------------------------------------
 
 import unittest
@@ -548,6 +804,11 @@ class EventAnalyzerTestCase(unittest.TestCase):
         decoder.process(data)
         self.assertEqual(decoder.flush(flush_pending), decoded)
 
+        decoder = TraceDecoder(self.tb.dut.event_sources, columnar=True)
+        for octet in data:
+            decoder.process(bytes([octet]))
+        self.assertEqual(decoder.expand(decoder.flush(flush_pending)), decoded)
+
     @simulation_test(sources=(8,))
     def test_one_8bit_src(self, tb):
         yield from tb.trigger(0, 0xaa)
@@ -849,3 +1110,141 @@ class EventAnalyzerTestCase(unittest.TestCase):
         ], [
             (0x10000, "overrun"),
         ], flush_pending=False)
+
+
+class TraceDecoderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_sources = [
+            EventSource("0", "strobe", 12, (), 16),
+            EventSource("1", "strobe", 0, (), 16),
+            EventSource("2", "change", 3, (("a", 1), ("b", 2)), 16),
+        ]
+        self.data = bytes([
+            REPORT_DELAY|2,
+            REPORT_EVENT|0, 0x0a, 0xbc,
+            REPORT_EVENT|1,
+            REPORT_DELAY|1,
+            REPORT_SPECIAL|SPECIAL_THROTTLE,
+            REPORT_EVENT|2, 0b110,
+            REPORT_DELAY|0b0000001, REPORT_DELAY|0b0000000,
+            REPORT_SPECIAL|SPECIAL_DETHROTTLE,
+            REPORT_DELAY|1,
+            REPORT_SPECIAL|SPECIAL_DONE,
+        ])
+
+    def test_columns(self):
+        decoder = TraceDecoder(self.event_sources, columnar=True)
+        decoder.process(self.data)
+        self.assertTrue(decoder.is_done())
+        columns = decoder.flush()
+        self.assertEqual(list(columns), [
+            (2, 0, 0xabc),
+            (2, 1, 0),
+            (3, TRACE_THROTTLE, 1),
+            (3, 2, 0b110),
+            (131, TRACE_THROTTLE, 0),
+            (132, TRACE_DONE, 0),
+        ])
+        self.assertEqual(columns.timestamp.itemsize, 8)
+        self.assertEqual(memoryview(columns.data).format, "Q")
+
+    def test_expand(self):
+        reference = TraceDecoder(self.event_sources)
+        reference.process(self.data)
+        reference = reference.flush()
+        for chunk_size in (1, 2, 3, len(self.data)):
+            decoder = TraceDecoder(self.event_sources, columnar=True)
+            timeline = []
+            for offset in range(0, len(self.data), chunk_size):
+                decoder.process(memoryview(self.data)[offset:offset + chunk_size])
+                timeline += decoder.expand(decoder.flush())
+            self.assertEqual(timeline, reference)
+
+    def test_flush_pending(self):
+        decoder = TraceDecoder(self.event_sources, columnar=True)
+        decoder.process(self.data[:5])
+        self.assertEqual(len(decoder.flush()), 0)
+        decoder.process(self.data[5:8])
+        self.assertEqual(list(decoder.flush()), [(2, 0, 0xabc), (2, 1, 0)])
+        self.assertEqual(list(decoder.flush(pending=True)), [(3, TRACE_THROTTLE, 1)])
+
+    def test_overrun(self):
+        decoder = TraceDecoder(self.event_sources, columnar=True)
+        decoder.process([REPORT_DELAY|4, REPORT_SPECIAL|SPECIAL_OVERRUN])
+        self.assertTrue(decoder.is_done())
+        self.assertEqual(decoder.expand(decoder.flush()), [(4, "overrun")])
+
+    def test_invalid(self):
+        data = self.data[:5] + bytes([REPORT_SPECIAL|SPECIAL_THROTTLE])
+        for columnar in (False, True):
+            decoder = TraceDecoder(self.event_sources, columnar=columnar)
+            with self.assertRaisesRegex(TraceDecodingError,
+                    r"^at byte offset 5: invalid byte 0x02 for state IDLE$"):
+                decoder.process(data)
+
+    def test_save_restore(self):
+        decoder = TraceDecoder(self.event_sources, columnar=True)
+        decoder.process(self.data[:10])
+        decoder.flush(pending=True)
+        offset, state = decoder.save_state()
+        self.assertEqual((offset, state), (10, ("DELAY", 3, 1)))
+
+        resumed = TraceDecoder(self.event_sources, columnar=True)
+        resumed.restore_state(offset, state)
+        resumed.process(self.data[offset:])
+        decoder.process(self.data[10:])
+        self.assertEqual(list(resumed.flush()), list(decoder.flush()))
+        self.assertEqual(resumed.save_state()[0], len(self.data))
+
+    def test_checkpoints(self):
+        for chunk_size in (1, 3, len(self.data)):
+            decoder = TraceDecoder(self.event_sources, columnar=True, checkpoint_interval=2)
+            checkpoints = []
+            for offset in range(0, len(self.data), chunk_size):
+                decoder.process(self.data[offset:offset + chunk_size])
+                checkpoints += decoder.flush_checkpoints()
+            self.assertEqual(checkpoints, [
+                (0, ("IDLE", 0, 0)),
+                (5, ("IDLE", 2, 0)),
+                (12, ("DELAY", 131, 0)),
+            ])
+
+        resumed = TraceDecoder(self.event_sources, columnar=True)
+        resumed.restore_state(5, ("IDLE", 2, 0))
+        resumed.process(self.data[5:])
+        self.assertEqual(list(resumed.flush())[0], (3, TRACE_THROTTLE, 1))
+
+    def test_out_of_bounds(self):
+        for columnar in (False, True):
+            decoder = TraceDecoder(self.event_sources, columnar=columnar)
+            with self.assertRaisesRegex(TraceDecodingError,
+                    r"^at byte offset 1: event source out of bounds$"):
+                decoder.process([REPORT_DELAY|1, REPORT_EVENT|3])
+
+
+def _benchmark_trace_decoder(cycles=200000):
+    import time
+
+    event_sources = [
+        EventSource("0", "strobe", 8, (), 512),
+        EventSource("1", "change", 16, (("a", 8), ("b", 8)), 256),
+        EventSource("2", "strobe", 0, (), 0),
+    ]
+    data = bytes([REPORT_DELAY|1, REPORT_EVENT|0, 0xaa,
+                  REPORT_EVENT|1, 0x12, 0x34,
+                  REPORT_DELAY|3, REPORT_EVENT|2]) * (cycles // 2)
+    chunk_size = 16384
+
+    for columnar in (False, True):
+        decoder = TraceDecoder(event_sources, columnar=columnar)
+        started = time.perf_counter()
+        for offset in range(0, len(data), chunk_size):
+            decoder.process(memoryview(data)[offset:offset + chunk_size])
+            decoder.flush()
+        elapsed = time.perf_counter() - started
+        print("{} decoder: {:.2f} MiB/s".format("columnar" if columnar else "timeline",
+                                                len(data) / elapsed / (1 << 20)))
+
+
+if __name__ == "__main__":
+    _benchmark_trace_decoder()
@@ -46,6 +46,19 @@ class GlasgowPlatform(LatticePlatform):
     def __init__(self):
         LatticePlatform.__init__(self, "ice40-up5k-sg48", _io, _connectors,
                                  toolchain="icestorm")
+        self._verilog = {}
+
+    def get_verilog(self, fragment, name="top", **kwargs):
+        # Converting a design to Verilog is expensive, and it is done both to compute
+        # the bitstream ID and to build the bitstream, so reuse the result.
+        if kwargs:
+            return super().get_verilog(fragment, name=name, **kwargs)
+        key = (id(fragment), name)
+        if key not in self._verilog:
+            # Keep the fragment alive so that its id() is not reused.
+            self._verilog[key] = fragment, super().get_verilog(fragment, name=name)
+        _, verilog = self._verilog[key]
+        return verilog
 
     def create_programmer(self):
         return GlasgowProgrammer()
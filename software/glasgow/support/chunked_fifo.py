@@ -0,0 +1,135 @@
+from collections import deque
+
+
+__all__ = ["ChunkedFIFO"]
+
+
+class ChunkedFIFO:
+    """
+    A first-in, first-out byte buffer that stores data as a queue of chunks.
+
+    Unlike slicing a ``bytearray``, neither writing to nor reading from this buffer copies
+    the data that remains in it, so the cost of an operation only depends on the amount of
+    data it transfers.
+    """
+    def __init__(self):
+        self._queue  = deque()
+        self._chunk  = None
+        self._offset = 0
+        self._length = 0
+
+    def clear(self):
+        """Discard all data in the buffer."""
+        self._queue.clear()
+        self._chunk  = None
+        self._offset = 0
+        self._length = 0
+
+    def write(self, data):
+        """
+        Append ``data`` to the buffer without copying it.
+
+        The buffer takes ownership of ``data``; if it is mutable, it must not be changed
+        afterwards.
+        """
+        if len(data) == 0:
+            return
+        self._queue.append(data)
+        self._length += len(data)
+
+    def _next_chunk(self):
+        if self._chunk is None:
+            self._chunk  = memoryview(self._queue.popleft())
+            self._offset = 0
+        return self._chunk
+
+    def read(self, max_length=None):
+        """
+        Remove and return at most ``max_length`` bytes (or, if ``max_length`` is ``None``,
+        the rest of the head chunk) from the head of the buffer, without copying.
+
+        The returned ``memoryview`` never spans more than one chunk, so it may be shorter than
+        requested even if there is enough data in the buffer. Returns an empty ``memoryview``
+        if the buffer is empty.
+        """
+        if self._length == 0:
+            return memoryview(b"")
+
+        chunk = self._next_chunk()
+        if max_length is None:
+            max_length = len(chunk) - self._offset
+        result = chunk[self._offset:self._offset + max_length]
+        self._offset += len(result)
+        self._length -= len(result)
+        if self._offset == len(chunk):
+            self._chunk = None
+        return result
+
+    def readinto(self, buffer):
+        """
+        Remove at most ``len(buffer)`` bytes from the head of the buffer and copy them into
+        ``buffer``. Returns the amount of bytes copied.
+        """
+        buffer = memoryview(buffer).cast("B")
+        offset = 0
+        while offset < len(buffer) and self._length > 0:
+            chunk = self.read(len(buffer) - offset)
+            buffer[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return offset
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+
+
+class ChunkedFIFOTestCase(unittest.TestCase):
+    def setUp(self):
+        self.fifo = ChunkedFIFO()
+
+    def test_empty(self):
+        self.assertFalse(self.fifo)
+        self.assertEqual(len(self.fifo), 0)
+        self.assertEqual(self.fifo.read(), b"")
+
+    def test_write_read(self):
+        self.fifo.write(b"abc")
+        self.fifo.write(b"")
+        self.fifo.write(bytearray(b"def"))
+        self.assertEqual(len(self.fifo), 6)
+        self.assertEqual(self.fifo.read(), b"abc")
+        self.assertEqual(self.fifo.read(2), b"de")
+        self.assertEqual(len(self.fifo), 1)
+        self.assertEqual(self.fifo.read(5), b"f")
+        self.assertFalse(self.fifo)
+
+    def test_read_no_copy(self):
+        data = b"abcdef"
+        self.fifo.write(data)
+        chunk = self.fifo.read(3)
+        self.assertIsInstance(chunk, memoryview)
+        self.assertIs(chunk.obj, data)
+
+    def test_readinto(self):
+        self.fifo.write(b"abc")
+        self.fifo.write(b"def")
+        buffer = bytearray(4)
+        self.assertEqual(self.fifo.readinto(buffer), 4)
+        self.assertEqual(buffer, b"abcd")
+        self.assertEqual(self.fifo.readinto(buffer), 2)
+        self.assertEqual(buffer, b"efcd")
+        self.assertEqual(self.fifo.readinto(buffer), 0)
+
+    def test_clear(self):
+        self.fifo.write(b"abc")
+        self.fifo.read(1)
+        self.fifo.clear()
+        self.assertFalse(self.fifo)
+        self.fifo.write(b"def")
+        self.assertEqual(self.fifo.read(), b"def")
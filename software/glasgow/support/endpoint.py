@@ -5,6 +5,7 @@ import re
 from collections import deque
 
 from .aobject import *
+from .logging import *
 
 
 __all__ = ["ServerEndpoint"]
@@ -133,7 +134,7 @@ class ServerEndpoint(aobject, asyncio.Protocol):
             self._buffer = self._buffer[len(chunk):]
             data += chunk
 
-        self._log(logging.TRACE, "recv <%s>", data.hex())
+        self._log(logging.TRACE, "recv <%s>", dump_hex(data))
         return data
 
     async def recv_until(self, separator):
@@ -141,7 +142,7 @@ class ServerEndpoint(aobject, asyncio.Protocol):
         data = bytearray()
         while True:
             if not self._buffer:
-                self._log(logging.TRACE, "recv waits for <%s>", separator.hex())
+                self._log(logging.TRACE, "recv waits for <%s>", dump_hex(separator))
                 await self._refill()
 
             try:
@@ -155,13 +156,13 @@ class ServerEndpoint(aobject, asyncio.Protocol):
                 data += self._buffer
                 self._buffer = None
 
-        self._log(logging.TRACE, "recv <%s%s>", data.hex(), separator.hex())
+        self._log(logging.TRACE, "recv <%s%s>", dump_hex(data), dump_hex(separator))
         return data
 
     async def send(self, data):
         data = bytes(data)
         if self._send_epoch == self._recv_epoch:
-            self._log(logging.TRACE, "send <%s>", data.hex())
+            self._log(logging.TRACE, "send <%s>", dump_hex(data))
             self._transport.write(data)
             return True
         else:
@@ -0,0 +1,89 @@
+import logging
+
+
+__all__ = ["dump_hex"]
+
+
+class dump_hex:
+    """
+    Lazily format ``data`` as a hexadecimal string.
+
+    Passing ``dump_hex(data)`` rather than ``data.hex()`` as a logging argument defers
+    the conversion until the record is actually emitted, so it costs nothing when the logger
+    is not enabled for the level of the message. The data is not copied, so a mutable buffer
+    must not be changed before the call to the logger returns.
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        if isinstance(self.data, (bytes, bytearray)):
+            return self.data.hex()
+        return bytes(self.data).hex()
+
+    def __repr__(self):
+        return "dump_hex({})".format(str(self))
+
+# -------------------------------------------------------------------------------------------------
+
+import io
+import unittest
+
+
+class DumpHexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stream  = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        self.logger  = logging.getLogger(__name__ + ".test")
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_str(self):
+        self.assertEqual(str(dump_hex(b"\x00\xab")), "00ab")
+        self.assertEqual(str(dump_hex(bytearray(b"\x12"))), "12")
+        self.assertEqual(str(dump_hex(memoryview(b"\x34\x56")[1:])), "56")
+        self.assertEqual(str(dump_hex([1, 2])), "0102")
+
+    def test_enabled(self):
+        self.logger.setLevel(logging.TRACE)
+        self.logger.trace("data=<%s>", dump_hex(b"\x01\x02"))
+        self.assertEqual(self.stream.getvalue(), "data=<0102>\n")
+
+    def test_disabled(self):
+        class data:
+            def hex(self):
+                raise AssertionError("formatted while disabled")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.trace("data=<%s>", dump_hex(data()))
+        self.assertEqual(self.stream.getvalue(), "")
+
+
+def _benchmark_dump_hex(total=8 << 20, chunk_size=16384):
+    import time
+
+    logger = logging.getLogger(__name__ + ".benchmark")
+    logger.setLevel(logging.DEBUG)
+    chunk = bytes(chunk_size)
+    count = total // chunk_size
+
+    started = time.perf_counter()
+    for _ in range(count):
+        logger.trace("data=<%s>", chunk.hex())
+    eager = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(count):
+        logger.trace("data=<%s>", dump_hex(chunk))
+    lazy = time.perf_counter() - started
+
+    print("logging {} MiB with TRACE disabled: {:.1f} ms with .hex(), {:.1f} ms with dump_hex()"
+          .format(total >> 20, eager * 1e3, lazy * 1e3))
+
+
+if __name__ == "__main__":
+    _benchmark_dump_hex()
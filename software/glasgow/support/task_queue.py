@@ -0,0 +1,164 @@
+import asyncio
+
+
+__all__ = ["TaskQueue"]
+
+
+class TaskQueue:
+    """
+    A queue of concurrently running tasks.
+
+    Tasks are retired in the order they complete; the result of a completed task is discarded,
+    but an exception raised by a task is reraised by whichever of :meth:`poll`, :meth:`wait_one`
+    or :meth:`wait_all` retires it.
+    """
+    def __init__(self):
+        self._live = []
+
+    def submit(self, coro):
+        """Schedule ``coro`` to run concurrently with other tasks in the queue."""
+        task = asyncio.ensure_future(coro)
+        self._live.append(task)
+        return task
+
+    async def _retire(self, tasks):
+        # Retire the tasks one at a time, so that if one of them raised an exception, the rest
+        # stay in the queue and are retired (reraising their exceptions) later.
+        for task in tasks:
+            self._live.remove(task)
+            if not task.cancelled():
+                await task
+
+    async def poll(self):
+        """Retire all completed tasks without waiting."""
+        await self._retire([task for task in self._live if task.done()])
+
+    async def wait_one(self):
+        """Wait until at least one task completes, and retire all completed tasks."""
+        if not self._live:
+            return
+        done, pending = await asyncio.wait(self._live, return_when=asyncio.FIRST_COMPLETED)
+        await self._retire([task for task in self._live if task in done])
+
+    async def wait_all(self):
+        """Wait until all tasks complete, and retire them."""
+        while self._live:
+            await self.wait_one()
+
+    async def cancel(self):
+        """Cancel all tasks, and wait until they are retired."""
+        tasks, self._live = self._live, []
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    def __len__(self):
+        return len(self._live)
+
+    def __bool__(self):
+        return bool(self._live)
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+
+
+class TaskQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop  = asyncio.get_event_loop()
+        self.queue = TaskQueue()
+
+    def run_until_complete(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def do_test_wait_one(self):
+        order = []
+        async def task(delay):
+            await asyncio.sleep(delay)
+            order.append(delay)
+
+        self.queue.submit(task(0.02))
+        self.queue.submit(task(0.01))
+        self.assertEqual(len(self.queue), 2)
+        await self.queue.wait_one()
+        self.assertEqual(order, [0.01])
+        self.assertEqual(len(self.queue), 1)
+        await self.queue.wait_one()
+        self.assertEqual(order, [0.01, 0.02])
+        self.assertFalse(self.queue)
+
+    def test_wait_one(self):
+        self.run_until_complete(self.do_test_wait_one())
+
+    async def do_test_wait_all(self):
+        async def task(delay):
+            await asyncio.sleep(delay)
+
+        for n in range(4):
+            self.queue.submit(task(n * 0.005))
+        await self.queue.wait_all()
+        self.assertFalse(self.queue)
+
+    def test_wait_all(self):
+        self.run_until_complete(self.do_test_wait_all())
+
+    async def do_test_resubmit(self):
+        count = 0
+        async def task():
+            nonlocal count
+            count += 1
+            if count < 4:
+                self.queue.submit(task())
+
+        self.queue.submit(task())
+        await self.queue.wait_all()
+        self.assertEqual(count, 4)
+
+    def test_resubmit(self):
+        self.run_until_complete(self.do_test_resubmit())
+
+    async def do_test_poll_exception(self):
+        async def task():
+            raise ValueError("foo")
+
+        self.queue.submit(task())
+        await asyncio.sleep(0)
+        with self.assertRaisesRegex(ValueError, r"^foo$"):
+            await self.queue.poll()
+        self.assertFalse(self.queue)
+
+    def test_poll_exception(self):
+        self.run_until_complete(self.do_test_poll_exception())
+
+    async def do_test_several_exceptions(self):
+        async def task(n):
+            raise ValueError(n)
+
+        for n in range(2):
+            self.queue.submit(task(n))
+        await asyncio.sleep(0)
+        with self.assertRaises(ValueError):
+            await self.queue.wait_one()
+        self.assertEqual(len(self.queue), 1)
+        with self.assertRaises(ValueError):
+            await self.queue.wait_one()
+        self.assertFalse(self.queue)
+
+    def test_several_exceptions(self):
+        self.run_until_complete(self.do_test_several_exceptions())
+
+    async def do_test_cancel(self):
+        async def task():
+            await asyncio.sleep(1)
+
+        tasks = [self.queue.submit(task()) for _ in range(2)]
+        await self.queue.cancel()
+        self.assertFalse(self.queue)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+
+    def test_cancel(self):
+        self.run_until_complete(self.do_test_cancel())
@@ -0,0 +1,386 @@
+import os
+import sys
+import site
+import shutil
+import hashlib
+import logging
+import tempfile
+import sysconfig
+import functools
+import importlib
+import subprocess
+
+
+__all__ = ["BitstreamCache", "toolchain_salt", "elaboration_key"]
+
+logger = logging.getLogger(__name__)
+
+
+_TOOLCHAIN = [
+    ("yosys",         ["-V"]),
+    ("arachne-pnr",   ["--version"]),
+    ("nextpnr-ice40", ["--version"]),
+    ("icepack",       None),
+]
+
+
+@functools.lru_cache()
+def toolchain_salt():
+    """
+    Return a digest of the versions of the FPGA toolchain found in ``PATH``.
+
+    Bitstreams built by different toolchain versions from the same Verilog may differ, so
+    the salt is a part of the cache key.
+    """
+    digest = hashlib.sha256()
+    for tool, version_args in _TOOLCHAIN:
+        path = shutil.which(tool)
+        if path is None:
+            version = "missing"
+        elif version_args is None:
+            version = "present"
+        else:
+            try:
+                version = subprocess.run([path, *version_args], timeout=10,
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         stdin=subprocess.DEVNULL).stdout.decode("utf-8", "replace")
+            except (OSError, subprocess.SubprocessError):
+                version = "unknown"
+        logger.trace("toolchain %s version: %s", tool, version.strip())
+        digest.update("{}\0{}\0".format(tool, version).encode("utf-8"))
+    return digest.digest()[:8]
+
+
+def _is_installed(path):
+    site_dirs = {sysconfig.get_paths()[name] for name in ("purelib", "platlib")}
+    if site.ENABLE_USER_SITE and site.USER_SITE:
+        site_dirs.add(site.USER_SITE)
+    path = os.path.realpath(path)
+    for site_dir in map(os.path.realpath, site_dirs):
+        if os.path.commonpath([path, site_dir]) == site_dir:
+            return True
+    return False
+
+
+@functools.lru_cache()
+def _package_fingerprint(package):
+    digest = hashlib.sha256()
+    module = importlib.import_module(package)
+    root = os.path.dirname(module.__file__)
+    if _is_installed(root):
+        # Installed packages only change when they are reinstalled, which replaces their files,
+        # so there is no need to look at every one of them.
+        stat = os.stat(module.__file__)
+        digest.update("{}\0{}\0{}\0".format(getattr(module, "__version__", ""), root,
+                                             stat.st_mtime_ns).encode("utf-8"))
+        return digest.digest()
+
+    # Files in a source checkout may be edited in place, which does not change the mtime
+    # of their directory.
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            digest.update("{}\0{}\0{}\0".format(os.path.relpath(path, root),
+                                                stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+    return digest.digest()
+
+
+def _encode_key_part(part):
+    if part is None or type(part) in (bool, int, float, str, bytes):
+        return repr(part)
+    if type(part) in (list, tuple):
+        return "{}({})".format(type(part).__name__, ",".join(map(_encode_key_part, part)))
+    if type(part) is dict:
+        return "dict({})".format(",".join(sorted("{}:{}".format(_encode_key_part(key),
+                                                                 _encode_key_part(value))
+                                                 for key, value in part.items())))
+    raise TypeError("cannot use {!r} of type {} in an elaboration key"
+                    .format(part, type(part).__name__))
+
+
+def elaboration_key(*parts):
+    """
+    Return a key identifying a design by ``parts`` (e.g. applet name and build arguments),
+    without elaborating it.
+
+    Every part must be ``None``, a ``bool``, ``int``, ``float``, ``str`` or ``bytes``, or
+    a ``list``, ``tuple`` or ``dict`` of those; any other value raises ``TypeError``, since
+    its representation might not be the same in another process.
+
+    The key also covers Glasgow and migen, so that it changes whenever a different version
+    of either is used, including during development.
+    """
+    digest = hashlib.sha256()
+    digest.update(_encode_key_part(parts).encode("utf-8"))
+    digest.update(_package_fingerprint("glasgow"))
+    digest.update(_package_fingerprint("migen"))
+    return digest.digest()[:16]
+
+
+def _user_cache_dir():
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+        return os.path.join(base, "glasgow", "Cache")
+    elif sys.platform == "darwin":
+        return os.path.expanduser("~/Library/Caches/glasgow")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(base, "glasgow")
+
+
+class BitstreamCache:
+    """
+    An on-disk cache of bitstreams, addressed by bitstream ID and toolchain salt.
+
+    Entries are evicted in least recently used order once the total size of the cache exceeds
+    ``max_size`` bytes. The cache is stored in ``path``, or if it is ``None``, in
+    the ``GLASGOW_CACHE_DIR`` environment variable or the user's cache directory.
+    """
+    max_size = 64 << 20
+
+    def __init__(self, path=None, max_size=None, salt=None):
+        if path is None:
+            path = os.environ.get("GLASGOW_CACHE_DIR") or _user_cache_dir()
+            path = os.path.join(path, "bitstreams")
+        if max_size is not None:
+            self.max_size = max_size
+        self.path  = path
+        self._salt = salt
+
+    @property
+    def salt(self):
+        if self._salt is None:
+            self._salt = toolchain_salt()
+        return self._salt
+
+    def _filename(self, bitstream_id, salt=None):
+        return os.path.join(self.path, "{}-{}.bin".format(bitstream_id.hex(),
+                                                          (salt or self.salt).hex()))
+
+    def get(self, bitstream_id):
+        """Return the cached bitstream with ID ``bitstream_id``, or ``None`` on a miss."""
+        filename = self._filename(bitstream_id)
+        try:
+            with open(filename, "rb") as f:
+                bitstream = f.read()
+            os.utime(filename)
+        except OSError:
+            logger.debug("bitstream ID %s not in cache", bitstream_id.hex())
+            return None
+        logger.debug("bitstream ID %s found in cache", bitstream_id.hex())
+        return bitstream
+
+    def put(self, bitstream_id, bitstream):
+        """Store ``bitstream`` with ID ``bitstream_id``, and evict old entries if necessary."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, temp_filename = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(bitstream)
+                os.replace(temp_filename, self._filename(bitstream_id))
+            except:
+                os.unlink(temp_filename)
+                raise
+        except OSError as e:
+            logger.warning("cannot store bitstream ID %s in cache: %s", bitstream_id.hex(), e)
+            return
+        logger.debug("bitstream ID %s stored in cache", bitstream_id.hex())
+        self.prune()
+
+    def _index_filename(self, key):
+        return os.path.join(self.path, "index", key.hex())
+
+    def get_bitstream_id(self, key):
+        """
+        Return the bitstream ID last recorded for elaboration key ``key``, or ``None``
+        if there is none.
+        """
+        try:
+            with open(self._index_filename(key), "r") as f:
+                return bytes.fromhex(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put_bitstream_id(self, key, bitstream_id):
+        """Record ``bitstream_id`` as the bitstream ID for elaboration key ``key``."""
+        filename = self._index_filename(key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + ".tmp", "w") as f:
+                f.write(bitstream_id.hex())
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logger.warning("cannot record bitstream ID %s in index: %s", bitstream_id.hex(), e)
+
+    def _seed_filename(self, bitstream_id):
+        return os.path.join(self.path, "seeds", "{}-{}".format(bitstream_id.hex(),
+                                                               self.salt.hex()))
+
+    def get_seed(self, bitstream_id):
+        """
+        Return the place and route seed recorded for bitstream ID ``bitstream_id``, or ``None``
+        if there is none.
+        """
+        try:
+            with open(self._seed_filename(bitstream_id), "r") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put_seed(self, bitstream_id, seed):
+        """Record ``seed`` as the place and route seed for bitstream ID ``bitstream_id``."""
+        filename = self._seed_filename(bitstream_id)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + ".tmp", "w") as f:
+                f.write(str(seed))
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logger.warning("cannot record seed for bitstream ID %s: %s", bitstream_id.hex(), e)
+
+    def entries(self):
+        """
+        Return a list of ``(bitstream_id, salt, size, atime)`` tuples for every cache entry,
+        most recently used first.
+        """
+        try:
+            filenames = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        for filename in filenames:
+            name, ext = os.path.splitext(filename)
+            if ext != ".bin" or name.count("-") != 1:
+                continue
+            bitstream_id, salt = name.split("-")
+            try:
+                stat = os.stat(os.path.join(self.path, filename))
+                entries.append((bytes.fromhex(bitstream_id), bytes.fromhex(salt),
+                                stat.st_size, stat.st_mtime))
+            except (OSError, ValueError):
+                continue
+        entries.sort(key=lambda entry: entry[3], reverse=True)
+        return entries
+
+    def prune(self, max_size=None, stale=False):
+        """
+        Evict least recently used entries until the cache is no larger than ``max_size``
+        (or :attr:`max_size`), as well as, if ``stale`` is true, every entry built by
+        a different toolchain. Returns the amount of evicted entries.
+
+        Recorded place and route seeds are kept, unless ``max_size`` is zero.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size == 0:
+            shutil.rmtree(os.path.join(self.path, "index"), ignore_errors=True)
+            shutil.rmtree(os.path.join(self.path, "seeds"), ignore_errors=True)
+
+        evicted = 0
+        total_size = 0
+        for bitstream_id, salt, size, atime in self.entries():
+            if total_size + size <= max_size and not (stale and salt != self.salt):
+                total_size += size
+                continue
+            try:
+                os.unlink(self._filename(bitstream_id, salt))
+                evicted += 1
+                logger.debug("bitstream ID %s evicted from cache", bitstream_id.hex())
+            except FileNotFoundError:
+                pass
+        return evicted
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import unittest.mock
+
+
+class BitstreamCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.cache   = BitstreamCache(self.tempdir.name, max_size=10, salt=b"\x01")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(b"\xaa"))
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_hit(self):
+        self.cache.put(b"\xaa", b"abcd")
+        self.assertEqual(self.cache.get(b"\xaa"), b"abcd")
+        (bitstream_id, salt, size, atime), = self.cache.entries()
+        self.assertEqual((bitstream_id, salt, size), (b"\xaa", b"\x01", 4))
+
+    def test_salt(self):
+        self.cache.put(b"\xaa", b"abcd")
+        other = BitstreamCache(self.tempdir.name, salt=b"\x02")
+        self.assertIsNone(other.get(b"\xaa"))
+        self.assertEqual(other.prune(stale=True), 1)
+        self.assertIsNone(self.cache.get(b"\xaa"))
+
+    def test_lru(self):
+        self.cache.put(b"\xaa", b"abcd")
+        os.utime(self.cache._filename(b"\xaa"), (1, 1))
+        self.cache.put(b"\xbb", b"efgh")
+        os.utime(self.cache._filename(b"\xbb"), (2, 2))
+        self.cache.get(b"\xaa")
+        self.cache.put(b"\xcc", b"ijkl")
+        self.assertEqual(self.cache.get(b"\xaa"), b"abcd")
+        self.assertIsNone(self.cache.get(b"\xbb"))
+        self.assertEqual(self.cache.get(b"\xcc"), b"ijkl")
+
+    def test_index(self):
+        self.assertIsNone(self.cache.get_bitstream_id(b"\x11"))
+        self.cache.put_bitstream_id(b"\x11", b"\xaa\xbb")
+        self.assertEqual(self.cache.get_bitstream_id(b"\x11"), b"\xaa\xbb")
+        self.cache.prune(max_size=0)
+        self.assertIsNone(self.cache.get_bitstream_id(b"\x11"))
+
+    def test_seed(self):
+        self.assertIsNone(self.cache.get_seed(b"\xaa"))
+        self.cache.put_seed(b"\xaa", 7)
+        self.assertEqual(self.cache.get_seed(b"\xaa"), 7)
+        other = BitstreamCache(self.tempdir.name, salt=b"\x02")
+        self.assertIsNone(other.get_seed(b"\xaa"))
+        self.cache.prune(max_size=0)
+        self.assertIsNone(self.cache.get_seed(b"\xaa"))
+
+    def test_elaboration_key(self):
+        self.assertEqual(elaboration_key("uart", [("baud", 115200)]),
+                         elaboration_key("uart", [("baud", 115200)]))
+        self.assertNotEqual(elaboration_key("uart", [("baud", 115200)]),
+                            elaboration_key("uart", [("baud", 9600)]))
+
+    def test_elaboration_key_types(self):
+        self.assertNotEqual(elaboration_key([1, 2]), elaboration_key((1, 2)))
+        self.assertNotEqual(elaboration_key(1), elaboration_key(True))
+        self.assertEqual(elaboration_key({"a": 1, "b": None}),
+                         elaboration_key({"b": None, "a": 1}))
+        with self.assertRaisesRegex(TypeError,
+                r"^cannot use <object object at 0x[0-9a-f]+> of type object in "
+                r"an elaboration key$"):
+            elaboration_key("uart", [("file", object())])
+
+    def test_installed_package_fingerprint(self):
+        if not _is_installed(os.path.dirname(importlib.import_module("migen").__file__)):
+            self.skipTest("migen is not installed")
+        _package_fingerprint.cache_clear()
+        try:
+            with unittest.mock.patch("os.walk", side_effect=AssertionError):
+                self.assertEqual(len(_package_fingerprint("migen")), 32)
+        finally:
+            _package_fingerprint.cache_clear()
+
+    def test_prune_all(self):
+        self.cache.put(b"\xaa", b"abcd")
+        self.assertEqual(self.cache.prune(max_size=0), 1)
+        self.assertEqual(self.cache.entries(), [])
@@ -1,4 +1,5 @@
 import hashlib
+import logging
 import os
 import sys
 import tempfile
@@ -11,6 +12,7 @@ from ..gateware.registers import I2CRegisters
 from ..gateware.fx2 import FX2Arbiter
 from ..platform import GlasgowPlatform
 from .analyzer import GlasgowAnalyzer
+from .pnr import run_seed_sweep
 
 
 __all__ = ["GlasgowHardwareTarget"]
@@ -90,21 +92,52 @@ class GlasgowHardwareTarget(Module):
             return self._fragment
         return super().get_fragment()
 
-    def build(self, **kwargs):
-        self.platform.build(self, **kwargs)
+    def build(self, seeds=None, jobs=None, **kwargs):
+        if seeds is None:
+            self.platform.build(self, **kwargs)
+        else:
+            self.platform.build(self, run=False, **kwargs)
+            return run_seed_sweep(kwargs["build_dir"], seeds, jobs)
 
     def get_verilog(self, **kwargs):
-        return self.platform.get_verilog(self)
+        # Pass the fragment rather than the module itself so that the result is reused
+        # by the platform when building the bitstream.
+        return self.platform.get_verilog(self.get_fragment())
 
     def get_bitstream_id(self, **kwargs):
         verilog = str(self.get_verilog(**kwargs))
         return hashlib.sha256(verilog.encode("utf-8")).digest()[:16]
 
-    def get_bitstream(self, build_dir=None, debug=False, **kwargs):
+    def get_bitstream(self, build_dir=None, debug=False, cache=None, seeds=None, jobs=None,
+                      **kwargs):
+        """
+        Build the design and return the bitstream.
+
+        If ``seeds`` is not ``None``, place and route is done once for each of the first ``seeds``
+        seeds, and the result with the best Fmax margin is used. If ``cache`` is provided, the seed
+        is recorded in it, and any later build of the same design uses the recorded seed. A cached
+        bitstream that was built without choosing a seed is only used if ``seeds`` is ``None``.
+        """
+        seed = None
+        if cache is not None:
+            bitstream_id = self.get_bitstream_id()
+            seed = cache.get_seed(bitstream_id)
+            if seed is not None or seeds is None:
+                bitstream = cache.get(bitstream_id)
+                if bitstream is not None:
+                    return bitstream
+
         if build_dir is None:
             build_dir = tempfile.mkdtemp(prefix="glasgow_")
         try:
-            self.build(build_dir=build_dir)
+            if seed is not None:
+                self.build(build_dir=build_dir, seeds=[seed])
+            elif seeds is not None:
+                seed = self.build(build_dir=build_dir, seeds=range(1, seeds + 1), jobs=jobs)
+                if cache is not None:
+                    cache.put_seed(bitstream_id, seed)
+            else:
+                self.build(build_dir=build_dir)
             with open(os.path.join(build_dir, "top.bin"), "rb") as f:
                 bitstream = f.read()
             if debug:
@@ -116,9 +149,83 @@ class GlasgowHardwareTarget(Module):
         finally:
             if not debug:
                 shutil.rmtree(build_dir)
+
+        if cache is not None:
+            cache.put(bitstream_id, bitstream)
         return bitstream
 
     def get_build_tree(self, **kwargs):
         build_dir = tempfile.TemporaryDirectory(prefix="glasgow_")
         self.build(build_dir=build_dir.name, run=False)
         return build_dir
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+import unittest.mock
+
+from ..applet import GlasgowAppletError
+from .cache import BitstreamCache
+
+
+class GlasgowHardwareTargetTestCase(unittest.TestCase):
+    def test_verilog_reused(self):
+        target = GlasgowHardwareTarget()
+        verilog = target.get_verilog()
+        self.assertIs(target.get_verilog(), verilog)
+        with target.get_build_tree() as build_dir:
+            with open(os.path.join(build_dir, "top.v")) as f:
+                self.assertEqual(f.read(), verilog.main_source)
+
+    def test_bitstream_cache_seeds(self):
+        def build(build_dir, seeds=None, jobs=None):
+            with open(os.path.join(build_dir, "top.bin"), "wb") as f:
+                f.write(b"seeds" if seeds else b"plain")
+            if seeds is not None:
+                return 3
+
+        target = GlasgowHardwareTarget()
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                unittest.mock.patch.object(target, "build", side_effect=build) as mock_build:
+            cache = BitstreamCache(cache_dir, salt=b"\x01")
+            self.assertEqual(target.get_bitstream(cache=cache), b"plain")
+            self.assertEqual(target.get_bitstream(cache=cache), b"plain")
+            self.assertEqual(mock_build.call_count, 1)
+            # A bitstream built without a seed sweep does not satisfy a request for one.
+            self.assertEqual(target.get_bitstream(cache=cache, seeds=4), b"seeds")
+            self.assertEqual(mock_build.call_args[1]["seeds"], range(1, 5))
+            self.assertEqual(cache.get_seed(target.get_bitstream_id()), 3)
+            self.assertEqual(target.get_bitstream(cache=cache, seeds=4), b"seeds")
+            self.assertEqual(mock_build.call_count, 2)
+
+    def test_two_interfaces(self):
+        from argparse import Namespace
+        from ..access.direct import DirectMultiplexer
+
+        class applet:
+            logger = logging.getLogger(__name__)
+
+        target = GlasgowHardwareTarget(multiplexer_cls=DirectMultiplexer)
+        iface_a = target.multiplexer.claim_interface(applet, Namespace(port_spec="A"))
+        self.assertTrue(target.multiplexer.single_interface)
+        iface_b = target.multiplexer.claim_interface(applet, Namespace(port_spec="B"))
+        self.assertFalse(target.multiplexer.single_interface)
+        self.assertEqual((iface_a._fifo_num, iface_b._fifo_num), (0, 1))
+        self.assertEqual((iface_a.get_pin_name(0), iface_b.get_pin_name(0)), ("A0", "B0"))
+
+    def test_port_claimed_twice(self):
+        from argparse import Namespace
+        from ..access.direct import DirectMultiplexer
+
+        class applet:
+            logger = logging.getLogger(__name__)
+
+        target = GlasgowHardwareTarget(multiplexer_cls=DirectMultiplexer)
+        self.assertIsNotNone(target.multiplexer.claim_interface(applet, Namespace(port_spec="AB")))
+        with self.assertRaisesRegex(GlasgowAppletError,
+                r"^cannot claim port\(s\) B: port\(s\) B already claimed$"):
+            target.multiplexer.claim_interface(applet, Namespace(port_spec="B"))
+        with self.assertRaisesRegex(GlasgowAppletError, r"^port C does not exist$"):
+            target.multiplexer.claim_interface(applet, Namespace(port_spec="C"))
+        # Rejected claims do not use up a FIFO.
+        self.assertTrue(target.multiplexer.single_interface)
@@ -0,0 +1,210 @@
+import os
+import re
+import shlex
+import shutil
+import logging
+import subprocess
+import concurrent.futures
+
+
+__all__ = ["parse_fmax_margin", "run_seed_sweep"]
+
+logger = logging.getLogger(__name__)
+
+
+_NEXTPNR_FMAX = re.compile(r"Max frequency for clock\s+'([^']*)':\s+([\d.]+) MHz"
+                           r"\s+\((?:PASS|FAIL) at ([\d.]+) MHz\)")
+_ICETIME_FMAX = re.compile(r"Total path delay:\s+[\d.]+ ns \(([\d.]+) MHz\)")
+
+
+def parse_fmax_margin(report, target=None):
+    """
+    Return the smallest difference between the achieved and the required clock frequency,
+    in MHz, found in a nextpnr log or an icetime ``report``, or ``None`` if there is none.
+
+    icetime reports do not include the required frequency, so it has to be passed as ``target``.
+    """
+    margins = {}
+    # nextpnr reports timing several times during the flow; only the last report for each
+    # clock describes the routed design.
+    for clock, fmax, required in _NEXTPNR_FMAX.findall(report):
+        margins[clock] = float(fmax) - float(required)
+    if target is not None:
+        for fmax in _ICETIME_FMAX.findall(report):
+            margins[None] = float(fmax) - target
+    if not margins:
+        return None
+    return min(margins.values())
+
+
+def _read_build_script(build_dir, build_name):
+    for script_name in ("build_{}.sh".format(build_name), "build_{}.bat".format(build_name)):
+        try:
+            with open(os.path.join(build_dir, script_name)) as f:
+                lines = f.read().splitlines()
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        raise FileNotFoundError("build script not found in {}".format(build_dir))
+
+    commands = []
+    for line in lines:
+        argv = shlex.split(line, comments=True)
+        if argv and argv[0] in ("yosys", "arachne-pnr", "nextpnr-ice40", "icetime", "icepack"):
+            commands.append(argv)
+    return commands
+
+
+def _run(argv, cwd):
+    logger.trace("running %s", " ".join(map(shlex.quote, argv)))
+    result = subprocess.run(argv, cwd=cwd, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = result.stdout.decode("utf-8", "replace")
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, argv, output)
+    return output
+
+
+def _rename(argv, renames):
+    return [renames.get(arg, arg) for arg in argv]
+
+
+def _icetime_target(icetime_argv):
+    # The required frequency is only passed to icetime if the platform specifies one.
+    for index, arg in enumerate(icetime_argv):
+        if arg == "-c" and index + 1 < len(icetime_argv):
+            value = icetime_argv[index + 1]
+        elif arg.startswith("-c") and len(arg) > 2:
+            value = arg[2:]
+        else:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def _run_seed(build_dir, build_name, seed, pnr_argv, icetime_argv, icetime_target):
+    asc_name = "{}.txt".format(build_name)
+    renames  = {
+        asc_name:                     "{}_seed{}.txt".format(build_name, seed),
+        "{}.tim".format(build_name):  "{}_seed{}.tim".format(build_name, seed),
+    }
+
+    pnr_argv = _rename(pnr_argv, renames)
+    if pnr_argv[0] == "arachne-pnr":
+        pnr_argv += ["-s", str(seed)]
+    else:
+        pnr_argv += ["--seed", str(seed)]
+    report = _run(pnr_argv, build_dir)
+
+    if icetime_argv is not None:
+        report += _run(_rename(icetime_argv, renames), build_dir)
+
+    with open(os.path.join(build_dir, "{}_seed{}.log".format(build_name, seed)), "w") as f:
+        f.write(report)
+    return parse_fmax_margin(report, icetime_target)
+
+
+def run_seed_sweep(build_dir, seeds, jobs=None, build_name="top"):
+    """
+    Run the build script generated by migen in ``build_dir``, placing and routing the design
+    once for every seed in ``seeds`` with at most ``jobs`` concurrent place-and-route processes,
+    and pack the result with the best Fmax margin into ``{build_name}.bin``.
+
+    Synthesis does not depend on the seed, so it is only done once. Returns the winning seed.
+
+    If the timing analysis is done by icetime without a required frequency, the seed with
+    the best Fmax is chosen instead.
+    """
+    seeds = list(seeds)
+    if not seeds:
+        raise ValueError("at least one seed is required")
+
+    commands = _read_build_script(build_dir, build_name)
+    pnr_index, pnr_argv = next((index, argv) for index, argv in enumerate(commands)
+                               if argv[0] in ("arachne-pnr", "nextpnr-ice40"))
+    icetime_argv   = next((argv for argv in commands if argv[0] == "icetime"), None)
+    icetime_target = None
+    if icetime_argv is not None:
+        icetime_target = _icetime_target(icetime_argv)
+        if icetime_target is None:
+            logger.info("icetime has no required frequency, comparing seeds by Fmax")
+            # With a required frequency of zero, the margin is the Fmax itself.
+            icetime_target = 0.0
+
+    for argv in commands[:pnr_index]:
+        _run(argv, build_dir)
+
+    margins = {}
+    errors  = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = {executor.submit(_run_seed, build_dir, build_name, seed, pnr_argv,
+                                   icetime_argv, icetime_target):
+                   seed for seed in seeds}
+        for future in concurrent.futures.as_completed(futures):
+            seed = futures[future]
+            try:
+                margins[seed] = future.result()
+            except subprocess.CalledProcessError as e:
+                logger.warning("place and route with seed %d failed", seed)
+                errors[seed] = e
+                continue
+            if margins[seed] is None:
+                logger.info("seed %d: no timing report", seed)
+            elif icetime_target == 0.0:
+                logger.info("seed %d: Fmax %.2f MHz", seed, margins[seed])
+            else:
+                logger.info("seed %d: Fmax margin %+.2f MHz", seed, margins[seed])
+
+    if not margins:
+        raise errors[seeds[0]]
+    # Prefer the lowest seed among equally good ones, so that the choice is reproducible.
+    best_seed = max(sorted(margins),
+                    key=lambda seed: float("-inf") if margins[seed] is None else margins[seed])
+    logger.info("using seed %d", best_seed)
+
+    shutil.copyfile(os.path.join(build_dir, "{}_seed{}.txt".format(build_name, best_seed)),
+                    os.path.join(build_dir, "{}.txt".format(build_name)))
+    for argv in commands[pnr_index + 1:]:
+        if argv[0] != "icetime":
+            _run(argv, build_dir)
+    return best_seed
+
+# -------------------------------------------------------------------------------------------------
+
+import unittest
+
+
+class ParseFmaxMarginTestCase(unittest.TestCase):
+    def test_nextpnr(self):
+        report = (
+            "Info: Max frequency for clock 'clk$glb_clk': 40.00 MHz (PASS at 30.00 MHz)\n"
+            "Info: Max frequency for clock 'clk$glb_clk': 45.50 MHz (PASS at 30.00 MHz)\n"
+            "Info: Max frequency for clock 'por_clk': 28.00 MHz (FAIL at 30.00 MHz)\n"
+        )
+        self.assertEqual(parse_fmax_margin(report), -2.0)
+        self.assertEqual(parse_fmax_margin(report.splitlines()[1]), 15.5)
+
+    def test_icetime(self):
+        report = "Total path delay: 25.00 ns (40.00 MHz)\n"
+        self.assertEqual(parse_fmax_margin(report, target=30.0), 10.0)
+        self.assertIsNone(parse_fmax_margin(report))
+
+    def test_none(self):
+        self.assertIsNone(parse_fmax_margin("Info: Program finished normally.\n"))
+
+
+class RunSeedSweepTestCase(unittest.TestCase):
+    def test_icetime_target(self):
+        self.assertEqual(_icetime_target(["icetime", "-tmd", "hx8k", "-c", "30", "top.txt"]),
+                         30.0)
+        self.assertEqual(_icetime_target(["icetime", "-c30.5", "top.txt"]), 30.5)
+        self.assertIsNone(_icetime_target(["icetime", "-tmd", "hx8k", "top.txt"]))
+        self.assertIsNone(_icetime_target(["icetime", "-c"]))
+
+    def test_no_seeds(self):
+        with self.assertRaisesRegex(ValueError, r"^at least one seed is required$"):
+            run_seed_sweep("/nonexistent", range(1, 1))
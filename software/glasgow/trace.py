@@ -0,0 +1,935 @@
+import io
+import os
+import json
+import time
+import queue
+import bisect
+import shutil
+import asyncio
+import logging
+import tempfile
+import functools
+import threading
+import subprocess
+from fractions import Fraction
+
+from .gateware.analyzer import EventSource, TraceDecoder, TraceColumns, TRACE_THROTTLE
+
+
+__all__ = ["trace_header_filename", "write_trace_header", "read_trace_header"]
+__all__ += ["TraceWriterError", "TraceVCDWriter", "TraceFSTWriter", "TraceRawWriter"]
+__all__ += ["TraceWriterThread"]
+__all__ += ["TRACE_FORMATS", "trace_format", "open_trace_writer"]
+__all__ += ["trace_index_filename", "TraceIndex", "decode_trace", "query_trace"]
+
+logger = logging.getLogger(__name__)
+
+
+_TRACE_FORMAT  = "glasgow-analyzer-trace"
+_TRACE_VERSION = 1
+_INDEX_FORMAT  = "glasgow-analyzer-trace-index"
+_INDEX_VERSION = 1
+
+
+def trace_header_filename(filename):
+    """Return the name of the header file that describes the raw analyzer trace ``filename``."""
+    return filename + ".json"
+
+
+def write_trace_header(filename, event_sources, sys_clk_freq, bitstream_id):
+    """
+    Write the header for the raw analyzer trace ``filename``, recorded with the event sources
+    ``event_sources`` by a design clocked at ``sys_clk_freq`` with ID ``bitstream_id``.
+    """
+    header = {
+        "format":        _TRACE_FORMAT,
+        "version":       _TRACE_VERSION,
+        "bitstream_id":  bitstream_id.hex(),
+        "sys_clk_freq":  sys_clk_freq,
+        "event_sources": [
+            {
+                "name":   event_src.name,
+                "kind":   event_src.kind,
+                "width":  event_src.width,
+                "fields": [list(field) for field in event_src.fields],
+                "depth":  event_src.depth,
+            }
+            for event_src in event_sources
+        ],
+    }
+    with open(trace_header_filename(filename), "w") as f:
+        json.dump(header, f, indent=2)
+        f.write("\n")
+
+
+def read_trace_header(filename):
+    """
+    Read the header for the raw analyzer trace ``filename``, and return a dictionary with
+    the ``event_sources``, ``sys_clk_freq`` and ``bitstream_id`` it was recorded with.
+    """
+    header_filename = trace_header_filename(filename)
+    with open(header_filename) as f:
+        header = json.load(f)
+    if header.get("format") != _TRACE_FORMAT or header.get("version") != _TRACE_VERSION:
+        raise ValueError("{} is not a version {} analyzer trace header"
+                         .format(header_filename, _TRACE_VERSION))
+
+    return {
+        "bitstream_id":  bytes.fromhex(header["bitstream_id"]),
+        "sys_clk_freq":  header["sys_clk_freq"],
+        "event_sources": [
+            EventSource(source["name"], source["kind"], source["width"],
+                        tuple(tuple(field) for field in source["fields"]), source["depth"])
+            for source in header["event_sources"]
+        ],
+    }
+
+
+TRACE_FORMATS = ("vcd", "fst")
+
+
+def trace_format(filename):
+    """Return the trace format implied by the extension of ``filename``."""
+    if os.path.splitext(filename)[1].lower() == ".fst":
+        return "fst"
+    return "vcd"
+
+
+class TraceWriterError(Exception):
+    pass
+
+
+class TraceVCDWriter:
+    """
+    A writer that converts the events decoded by ``decoder`` from the trace of a design clocked
+    at ``sys_clk_freq`` into a VCD file ``file``, which is either a file name or a text file.
+
+    The file is only flushed when :meth:`flush` or :meth:`close` is called.
+    """
+    def __init__(self, file, decoder, sys_clk_freq, comment="", logger=logger):
+        from vcd import VCDWriter
+
+        if isinstance(file, str):
+            self._file = file = open(file, "w")
+        else:
+            self._file = None
+
+        self.sys_clk_freq = sys_clk_freq
+        self.logger       = logger
+
+        # The timestamp of a cycle in nanoseconds is ``cycle * num // den``; integer arithmetic
+        # is both faster and exact for any cycle count.
+        period = Fraction(10 ** 9) / Fraction(sys_clk_freq).limit_denominator()
+        self._period_num = period.numerator
+        self._period_den = period.denominator
+
+        self._decoder = decoder
+
+        self._writer  = VCDWriter(file, timescale="1 ns", check_values=False, comment=comment)
+        self._signals = {}
+        self._strobes = set()
+        for field_name, field_trigger, field_width in decoder.events():
+            if field_trigger == "throttle":
+                var_type = "wire"
+                var_init = 0
+            elif field_trigger == "change":
+                var_type = "wire"
+                var_init = "x"
+            elif field_trigger == "strobe":
+                if field_width > 0:
+                    var_type = "tri"
+                    var_init = "z"
+                else:
+                    var_type = "event"
+                    var_init = ""
+            else:
+                assert False
+            self._signals[field_name] = self._writer.register_var(
+                scope="", name=field_name, var_type=var_type,
+                size=field_width, init=var_init)
+            if field_trigger == "strobe":
+                self._strobes.add(field_name)
+
+        self._init           = True
+        self._timestamp      = 0
+        self._next_timestamp = 0
+
+    def write(self, batch):
+        """
+        Write the events in ``batch``, either a timeline or :class:`TraceColumns` returned by
+        :meth:`TraceDecoder.flush`. Returns ``False`` if the trace overran, in which case
+        nothing else should be written.
+        """
+        if isinstance(batch, TraceColumns):
+            batch = self._decoder.expand(batch)
+
+        num, den = self._period_num, self._period_den
+        for cycle, events in batch:
+            if events == "overrun":
+                for signal in self._signals.values():
+                    self._writer.change(signal, self._next_timestamp, "x")
+                self._timestamp += 1000 # 1us
+                return False
+
+            if self.logger.isEnabledFor(logging.TRACE):
+                self.logger.trace("cycle %d: %s", cycle,
+                                  " ".join("{}={}".format(n, v) for n, v in events.items()))
+
+            self._timestamp      = timestamp      = (cycle + 0) * num // den
+            self._next_timestamp = next_timestamp = (cycle + 1) * num // den
+            if self._init:
+                self._init = False
+                self._writer._timestamp = timestamp
+            for name, value in events.items():
+                self._writer.change(self._signals[name], timestamp, value)
+            for name, _value in events.items():
+                if name in self._strobes:
+                    self._writer.change(self._signals[name], next_timestamp, "z")
+        return True
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close(self._timestamp)
+        if self._file is not None:
+            self._file.close()
+
+
+_VCD2FST_PROBE = """\
+$timescale 1 ns $end
+$scope module probe $end
+$var wire 1 ! probe $end
+$upscope $end
+$enddefinitions $end
+#0
+0!
+#1
+1!
+"""
+
+
+def _run_vcd2fst(argv, **kwargs):
+    try:
+        result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                timeout=60, **kwargs)
+    except (OSError, subprocess.SubprocessError) as e:
+        return str(e)
+    if result.returncode != 0:
+        return "exited with status {}: {}".format(
+            result.returncode, result.stdout.decode("utf-8", "replace").strip())
+    if not os.path.exists(argv[-1]) or os.path.getsize(argv[-1]) == 0:
+        return "did not write {}".format(argv[-1])
+    return None
+
+
+@functools.lru_cache()
+def _probe_vcd2fst(vcd2fst):
+    # Some builds of vcd2fst cannot read VCD data from standard input, and some do not work
+    # at all, so find that out before capturing a trace that could not be converted.
+    with tempfile.TemporaryDirectory() as tempdir:
+        vcd_filename = os.path.join(tempdir, "probe.vcd")
+        fst_filename = os.path.join(tempdir, "probe.fst")
+        error = _run_vcd2fst([vcd2fst, "-", fst_filename],
+                             input=_VCD2FST_PROBE.encode("ascii"))
+        if error is None:
+            return True
+        logger.debug("%s cannot read from standard input: %s", vcd2fst, error)
+
+        with open(vcd_filename, "w") as f:
+            f.write(_VCD2FST_PROBE)
+        error = _run_vcd2fst([vcd2fst, vcd_filename, fst_filename], stdin=subprocess.DEVNULL)
+        if error is None:
+            return False
+        raise TraceWriterError("{} cannot convert VCD files: {}".format(vcd2fst, error))
+
+
+class TraceFSTWriter(TraceVCDWriter):
+    """
+    A writer like :class:`TraceVCDWriter`, except that it writes an FST file ``filename``, which
+    is much smaller and loads much faster in GTKWave than the equivalent VCD file.
+
+    The file is converted by ``vcd2fst`` from GTKWave, which must be in ``PATH``; it is checked
+    to work when the writer is created. The VCD data is streamed through ``vcd2fst`` if it can
+    read standard input, and otherwise written to a temporary VCD file next to ``filename``
+    first.
+    """
+    def __init__(self, filename, decoder, sys_clk_freq, comment="", logger=logger):
+        vcd2fst = shutil.which("vcd2fst")
+        if vcd2fst is None:
+            raise TraceWriterError("writing FST files requires vcd2fst from GTKWave")
+
+        self._vcd2fst  = vcd2fst
+        self._filename = filename
+        if _probe_vcd2fst(vcd2fst):
+            self._vcd_filename = None
+            self._process = subprocess.Popen([vcd2fst, "-", filename],
+                                             stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            file = io.TextIOWrapper(self._process.stdin, encoding="ascii")
+        else:
+            fd, self._vcd_filename = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(filename)), suffix=".vcd")
+            os.close(fd)
+            self._process = None
+            file = self._vcd_filename
+        try:
+            super().__init__(file, decoder, sys_clk_freq, comment, logger)
+        except:
+            self._cleanup()
+            raise
+
+    def _cleanup(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+        if self._vcd_filename is not None:
+            os.unlink(self._vcd_filename)
+
+    def close(self):
+        if self._process is None:
+            try:
+                super().close()
+                error = _run_vcd2fst([self._vcd2fst, self._vcd_filename, self._filename],
+                                     stdin=subprocess.DEVNULL)
+            finally:
+                os.unlink(self._vcd_filename)
+            if error is not None:
+                raise TraceWriterError("vcd2fst {}".format(error))
+            return
+
+        try:
+            super().close()
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self._process.wait()
+        if returncode != 0:
+            raise TraceWriterError("vcd2fst exited with status {}".format(returncode))
+
+
+class TraceRawWriter:
+    """
+    A writer that stores a raw analyzer trace, in the chunks it is received in, into ``file``,
+    a binary file. It is meant to be used with :class:`TraceWriterThread`, which then counts
+    bytes rather than events.
+    """
+    def __init__(self, file, logger=logger):
+        self.logger = logger
+        self._file  = file
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        return True
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def open_trace_writer(filename, decoder, sys_clk_freq, format=None, **kwargs):
+    """
+    Return a writer for the events decoded by ``decoder`` into ``filename``, in ``format``
+    (one of :data:`TRACE_FORMATS`), or if it is ``None``, the format implied by its extension.
+    """
+    if format is None:
+        format = trace_format(filename)
+    if format == "vcd":
+        return TraceVCDWriter(filename, decoder, sys_clk_freq, **kwargs)
+    if format == "fst":
+        return TraceFSTWriter(filename, decoder, sys_clk_freq, **kwargs)
+    raise ValueError("unknown trace format {!r}".format(format))
+
+
+class TraceWriterThread:
+    """
+    Run a trace writer, such as :class:`TraceVCDWriter`, in a background thread, so that
+    the event loop reading the trace never waits for the disk.
+
+    Batches of decoded events are passed to the thread through a queue that holds at most
+    ``max_batches`` of them. The writer is flushed once ``flush_events`` rows or timeline entries
+    were written, or ``flush_interval`` seconds after the first unflushed one, whichever comes
+    first.
+    """
+    def __init__(self, writer, max_batches=64, flush_events=1 << 16, flush_interval=1.0):
+        self.writer         = writer
+        self.flush_events   = flush_events
+        self.flush_interval = flush_interval
+        self.overrun        = False
+
+        self._queue  = queue.Queue(max_batches)
+        self._error  = None
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        unflushed = 0
+        deadline  = None
+        while True:
+            try:
+                if deadline is None:
+                    batch = self._queue.get()
+                else:
+                    batch = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                batch = ()
+            if batch is None:
+                break
+            if self._error is not None or self.overrun:
+                # Keep draining the queue, so that the producer does not get stuck.
+                continue
+
+            try:
+                if len(batch) > 0:
+                    if not self.writer.write(batch):
+                        self.writer.logger.error("FIFO overrun, shutting down")
+                        self.overrun = True
+                    unflushed += len(batch)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_interval
+                if unflushed >= self.flush_events or \
+                        deadline is not None and time.monotonic() >= deadline:
+                    self.writer.flush()
+                    unflushed = 0
+                    deadline  = None
+            except Exception as e:
+                self._error = e
+
+        try:
+            self.writer.close()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+
+    async def put(self, batch):
+        """
+        Queue ``batch`` for writing, waiting (without blocking the event loop) if the queue is
+        full. If the writer raised an exception, stops the thread and reraises it.
+        """
+        if self._error is not None:
+            await self.close()
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            await asyncio.get_event_loop().run_in_executor(None, self._queue.put, batch)
+
+    def _close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    async def close(self):
+        """
+        Write all queued batches, close the writer, and stop the thread. Reraises any exception
+        raised by the writer.
+        """
+        await asyncio.get_event_loop().run_in_executor(None, self._close)
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def trace_index_filename(filename):
+    """Return the name of the index file for the raw analyzer trace ``filename``."""
+    return filename + ".index.json"
+
+
+class TraceIndex:
+    """
+    An index of a raw analyzer trace, which allows decoding it starting near any timestamp.
+
+    The index is a list of checkpoints, at least ``interval`` cycles apart, which are taken by
+    a :class:`TraceDecoder` created with ``checkpoint_interval=interval`` as soon as the interval
+    elapses, independently of the size of the chunks it processes. Every checkpoint is
+    a ``(timestamp, byte_offset, state)`` tuple, where ``byte_offset`` and ``state`` are returned
+    by :meth:`TraceDecoder.flush_checkpoints`, and ``timestamp`` is the timestamp of the last event
+    decoded before ``byte_offset``; every event after ``byte_offset`` happens no earlier than
+    that.
+    """
+    def __init__(self, interval, checkpoints=()):
+        self.interval    = interval
+        self.checkpoints = []
+        self._timestamps = []
+        for checkpoint in checkpoints:
+            self._append(checkpoint)
+
+    def _append(self, checkpoint):
+        self.checkpoints.append(checkpoint)
+        self._timestamps.append(checkpoint[0])
+
+    def update(self, decoder):
+        """
+        Record the checkpoints taken by ``decoder`` since the previous update.
+        """
+        for byte_offset, state in decoder.flush_checkpoints():
+            _, timestamp, _ = state
+            self._append((timestamp, byte_offset, state))
+
+    def find(self, timestamp):
+        """
+        Return the last checkpoint after which no events happening before ``timestamp`` are
+        recorded, or ``None`` if decoding has to start at the beginning of the trace.
+        """
+        index = bisect.bisect_left(self._timestamps, timestamp)
+        if index == 0:
+            return None
+        return self.checkpoints[index - 1]
+
+    def save(self, filename, size):
+        """Write the index for the raw analyzer trace ``filename``, which is ``size`` bytes long."""
+        index = {
+            "format":      _INDEX_FORMAT,
+            "version":     _INDEX_VERSION,
+            "size":        size,
+            "interval":    self.interval,
+            "checkpoints": [[timestamp, byte_offset, state, delay]
+                            for timestamp, byte_offset, (state, _, delay) in self.checkpoints],
+        }
+        with open(trace_index_filename(filename), "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read the index for the raw analyzer trace ``filename``. Returns ``None`` if there is
+        no index, or if it was built for a trace of a different size.
+        """
+        try:
+            with open(trace_index_filename(filename)) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        if index.get("format") != _INDEX_FORMAT or index.get("version") != _INDEX_VERSION:
+            raise ValueError("{} is not a version {} analyzer trace index"
+                             .format(trace_index_filename(filename), _INDEX_VERSION))
+        if index["size"] != os.path.getsize(filename):
+            logger.warning("%s: ignoring index built for a trace of a different size", filename)
+            return None
+        return cls(index["interval"], [(timestamp, byte_offset, (state, timestamp, delay))
+                                       for timestamp, byte_offset, state, delay
+                                       in index["checkpoints"]])
+
+
+def decode_trace(filename, output_filename, format=None, index_interval=None,
+                 chunk_size=1 << 16):
+    """
+    Convert the raw analyzer trace ``filename``, described by its header file, into a trace file
+    ``output_filename`` in ``format`` (see :func:`open_trace_writer`), and write
+    a :class:`TraceIndex` for it with checkpoints ``index_interval`` cycles (by default, 0.1 s)
+    apart. Returns the amount of bytes decoded.
+    """
+    header  = read_trace_header(filename)
+    if index_interval is None:
+        index_interval = int(header["sys_clk_freq"] // 10)
+    decoder = TraceDecoder(header["event_sources"], columnar=True,
+                           checkpoint_interval=index_interval)
+    index   = TraceIndex(index_interval)
+    size    = 0
+    with open(filename, "rb") as f:
+        writer = open_trace_writer(output_filename, decoder, header["sys_clk_freq"], format,
+            comment="Generated by Glasgow for bitstream ID %s" % header["bitstream_id"].hex())
+        try:
+            while not decoder.is_done():
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    logger.warning("%s: trace ends before the analyzer finished", filename)
+                    writer.write(decoder.flush(pending=True))
+                    break
+                size += len(chunk)
+                decoder.process(chunk)
+                index.update(decoder)
+                if not writer.write(decoder.flush()):
+                    logger.error("%s: analyzer FIFO overrun at byte offset %d",
+                                 filename, size)
+                    break
+        finally:
+            writer.close()
+    index.save(filename, os.path.getsize(filename))
+    return size
+
+
+def query_trace(filename, start, stop, source=None, chunk_size=1 << 16):
+    """
+    Decode the events that happened in cycles ``[start, stop)`` of the raw analyzer trace
+    ``filename``, optionally only those from the event source (or ``"throttle"``) named
+    ``source``, and return them as :class:`TraceColumns`.
+
+    If the trace has a :class:`TraceIndex`, decoding starts at the checkpoint nearest to
+    ``start`` instead of at the beginning of the trace.
+    """
+    header  = read_trace_header(filename)
+    decoder = TraceDecoder(header["event_sources"], columnar=True)
+    if source is None:
+        source_index = None
+    elif source == "throttle":
+        source_index = TRACE_THROTTLE
+    else:
+        names = [event_src.name for event_src in header["event_sources"]]
+        if source not in names:
+            raise ValueError("trace {} has no event source {!r}".format(filename, source))
+        source_index = names.index(source)
+
+    index  = TraceIndex.load(filename)
+    result = TraceColumns()
+    with open(filename, "rb") as f:
+        checkpoint = None if index is None else index.find(start)
+        if checkpoint is not None:
+            _, byte_offset, state = checkpoint
+            logger.debug("%s: starting at byte offset %d", filename, byte_offset)
+            decoder.restore_state(byte_offset, state)
+            f.seek(byte_offset)
+
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                decoder.process(chunk)
+                columns = decoder.flush()
+            else:
+                columns = decoder.flush(pending=True)
+
+            begin = bisect.bisect_left(columns.timestamp, start)
+            end   = bisect.bisect_left(columns.timestamp, stop)
+            for row in range(begin, end):
+                if source_index is None or columns.source[row] == source_index:
+                    result.append(columns.timestamp[row], columns.source[row], columns.data[row])
+            if not chunk or decoder.is_done() or end < len(columns):
+                break
+    return result
+
+# -------------------------------------------------------------------------------------------------
+
+import sys
+import unittest
+import unittest.mock
+
+from .gateware.analyzer import (REPORT_DELAY, REPORT_EVENT, REPORT_SPECIAL,
+                                SPECIAL_DONE, SPECIAL_OVERRUN, TRACE_DONE)
+
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir  = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "trace.bin")
+        self.event_sources = [
+            EventSource("pin", "change", 1, (), 2048),
+            EventSource("fifo", "strobe", 8, (("lo", 4), ("hi", 4)), 512),
+        ]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_trace(self, data):
+        write_trace_header(self.filename, self.event_sources, 30e6, b"\x12\x34")
+        with open(self.filename, "wb") as f:
+            f.write(bytes(data))
+
+    def test_header(self):
+        self.write_trace(b"")
+        header = read_trace_header(self.filename)
+        self.assertEqual(header["bitstream_id"], b"\x12\x34")
+        self.assertEqual(header["sys_clk_freq"], 30e6)
+        pin, fifo = header["event_sources"]
+        self.assertEqual((pin.name, pin.kind, pin.width, pin.fields), ("pin", "change", 1, ()))
+        self.assertEqual(fifo.fields, (("lo", 4), ("hi", 4)))
+        self.assertEqual(list(TraceDecoder(header["event_sources"]).events()),
+                         list(TraceDecoder(self.event_sources).events()))
+
+    def test_bad_header(self):
+        with open(trace_header_filename(self.filename), "w") as f:
+            f.write("{}")
+        with self.assertRaisesRegex(ValueError, r"is not a version 1 analyzer trace header"):
+            read_trace_header(self.filename)
+
+    def decode(self, data, chunk_size=1 << 20):
+        self.write_trace(data)
+        output_filename = os.path.join(self.tempdir.name, "trace.vcd")
+        decode_trace(self.filename, output_filename, chunk_size=chunk_size)
+        with open(output_filename) as f:
+            return "".join(line for line in f if not line.startswith("$date"))
+
+    data = [
+        REPORT_DELAY|3,
+        REPORT_EVENT|0, 1,
+        REPORT_EVENT|1, 0xa5,
+        REPORT_DELAY|3,
+        REPORT_EVENT|0, 0,
+        REPORT_DELAY|1,
+        REPORT_SPECIAL|SPECIAL_DONE,
+    ]
+
+    def test_decode(self):
+        vcd = self.decode(self.data)
+        self.assertIn("bitstream ID 1234", vcd)
+        self.assertIn("$var wire 1 0 throttle $end", vcd)
+        self.assertIn("#100\n$dumpvars\n00\n11\nb101 2\nb1010 3\n$end\n", vcd)
+        self.assertIn("#133\nbz 2\nbz 3\n", vcd)
+        self.assertIn("#200\n01\n", vcd)
+        self.assertEqual(self.decode(self.data, chunk_size=1), vcd)
+
+    def test_decode_truncated(self):
+        vcd = self.decode([REPORT_DELAY|3, REPORT_EVENT|0, 1])
+        self.assertIn("$dumpvars\n00\n11\n", vcd)
+
+    def test_decode_overrun(self):
+        vcd = self.decode([REPORT_DELAY|3, REPORT_SPECIAL|SPECIAL_OVERRUN])
+        self.assertIn("bx 2\nbx 3\n$end\n#1000\n", vcd)
+
+    def test_format(self):
+        self.assertEqual(trace_format("trace.vcd"), "vcd")
+        self.assertEqual(trace_format("trace.FST"), "fst")
+        self.assertEqual(trace_format("trace"), "vcd")
+
+    @unittest.skipUnless(shutil.which("vcd2fst") and shutil.which("fst2vcd"),
+                         "GTKWave not available")
+    def test_decode_fst(self):
+        self.write_trace(self.data)
+        output_filename = os.path.join(self.tempdir.name, "trace.fst")
+        decode_trace(self.filename, output_filename)
+        vcd = subprocess.run(["fst2vcd", output_filename], stdout=subprocess.PIPE,
+                             check=True).stdout.decode()
+        self.assertIn("hi-fifo", vcd)
+        self.assertIn("b1010 ", vcd)
+
+    def fake_vcd2fst(self, stdin=True, broken=False):
+        bin_dir = tempfile.mkdtemp(dir=self.tempdir.name)
+        filename = os.path.join(bin_dir, "vcd2fst")
+        with open(filename, "w") as f:
+            f.write("#!{}\n".format(sys.executable))
+            f.write("import sys\n")
+            f.write("vcd, fst = sys.argv[1:]\n")
+            f.write("if {!r} or (vcd == '-' and not {!r}):\n".format(broken, stdin))
+            f.write("    sys.exit('vcd2fst: cannot read ' + vcd)\n")
+            f.write("with (sys.stdin if vcd == '-' else open(vcd)) as fi, open(fst, 'w') as fo:\n")
+            f.write("    fo.write('FST\\n' + fi.read())\n")
+        os.chmod(filename, 0o755)
+        return unittest.mock.patch.dict(os.environ, {"PATH": bin_dir})
+
+    def decode_fst(self):
+        self.write_trace(self.data)
+        output_filename = os.path.join(self.tempdir.name, "trace.fst")
+        decode_trace(self.filename, output_filename)
+        with open(output_filename) as f:
+            return f.read()
+
+    @unittest.skipUnless(os.name == "posix", "POSIX only")
+    def test_fst_stdin(self):
+        with self.fake_vcd2fst(stdin=True):
+            fst = self.decode_fst()
+        self.assertTrue(fst.startswith("FST\n"))
+        self.assertIn("b1010 3\n", fst)
+
+    @unittest.skipUnless(os.name == "posix", "POSIX only")
+    def test_fst_no_stdin(self):
+        with self.fake_vcd2fst(stdin=False):
+            fst = self.decode_fst()
+        self.assertTrue(fst.startswith("FST\n"))
+        self.assertIn("b1010 3\n", fst)
+        self.assertEqual([name for name in os.listdir(self.tempdir.name)
+                          if name.endswith(".vcd")], [])
+
+    @unittest.skipUnless(os.name == "posix", "POSIX only")
+    def test_fst_broken(self):
+        with self.fake_vcd2fst(broken=True):
+            with self.assertRaisesRegex(TraceWriterError,
+                    r"vcd2fst cannot convert VCD files: exited with status 1: "
+                    r"vcd2fst: cannot read .*probe\.vcd$"):
+                self.decode_fst()
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, "trace.fst")))
+
+    def test_fst_unavailable(self):
+        self.write_trace(self.data)
+        with unittest.mock.patch.dict(os.environ, {"PATH": ""}):
+            with self.assertRaisesRegex(TraceWriterError, r"requires vcd2fst"):
+                decode_trace(self.filename, os.path.join(self.tempdir.name, "trace.fst"))
+
+
+class TraceWriterThreadTestCase(unittest.TestCase):
+    class MockWriter:
+        logger = logger
+
+        def __init__(self, fail_on=None):
+            self.calls   = []
+            self.fail_on = fail_on
+
+        def write(self, batch):
+            if batch == self.fail_on:
+                raise ValueError("cannot write {}".format(batch))
+            self.calls.append(("write", batch))
+            return "overrun" not in batch
+
+        def flush(self):
+            self.calls.append(("flush",))
+
+        def close(self):
+            self.calls.append(("close",))
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+
+    def run_thread(self, batches, **kwargs):
+        async def run():
+            for batch in batches:
+                await thread.put(batch)
+            await thread.close()
+
+        thread = TraceWriterThread(self.writer, max_batches=1, **kwargs)
+        self.loop.run_until_complete(run())
+        return thread
+
+    def test_flush_events(self):
+        self.writer = self.MockWriter()
+        self.run_thread(["ab", "c", "de", "f"], flush_events=3, flush_interval=60)
+        self.assertEqual(self.writer.calls, [
+            ("write", "ab"), ("write", "c"), ("flush",),
+            ("write", "de"), ("write", "f"), ("flush",),
+            ("close",)
+        ])
+
+    def test_flush_interval(self):
+        self.writer = self.MockWriter()
+        async def run():
+            await thread.put("a")
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.writer.calls, [("write", "a"), ("flush",)])
+            await thread.close()
+
+        thread = TraceWriterThread(self.writer, flush_interval=0.01)
+        self.loop.run_until_complete(run())
+
+    def test_overrun(self):
+        self.writer = self.MockWriter()
+        thread = self.run_thread(["a", "overrun", "b"])
+        self.assertTrue(thread.overrun)
+        self.assertEqual(self.writer.calls, [("write", "a"), ("write", "overrun"), ("close",)])
+
+    def test_error(self):
+        self.writer = self.MockWriter(fail_on="b")
+        with self.assertRaisesRegex(ValueError, r"^cannot write b$"):
+            self.run_thread(["a", "b", "c", "d"])
+        self.assertEqual(self.writer.calls, [("write", "a"), ("close",)])
+
+
+    def test_error_on_close(self):
+        # An error writing the last batch is only noticed when the thread is closed.
+        self.writer = self.MockWriter(fail_on="b")
+        with self.assertRaisesRegex(ValueError, r"^cannot write b$"):
+            self.run_thread(["a", "b"])
+        self.assertEqual(self.writer.calls, [("write", "a"), ("close",)])
+
+
+class TraceRawWriterTestCase(unittest.TestCase):
+    def test_write(self):
+        async def run():
+            for chunk in (b"abc", b"", b"de"):
+                await thread.put(chunk)
+            await thread.close()
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "trace.bin")
+            thread = TraceWriterThread(TraceRawWriter(open(filename, "wb")), flush_events=2)
+            asyncio.get_event_loop().run_until_complete(run())
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"abcde")
+
+
+class TraceIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir  = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "trace.bin")
+        self.event_sources = [
+            EventSource("pin", "change", 1, (), 2048),
+            EventSource("word", "strobe", 16, (), 256),
+        ]
+        data = bytearray()
+        for cycle in range(1000):
+            data += bytes([REPORT_DELAY|3, REPORT_EVENT|0, cycle & 1,
+                           REPORT_EVENT|1, cycle >> 8, cycle & 0xff])
+        data += bytes([REPORT_DELAY|1, REPORT_SPECIAL|SPECIAL_DONE])
+        write_trace_header(self.filename, self.event_sources, 30e6, b"\x00")
+        with open(self.filename, "wb") as f:
+            f.write(data)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def decode(self, **kwargs):
+        decode_trace(self.filename, os.path.join(self.tempdir.name, "trace.vcd"), **kwargs)
+
+    def test_index(self):
+        self.decode(index_interval=100)
+        index = TraceIndex.load(self.filename)
+        self.assertEqual(index.interval, 100)
+        self.assertEqual(index.checkpoints[0], (0, 0, ("IDLE", 0, 0)))
+        # Every cycle of the trace is 6 bytes and advances the timestamp by 3, so the whole trace
+        # is decoded as one chunk, but checkpoints are still taken every 34 cycles.
+        self.assertEqual(index.checkpoints[1], (102, 34 * 6, ("IDLE", 102, 0)))
+        self.assertEqual(len(index.checkpoints), 30)
+        timestamp, byte_offset, state = index.find(1500)
+        self.assertLess(timestamp, 1500)
+        self.assertGreaterEqual(timestamp, 1500 - 102)
+        self.assertIsNone(index.find(0))
+
+        checkpoints = index.checkpoints
+        self.decode(index_interval=100, chunk_size=64)
+        self.assertEqual(TraceIndex.load(self.filename).checkpoints, checkpoints)
+
+    def test_stale_index(self):
+        self.decode()
+        with open(self.filename, "ab") as f:
+            f.write(b"\x00")
+        self.assertIsNone(TraceIndex.load(self.filename))
+
+    def test_query(self):
+        self.assertEqual(list(query_trace(self.filename, 30, 36)), [
+            (30, 0, 1), (30, 1, 9),
+            (33, 0, 0), (33, 1, 10),
+        ])
+        reference = query_trace(self.filename, 1490, 2200, source="word")
+        self.assertEqual(list(reference.data), list(range(496, 733)))
+
+        self.decode(index_interval=100, chunk_size=64)
+        with self.assertLogs(__name__, "DEBUG") as logs:
+            columns = query_trace(self.filename, 1490, 2200, source="word", chunk_size=16)
+        self.assertRegex(logs.output[0], r"starting at byte offset [1-9]")
+        self.assertEqual(list(columns), list(reference))
+        self.assertEqual(list(query_trace(self.filename, 3000, 3010)), [
+            (3000, 0, 1), (3000, 1, 999), (3001, TRACE_DONE, 0),
+        ])
+
+    def test_query_unknown_source(self):
+        with self.assertRaisesRegex(ValueError, r"has no event source 'foo'"):
+            query_trace(self.filename, 0, 1, source="foo")
+
+
+def _benchmark_trace_writers(cycles=200000):
+    event_sources = [
+        EventSource("sck", "change", 1, (), 2048),
+        EventSource("data", "strobe", 8, (), 512),
+    ]
+    data = bytearray()
+    for cycle in range(cycles):
+        data += bytes([REPORT_DELAY|2, REPORT_EVENT|0, cycle & 1, REPORT_EVENT|1, cycle & 0xff])
+    data += bytes([REPORT_DELAY|1, REPORT_SPECIAL|SPECIAL_DONE])
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, "trace.bin")
+        write_trace_header(filename, event_sources, 30e6, b"\x00")
+        with open(filename, "wb") as f:
+            f.write(data)
+
+        for format in TRACE_FORMATS:
+            output_filename = os.path.join(tempdir, "trace." + format)
+            started = time.perf_counter()
+            try:
+                decode_trace(filename, output_filename)
+            except TraceWriterError as e:
+                print("{}: {}".format(format, e))
+                continue
+            elapsed = time.perf_counter() - started
+            print("{}: {} cycles in {:.2f} s ({:.0f} cycles/s), {} bytes".format(
+                format, cycles, elapsed, cycles / elapsed, os.path.getsize(output_filename)))
+
+
+if __name__ == "__main__":
+    _benchmark_trace_writers()